@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Rollout of stacksets deployed to several account batches with different
+parameters, running every entry at once versus grouping the entries by
+StackSet.
+
+With a flat Map, the entries of a StackSet collide: all but one are rejected
+with OperationInProgressException, and back off in the functions then in the
+retry policy of the state machine. Grouped by StackSet, the entries of a
+StackSet run one after the other while the StackSets run in parallel.
+"""
+
+import argparse
+import copy
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+from statemachine import StateMachine, find_state, load_definition
+
+
+def flat_definition(definition):
+    # Map over every entry at once, as the state machine used to
+    iterator = copy.deepcopy(find_state(definition, "CreateStackSetGroupInstances"))
+    iterator.pop("MaxConcurrencyPath")
+    iterator["ItemsPath"] = "$.stacksets"
+    return {
+        "StartAt": "CreateStackSetInstances",
+        "States": {"CreateStackSetInstances": iterator},
+    }
+
+
+def rollout(functions, stacksets, variants, mode, stackset_concurrency, seed):
+    trigger, create, verify = functions
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(clock, operation_seconds=(45, 300), seed=seed)
+    create.cloudformation = verify.cloudformation = cloudformation
+    create.stack_instances.invalidate()
+    config_file = {
+        "stacksets": [
+            {
+                "name": "stackset-" + str(stackset),
+                "parameters": {"Variant": str(variant)},
+                "accounts": [str(100000000000 + variant)],
+            }
+            for stackset in range(stacksets)
+            for variant in range(variants)
+        ]
+    }
+    definition = load_definition()
+    if mode == "flat":
+        definition = flat_definition(definition)
+        execution_input = config_file
+    else:
+        config_file["stackset_concurrency"] = stackset_concurrency
+        execution_input = trigger.order_stacksets(config_file)
+    state_machine = StateMachine(
+        definition,
+        {
+            "CreateUpdateDeleteStackInstances": create,
+            "VerifyStackInstanceStatus": verify,
+        },
+        clock,
+    )
+    with patch_sleep(clock):
+        state_machine.run(execution_input)
+    return clock.now, state_machine.usage, cloudformation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stacksets", type=int, default=5)
+    parser.add_argument("--variants", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    environ = {"AWS_REGION": "eu-west-1"}
+    functions = (
+        load_function("01_trigger_step_function", {"STATE_MACHINE": "benchmark"}),
+        load_function("02_create_update_delete_stack_instances", environ),
+        load_function("03_verify_stack_instance_creation", environ),
+    )
+
+    rows = []
+    for variants in args.variants:
+        for mode in ["flat", "grouped"]:
+            makespan, usage, cloudformation = rollout(
+                functions, args.stacksets, variants, mode, 1, args.seed
+            )
+            rows.append(
+                [
+                    args.stacksets * variants,
+                    mode,
+                    "%.0f" % makespan,
+                    "%.1f" % usage["lambda_seconds"],
+                    cloudformation.rejected_operations,
+                    usage["retries"],
+                ]
+            )
+    print_table(
+        [
+            "entries",
+            "mode",
+            "wall s",
+            "lambda s",
+            "rejected operations",
+            "states retries",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
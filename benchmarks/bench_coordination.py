@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Executions contending for the same StackSets, with and without the
+coordination layer.
+
+Several account files are uploaded a few seconds apart, each starting an
+execution that deploys the same stacksets. Without coordination, the
+executions collide with OperationInProgressException and back off for
+minutes. With StackSet leases (in-memory store), the operations queue.
+"""
+
+import argparse
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+from statemachine import StateMachine, load_definition
+
+
+def rollout(functions, executions, stacksets, mode, upload_interval, seed):
+    trigger, create, verify = functions
+    coordination = create.coordination
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(clock, operation_seconds=(45, 300), seed=seed)
+    create.cloudformation = verify.cloudformation = cloudformation
+    create.stack_instances.invalidate()
+    if mode == "coordinated":
+        coordination.use(
+            coordination.Coordinator(coordination.MemoryStore(), clock=clock.time)
+        )
+        coordination.throttle_client(cloudformation)
+    else:
+        coordination.use(coordination.NullCoordinator())
+
+    inputs = [
+        trigger.order_stacksets(
+            trigger.add_account_information(
+                {
+                    "account": str(100000000000 + execution),
+                    "stacksets": [
+                        {"name": "stackset-" + str(index)} for index in range(stacksets)
+                    ],
+                }
+            )
+        )
+        for execution in range(executions)
+    ]
+    state_machine = StateMachine(
+        load_definition(),
+        {
+            "CreateUpdateDeleteStackInstances": create,
+            "VerifyStackInstanceStatus": verify,
+        },
+        clock,
+        seed=seed,
+    )
+    with patch_sleep(clock):
+        state_machine.run(
+            *inputs,
+            start_times=[upload_interval * index for index in range(executions)]
+        )
+    return clock.now, state_machine.usage, cloudformation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--executions", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--stacksets", type=int, default=3)
+    parser.add_argument("--upload-interval", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    environ = {"AWS_REGION": "eu-west-1"}
+    functions = (
+        load_function("01_trigger_step_function", {"STATE_MACHINE": "benchmark"}),
+        load_function("02_create_update_delete_stack_instances", environ),
+        load_function("03_verify_stack_instance_creation", environ),
+    )
+
+    rows = []
+    for executions in args.executions:
+        for mode in ["uncoordinated", "coordinated"]:
+            makespan, usage, cloudformation = rollout(
+                functions,
+                executions,
+                args.stacksets,
+                mode,
+                args.upload_interval,
+                args.seed,
+            )
+            rows.append(
+                [
+                    executions,
+                    mode,
+                    "%.0f" % makespan,
+                    "%.1f" % usage["lambda_seconds"],
+                    cloudformation.rejected_operations,
+                    usage["retries"],
+                    cloudformation.api_calls,
+                ]
+            )
+    print_table(
+        [
+            "executions",
+            "mode",
+            "wall s",
+            "lambda s",
+            "rejected operations",
+            "states retries",
+            "api calls",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Edit of a single stackset in a large account file, deploying the whole file
+versus the delta with its applied state.
+
+The file is applied once, then one stackset gets new parameters and another
+is removed from the file; only the second rollout is measured.
+"""
+
+import argparse
+import copy
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+from statemachine import StateMachine, load_definition
+
+
+def account_file(stacksets):
+    return {
+        "account": "123456789876",
+        "stacksets": [
+            {"name": "stackset-" + str(index), "parameters": {"Version": "1"}}
+            for index in range(stacksets)
+        ],
+    }
+
+
+def rollout(functions, stacksets, mode, seed):
+    trigger, create, verify = functions
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(clock, operation_seconds=(45, 300), seed=seed)
+    create.cloudformation = verify.cloudformation = cloudformation
+    create.stack_instances.invalidate()
+    create.coordination.use(create.coordination.NullCoordinator())
+    state_machine = StateMachine(
+        load_definition(),
+        {
+            "CreateUpdateDeleteStackInstances": create,
+            "VerifyStackInstanceStatus": verify,
+        },
+        clock,
+    )
+
+    applied_file = trigger.add_account_information(account_file(stacksets))
+    edited_file = trigger.add_account_information(account_file(stacksets))
+    edited_file["stacksets"][0]["parameters"]["Version"] = "2"
+    edited_file["stacksets"].pop()
+    if mode == "incremental":
+        applied_state = {
+            "succeeded": True,
+            "stacksets": {
+                stackset["name"]: {
+                    "digest": trigger.stackset_digest(stackset),
+                    "stackset": stackset,
+                }
+                for stackset in applied_file["stacksets"]
+            },
+        }
+        edited_file = trigger.delta_config_file(
+            edited_file, trigger.diff_stacksets(applied_state, edited_file)
+        )
+
+    with patch_sleep(clock):
+        state_machine.run(trigger.order_stacksets(copy.deepcopy(applied_file)))
+        applied_at = clock.now
+        operations = len(cloudformation.operations)
+        api_calls = cloudformation.api_calls
+        usage = dict(state_machine.usage)
+        state_machine.run(trigger.order_stacksets(edited_file))
+    return (
+        clock.now - applied_at,
+        state_machine.usage["lambda_seconds"] - usage["lambda_seconds"],
+        state_machine.usage["invocations"] - usage["invocations"],
+        len(cloudformation.operations) - operations,
+        cloudformation.api_calls - api_calls,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stacksets", type=int, nargs="+", default=[5, 30, 100])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    environ = {"AWS_REGION": "eu-west-1"}
+    functions = (
+        load_function("01_trigger_step_function", {"STATE_MACHINE": "benchmark"}),
+        load_function("02_create_update_delete_stack_instances", environ),
+        load_function("03_verify_stack_instance_creation", environ),
+    )
+
+    rows = []
+    for stacksets in args.stacksets:
+        for mode in ["whole file", "incremental"]:
+            wall, lambda_seconds, invocations, operations, api_calls = rollout(
+                functions, stacksets, mode, args.seed
+            )
+            rows.append(
+                [
+                    stacksets,
+                    mode,
+                    "%.0f" % wall,
+                    "%.1f" % lambda_seconds,
+                    invocations,
+                    operations,
+                    api_calls,
+                ]
+            )
+    print_table(
+        [
+            "stacksets",
+            "mode",
+            "wall s",
+            "lambda s",
+            "invocations",
+            "operations",
+            "api calls",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Rollout of many accounts with a single manifest instead of one file per account.
+
+The manifest is streamed from an in-memory object, and start_execution is a
+fixed-latency stand-in. The table compares the executions and StackSet
+operations requested by a manifest with one configuration file per account.
+"""
+
+import argparse
+import io
+import json
+import time
+
+from botocore.response import StreamingBody
+
+from harness import load_function, print_table
+
+STACKSETS = ["vpc", "dns", "logging"]
+
+
+def document(account_id):
+    return {
+        "account": account_id,
+        "stacksets": [{"name": name} for name in STACKSETS],
+    }
+
+
+def make_manifest(accounts, manifest_format):
+    documents = [document("%012d" % account) for account in range(accounts)]
+    if manifest_format == "jsonl":
+        return "\n".join(json.dumps(d) for d in documents).encode()
+    return "".join(
+        "---\naccount: '"
+        + d["account"]
+        + "'\nstacksets:\n"
+        + "".join("- name: " + s["name"] + "\n" for s in d["stacksets"])
+        for d in documents
+    ).encode()
+
+
+def make_event(keys):
+    return {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "benchmark-bucket"},
+                    "object": {"key": key},
+                }
+            }
+            for key in keys
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[100, 2000])
+    parser.add_argument("--start-execution-latency", type=float, default=0.01)
+    parser.add_argument("--max-executions", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    trigger = load_function(
+        "01_trigger_step_function",
+        {"STATE_MACHINE": "benchmark_arn", "INCREMENTAL_DEPLOYMENTS": "false"},
+    )
+    trigger.MANIFEST_MAX_EXECUTIONS = args.max_executions
+    trigger.MANIFEST_BATCH_SIZE = args.batch_size
+    objects = {}
+    operations = []
+
+    def get_object(Bucket, Key):
+        body = objects[Key]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body))}
+
+    def start_execution(**kwargs):
+        time.sleep(args.start_execution_latency)
+        execution_input = json.loads(kwargs["input"])
+        for wave in execution_input["waves"]:
+            for group in wave["stackset_groups"]:
+                operations.extend(group["stacksets"])
+        return {"executionArn": "arn:" + str(len(operations))}
+
+    trigger.s3.get_object = get_object
+    trigger.step_functions.start_execution = start_execution
+
+    rows = []
+    for accounts in args.accounts:
+        for mode in ["files", "yaml", "jsonl"]:
+            operations.clear()
+            if mode == "files":
+                keys = [
+                    "accounts/" + str(account) + ".yaml" for account in range(accounts)
+                ]
+                for account, key in enumerate(keys):
+                    objects[key] = json.dumps(document("%012d" % account)).encode()
+            else:
+                keys = ["rollout." + ("jsonl" if mode == "jsonl" else "manifest.yaml")]
+                objects[keys[0]] = make_manifest(accounts, mode)
+            start = time.perf_counter()
+            report = trigger.lambda_handler(make_event(keys), {})
+            elapsed = time.perf_counter() - start
+            assert not report["failures"], report["failures"][0]
+            rows.append(
+                [
+                    accounts,
+                    mode,
+                    len(keys),
+                    len(report["executions"]),
+                    len(operations),
+                    "%.3f" % elapsed,
+                ]
+            )
+    print_table(
+        ["accounts", "mode", "uploads", "executions", "operations", "seconds"], rows
+    )
+
+
+if __name__ == "__main__":
+    main()
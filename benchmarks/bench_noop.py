@@ -0,0 +1,116 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Re-apply of an unchanged account tree, updating every stack instance versus
+skipping the instances which already have their parameters.
+
+The tree is applied once, then the same configuration is applied again; only
+the second rollout is measured.
+"""
+
+import argparse
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+from statemachine import StateMachine, load_definition
+
+
+def rollout(functions, accounts, stacksets, mode, seed):
+    trigger, create, verify = functions
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(clock, operation_seconds=(45, 300), seed=seed)
+    create.cloudformation = verify.cloudformation = cloudformation
+    create.stack_instances.invalidate()
+    create.coordination.use(create.coordination.NullCoordinator())
+    describe_parameters = create.describe_parameters
+    if mode == "update all":
+        create.describe_parameters = lambda *args: {}
+
+    execution_input = trigger.order_stacksets(
+        {
+            "stacksets": [
+                {
+                    "name": "stackset-" + str(stackset),
+                    "parameters": {"Environment": "production"},
+                    "accounts": [str(100000000000 + a) for a in range(accounts)],
+                }
+                for stackset in range(stacksets)
+            ]
+        }
+    )
+    state_machine = StateMachine(
+        load_definition(),
+        {
+            "CreateUpdateDeleteStackInstances": create,
+            "VerifyStackInstanceStatus": verify,
+        },
+        clock,
+    )
+    try:
+        with patch_sleep(clock):
+            state_machine.run(execution_input)
+            applied_at = clock.now
+            operations = len(cloudformation.operations)
+            api_calls = cloudformation.api_calls
+            usage = dict(state_machine.usage)
+            state_machine.run(execution_input)
+    finally:
+        create.describe_parameters = describe_parameters
+    return (
+        clock.now - applied_at,
+        state_machine.usage["lambda_seconds"] - usage["lambda_seconds"],
+        len(cloudformation.operations) - operations,
+        cloudformation.api_calls - api_calls,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--stacksets", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    environ = {"AWS_REGION": "eu-west-1"}
+    functions = (
+        load_function("01_trigger_step_function", {"STATE_MACHINE": "benchmark"}),
+        load_function("02_create_update_delete_stack_instances", environ),
+        load_function("03_verify_stack_instance_creation", environ),
+    )
+
+    rows = []
+    for accounts in args.accounts:
+        for mode in ["update all", "skip unchanged"]:
+            wall, lambda_seconds, operations, api_calls = rollout(
+                functions, accounts, args.stacksets, mode, args.seed
+            )
+            rows.append(
+                [
+                    accounts,
+                    mode,
+                    "%.0f" % wall,
+                    "%.1f" % lambda_seconds,
+                    operations,
+                    api_calls,
+                ]
+            )
+    print_table(
+        ["accounts", "mode", "wall s", "lambda s", "operations", "api calls"], rows
+    )
+
+
+if __name__ == "__main__":
+    main()
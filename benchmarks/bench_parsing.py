@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Parsing of large YAML manifests, with the pure-Python and the libyaml loaders.
+
+Each document describes an account with a few stacksets and parameters. The
+table shows the time to parse the manifest with each loader, and the time
+added by validating and normalizing the documents against the schema.
+"""
+
+import argparse
+import time
+
+import yaml
+
+from harness import print_table
+from stackset_orchestration import schema
+
+LOADERS = [("SafeLoader", yaml.SafeLoader)]
+if hasattr(yaml, "CSafeLoader"):
+    LOADERS.append(("CSafeLoader", yaml.CSafeLoader))
+
+
+def make_manifest(documents):
+    return "".join(
+        "---\n"
+        "account: '%012d'\n"
+        "regions: [eu-west-1, us-east-1]\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "  parameters:\n"
+        "    CidrBlock: '10.%d.%d.0/24'\n"
+        "    EnableDnsHostnames: true\n"
+        "    SubnetCount: 3\n"
+        "  max_concurrent_percentage: 50\n"
+        "- name: dns\n"
+        "- name: logging\n"
+        "  parameters:\n"
+        "    RetentionInDays: 90\n" % (document, document // 256, document % 256)
+        for document in range(documents)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, nargs="+", default=[100, 2000])
+    args = parser.parse_args()
+
+    rows = []
+    for documents in args.documents:
+        manifest = make_manifest(documents)
+        for name, loader in LOADERS:
+            start = time.perf_counter()
+            parsed = list(yaml.load_all(manifest, Loader=loader))
+            parsing = time.perf_counter() - start
+            start = time.perf_counter()
+            for document in parsed:
+                schema.normalize(document)
+            validation = time.perf_counter() - start
+            rows.append(
+                [
+                    documents,
+                    "%.1f" % (len(manifest) / 1024),
+                    name,
+                    "%.3f" % parsing,
+                    "%.3f" % validation,
+                    "%.1f%%" % (100 * validation / parsing),
+                ]
+            )
+    print_table(
+        ["documents", "KB", "loader", "parse s", "validate s", "overhead"], rows
+    )
+
+
+if __name__ == "__main__":
+    main()
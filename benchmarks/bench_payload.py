@@ -0,0 +1,137 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Size of the Step Functions payloads of a large rollout, inline versus offloaded.
+
+Every account of the manifest has its own parameters, so each one is deployed
+by its own Map iteration. The table shows the execution input, the state of an
+iteration and the time the trigger function takes, against the 256 KB limit.
+"""
+
+import argparse
+import io
+import json
+import time
+
+from botocore.response import StreamingBody
+
+from harness import load_function, print_table
+
+PAYLOAD_LIMIT = 256 * 1024
+
+
+def make_manifest(accounts, parameters):
+    return "\n".join(
+        json.dumps(
+            {
+                "account": "%012d" % account,
+                "stacksets": [
+                    {
+                        "name": "baseline",
+                        "parameters": {
+                            "Parameter" + str(i): "value-%012d-%d" % (account, i)
+                            for i in range(parameters)
+                        },
+                    }
+                ],
+            }
+        )
+        for account in range(accounts)
+    ).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--parameters", type=int, default=10)
+    args = parser.parse_args()
+
+    trigger = load_function(
+        "01_trigger_step_function",
+        {"STATE_MACHINE": "benchmark_arn", "INCREMENTAL_DEPLOYMENTS": "false"},
+    )
+    objects = {}
+    inputs = []
+
+    def get_object(Bucket, Key, Range=None):
+        body = objects[Key]
+        if Range:
+            start, end = Range[len("bytes=") :].split("-")
+            body = body[int(start) : int(end) + 1]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body))}
+
+    def put_object(Bucket, Key, Body, **kwargs):
+        objects[Key] = Body
+        return {}
+
+    def start_execution(**kwargs):
+        inputs.append(kwargs["input"])
+        return {"executionArn": "arn:" + str(len(inputs))}
+
+    trigger.s3.get_object = get_object
+    trigger.s3.put_object = put_object
+    trigger.payloads.s3.get_object = get_object
+    trigger.payloads.s3.put_object = put_object
+    trigger.step_functions.start_execution = start_execution
+    trigger.MANIFEST_MAX_EXECUTIONS = 1
+    trigger.PLAN_BUCKET = "benchmark-bucket"
+
+    rows = []
+    for accounts in args.accounts:
+        objects["rollout.jsonl"] = make_manifest(accounts, args.parameters)
+        event = {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": "benchmark-bucket"},
+                        "object": {"key": "rollout.jsonl"},
+                    }
+                }
+            ]
+        }
+        for mode, threshold in [("inline", 2**62), ("offloaded", 0)]:
+            trigger.PLAN_OFFLOAD_THRESHOLD = threshold
+            inputs.clear()
+            start = time.perf_counter()
+            report = trigger.lambda_handler(event, {})
+            elapsed = time.perf_counter() - start
+            assert not report["failures"], report["failures"][0]
+            execution_input = json.loads(inputs[0])
+            items = [
+                stackset
+                for wave in execution_input["waves"]
+                for group in wave["stackset_groups"]
+                for stackset in group["stacksets"]
+            ]
+            # An iteration loads its own stackset, and returns the compact state
+            loaded = trigger.payloads.load(items[-1])
+            item_size = len(json.dumps(trigger.payloads.compact(loaded)))
+            input_size = len(inputs[0])
+            rows.append(
+                [
+                    accounts,
+                    mode,
+                    "%.1f" % (input_size / 1024),
+                    "yes" if input_size <= PAYLOAD_LIMIT else "no",
+                    item_size,
+                    "%.3f" % elapsed,
+                ]
+            )
+    print_table(["accounts", "mode", "input KB", "fits", "item bytes", "seconds"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Lambda-seconds of the verify loop, waiting inside the verify function versus
+in a Wait state of the state machine.
+
+Runs the state machine of template.yaml locally against a fake CloudFormation,
+for one execution deploying N stacksets. "lambda-sleep" reproduces the former
+loop, where the verify function slept 30 seconds before each poll.
+"""
+
+import argparse
+import copy
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+from statemachine import StateMachine, find_state, load_definition
+
+LEGACY_POLL_SECONDS = 30
+
+
+class SleepingVerify:
+    # Verify function sleeping before each poll, as it used to
+    def __init__(self, verify, clock):
+        self.verify = verify
+        self.clock = clock
+
+    def lambda_handler(self, event, context):
+        self.clock.sleep(LEGACY_POLL_SECONDS)
+        return self.verify.lambda_handler(event, context)
+
+
+def legacy_definition(definition):
+    # Verify again right away instead of waiting in the state machine
+    definition = copy.deepcopy(definition)
+    wait = find_state(definition, "WaitForStackSetOperation")
+    wait.pop("SecondsPath")
+    wait["Seconds"] = 0
+    return definition
+
+
+def rollout(functions, stacksets, mode, operation_seconds, seed):
+    trigger, create, verify = functions
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(
+        clock, operation_seconds=operation_seconds, seed=seed
+    )
+    create.cloudformation = verify.cloudformation = cloudformation
+    create.stack_instances.invalidate()
+    definition = load_definition()
+    resources = {"CreateUpdateDeleteStackInstances": create}
+    if mode == "lambda-sleep":
+        definition = legacy_definition(definition)
+        resources["VerifyStackInstanceStatus"] = SleepingVerify(verify, clock)
+    else:
+        resources["VerifyStackInstanceStatus"] = verify
+    state_machine = StateMachine(definition, resources, clock)
+    execution_input = trigger.order_stacksets(
+        trigger.add_account_information(
+            {
+                "account": "123456789876",
+                "stacksets": [
+                    {
+                        "name": "stackset-" + str(index),
+                        "parameters": {"CidrBlock": "10.0.0.0/24"},
+                    }
+                    for index in range(stacksets)
+                ],
+            }
+        )
+    )
+    with patch_sleep(clock):
+        state_machine.run(execution_input)
+    return clock.now, state_machine.usage, cloudformation.api_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stacksets", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--min-operation-seconds", type=float, default=45)
+    parser.add_argument("--max-operation-seconds", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    environ = {"AWS_REGION": "eu-west-1"}
+    functions = (
+        load_function("01_trigger_step_function", {"STATE_MACHINE": "benchmark"}),
+        load_function("02_create_update_delete_stack_instances", environ),
+        load_function("03_verify_stack_instance_creation", environ),
+    )
+
+    rows = []
+    for stacksets in args.stacksets:
+        for mode in ["lambda-sleep", "wait-state"]:
+            makespan, usage, api_calls = rollout(
+                functions,
+                stacksets,
+                mode,
+                (args.min_operation_seconds, args.max_operation_seconds),
+                args.seed,
+            )
+            rows.append(
+                [
+                    stacksets,
+                    mode,
+                    "%.0f" % makespan,
+                    "%.1f" % usage["lambda_seconds"],
+                    usage["invocations"],
+                    usage["transitions"],
+                    api_calls,
+                ]
+            )
+    print_table(
+        [
+            "stacksets",
+            "mode",
+            "wall s",
+            "lambda s",
+            "invocations",
+            "transitions",
+            "api calls",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Wall time and Lambda-seconds of an N-stackset rollout, before and after the
+retry engine replaced the fixed random sleeps.
+
+Each stackset is deployed by its own Map iteration, so the rollout takes as
+long as its slowest stackset. "before" reproduces the randrange(10, 20) sleeps
+of the original functions around each CloudFormation call. Both modes poll
+every 30 seconds from within the verify function, so that only the retry
+policy differs (see bench_polling.py for the poll interval).
+"""
+
+import argparse
+
+from botocore.exceptions import ClientError
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+
+# Retry policy of the Lambda tasks in the state machine
+STATES_RETRY_INTERVAL = 120
+STATES_RETRY_BACKOFF = 1.1
+STATES_RETRY_MAX_ATTEMPTS = 30
+POLL_SECONDS = 30
+
+
+class SleepingVerify:
+    def __init__(self, verify, clock):
+        self.verify = verify
+        self.clock = clock
+
+    def lambda_handler(self, event, context):
+        self.clock.sleep(POLL_SECONDS)
+        return self.verify.lambda_handler(event, context)
+
+
+def invoke(function, event, clock, usage):
+    # Invoke a Lambda function, retrying it like the state machine does
+    for attempt in range(STATES_RETRY_MAX_ATTEMPTS + 1):
+        start = clock.now
+        try:
+            result = function.lambda_handler(event, {})
+        except ClientError:
+            if attempt == STATES_RETRY_MAX_ATTEMPTS:
+                raise
+            usage["states_retries"] += 1
+            usage["lambda_seconds"] += clock.now - start
+            clock.advance(STATES_RETRY_INTERVAL * STATES_RETRY_BACKOFF**attempt)
+            continue
+        usage["lambda_seconds"] += clock.now - start
+        return result
+
+
+def rollout(functions, stacksets, legacy, throttle_rate, seed):
+    create, verify = functions
+    # The original functions left every throttling error to the state machine
+    create.retry.retrier.max_attempts = 1 if legacy else 5
+    usage = {"lambda_seconds": 0.0, "states_retries": 0, "api_calls": 0}
+    makespan = 0.0
+    for index in range(stacksets):
+        clock = VirtualClock()
+        cloudformation = FakeCloudFormation(
+            clock,
+            throttle_rate=throttle_rate,
+            legacy_jitter=legacy,
+            seed=seed + index,
+        )
+        create.cloudformation = verify.cloudformation = cloudformation
+        create.stack_instances.invalidate()
+        event = {
+            "name": "stackset-" + str(index),
+            "account": "123456789876",
+            "parameters": {"CidrBlock": "10.0.0.0/24"},
+        }
+        poll = SleepingVerify(verify, clock)
+        with patch_sleep(clock):
+            event = invoke(create, event, clock, usage)
+            event = invoke(poll, event, clock, usage)
+            while not event["stackset_instance_ready"]:
+                event = invoke(poll, event, clock, usage)
+        usage["api_calls"] += cloudformation.api_calls
+        makespan = max(makespan, clock.now)
+    return makespan, usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stacksets", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--throttle-rates", type=float, nargs="+", default=[0, 0.2])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    environ = {"AWS_REGION": "eu-west-1"}
+    functions = (
+        load_function("02_create_update_delete_stack_instances", environ),
+        load_function("03_verify_stack_instance_creation", environ),
+    )
+
+    rows = []
+    for throttle_rate in args.throttle_rates:
+        for stacksets in args.stacksets:
+            for mode in ["before", "after"]:
+                makespan, usage = rollout(
+                    functions, stacksets, mode == "before", throttle_rate, args.seed
+                )
+                rows.append(
+                    [
+                        throttle_rate,
+                        stacksets,
+                        mode,
+                        "%.0f" % makespan,
+                        "%.0f" % usage["lambda_seconds"],
+                        usage["api_calls"],
+                        usage["states_retries"],
+                    ]
+                )
+    print_table(
+        [
+            "throttle",
+            "stacksets",
+            "mode",
+            "wall s",
+            "lambda s",
+            "api calls",
+            "states retries",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+End-to-end rollouts of stacksets to accounts, from the upload of the
+configuration files to the end of the executions.
+
+Each rollout runs the three functions and the state machine of template.yaml
+against fake AWS services on a virtual clock (see simulator.py). The table
+reports the makespan, the API calls and the Lambda-seconds of each way of
+notifying the configuration files: one S3 event per account file, a single
+event in batching mode, or a single manifest. With --update and a failure
+rate, failed updates are rolled back, and the table reports the longest time
+to recovery of their stack instances.
+"""
+
+import argparse
+
+from harness import print_table
+from simulator import MODES, simulate
+
+
+def format_recovery(usage):
+    if usage["unrecovered_operations"]:
+        return "never"
+    if usage["recovery_seconds"] is None:
+        return "-"
+    return "%.0f" % usage["recovery_seconds"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--stacksets", type=int, nargs="+", default=[3])
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--operation-seconds", type=float, nargs=2, default=[45, 300])
+    parser.add_argument("--api-latency", type=float, default=0.1)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--managed-execution",
+        action="store_true",
+        help="queue concurrent operations on a StackSet instead of rejecting them",
+    )
+    parser.add_argument(
+        "--coordinated",
+        action="store_true",
+        help="share StackSet leases and an API call bucket between executions",
+    )
+    parser.add_argument("--upload-interval", type=float, default=0.0)
+    parser.add_argument(
+        "--chained",
+        action="store_true",
+        help="make each stackset depend on the previous one",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="update stack instances deployed with other parameters",
+    )
+    parser.add_argument(
+        "--rollout",
+        action="store_true",
+        help="deploy the accounts in growing waves after a canary account",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = []
+    for accounts in args.accounts:
+        for stacksets in args.stacksets:
+            for mode in args.modes:
+                usage = simulate(
+                    accounts=accounts,
+                    stacksets=stacksets,
+                    regions=args.regions,
+                    mode=mode,
+                    operation_seconds=tuple(args.operation_seconds),
+                    api_latency=args.api_latency,
+                    throttle_rate=args.throttle_rate,
+                    failure_rate=args.failure_rate,
+                    managed_execution=args.managed_execution,
+                    coordinated=args.coordinated,
+                    upload_interval=args.upload_interval,
+                    chained=args.chained,
+                    update=args.update,
+                    rollout=args.rollout,
+                    seed=args.seed,
+                )
+                rows.append(
+                    [
+                        accounts,
+                        stacksets,
+                        mode,
+                        usage["executions"],
+                        usage["failed_executions"],
+                        usage["operations"],
+                        usage["rejected_operations"],
+                        "%.0f" % usage["makespan"],
+                        usage["api_calls"],
+                        "%.1f" % usage["lambda_seconds"],
+                        format_recovery(usage),
+                    ]
+                )
+    print_table(
+        [
+            "accounts",
+            "stacksets",
+            "mode",
+            "executions",
+            "failed",
+            "operations",
+            "rejected",
+            "makespan s",
+            "API calls",
+            "lambda s",
+            "recovery s",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Cold start of the Lambda functions: import of boto3 and of their module, first
+call, which creates the boto3 client when it is lazy, and a warm call.
+
+Every function is measured in a fresh interpreter, with stubbed AWS responses.
+The eager rows create the clients with the default configuration at import,
+as the functions did before the client factory of the shared layer.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from harness import print_table
+
+FUNCTIONS = [
+    ("01_trigger_step_function", ["s3", "step_functions"], "s3", "list_buckets"),
+    (
+        "02_create_update_delete_stack_instances",
+        ["cloudformation"],
+        "cloudformation",
+        "list_stack_sets",
+    ),
+    (
+        "03_verify_stack_instance_creation",
+        ["cloudformation"],
+        "cloudformation",
+        "list_stack_sets",
+    ),
+]
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import boto3
+from botocore.stub import Stubber
+from harness import load_function
+function_dir, client_names, client_name, operation_name, eager = json.loads(sys.argv[1])
+imported = time.perf_counter()
+module = load_function(function_dir, {"AWS_REGION": "eu-west-1", "STATE_MACHINE": "benchmark"})
+if eager:
+    for name in client_names:
+        service_name = getattr(module, name)._service_name
+        setattr(module, name, boto3.client(service_name))
+loaded = time.perf_counter()
+client = getattr(module, client_name)
+timings = []
+for _ in range(2):
+    call_start = time.perf_counter()
+    stubber = Stubber(client)
+    stubber.add_response(operation_name, {})
+    with stubber:
+        getattr(client, operation_name)()
+    timings.append(time.perf_counter() - call_start)
+print(json.dumps([imported - start, loaded - imported] + timings))
+"""
+
+
+def measure(function, eager):
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE, json.dumps(list(function) + [eager])],
+        cwd=os.path.dirname(os.path.realpath(__file__)),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for function in FUNCTIONS:
+        for mode in ["eager", "lazy"]:
+            runs = [measure(function, mode == "eager") for _ in range(args.runs)]
+            medians = [
+                statistics.median(run[index] for run in runs) * 1000
+                for index in range(4)
+            ]
+            rows.append(
+                [function[0], mode]
+                + ["%.1f" % median for median in medians]
+                + ["%.1f" % (medians[1] + medians[2])]
+            )
+    print_table(
+        [
+            "function",
+            "clients",
+            "boto3 import ms",
+            "module import ms",
+            "first call ms",
+            "warm call ms",
+            "cold start ms",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Throughput of the trigger function for S3 notifications carrying many records.
+
+The S3 and Step Functions calls are replaced by fixed-latency stand-ins, so the
+numbers show how the bounded thread pool overlaps network waits.
+"""
+
+import argparse
+import time
+
+from harness import load_function, print_table
+
+CONFIG_FILE = """
+account: '123456789876'
+stacksets:
+- name: vpc
+  parameters:
+    CidrBlock: '10.0.0.0/24'
+"""
+
+
+def make_event(batch_size):
+    return {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "benchmark-bucket"},
+                    "object": {"key": "accounts/" + str(i) + ".yaml"},
+                }
+            }
+            for i in range(batch_size)
+        ]
+    }
+
+
+def run(trigger, batch_size, max_workers):
+    trigger.MAX_WORKERS = max_workers
+    start = time.perf_counter()
+    report = trigger.lambda_handler(make_event(batch_size), {})
+    elapsed = time.perf_counter() - start
+    assert len(report["executions"]) == batch_size, report["failures"]
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--s3-latency", type=float, default=0.03)
+    parser.add_argument("--start-execution-latency", type=float, default=0.01)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--max-workers", type=int, nargs="+", default=[1, 10, 32])
+    args = parser.parse_args()
+
+    trigger = load_function(
+        "01_trigger_step_function",
+        {"STATE_MACHINE": "benchmark_arn", "INCREMENTAL_DEPLOYMENTS": "false"},
+    )
+
+    def get_object(**kwargs):
+        time.sleep(args.s3_latency)
+        return {"Body": CONFIG_FILE}
+
+    def start_execution(**kwargs):
+        time.sleep(args.start_execution_latency)
+        return {"executionArn": "arn:" + str(time.perf_counter())}
+
+    trigger.s3.get_object = get_object
+    trigger.step_functions.start_execution = start_execution
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        for max_workers in args.max_workers:
+            elapsed = run(trigger, batch_size, max_workers)
+            rows.append(
+                [
+                    batch_size,
+                    max_workers,
+                    "%.3f" % elapsed,
+                    "%.1f" % (batch_size / elapsed),
+                ]
+            )
+    print_table(["records", "workers", "seconds", "records/s"], rows)
+
+
+if __name__ == "__main__":
+    main()
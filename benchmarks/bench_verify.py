@@ -0,0 +1,105 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Verification of many stack instances, one invocation per instance versus a
+single batch invocation.
+
+Every stack instance is verified once the operations are over: one
+ListStackInstances call per instance, as done by the verify loops of the Map
+iterations, or a single invocation of the batch mode paging through the
+instances of each StackSet once. The table reports the API calls, the
+throttled calls and the virtual time spent in CloudFormation.
+"""
+
+import argparse
+
+from fakes import FakeCloudFormation, VirtualClock, patch_sleep
+from harness import load_function, print_table
+
+
+def verify(function, instances, mode, throttle_rate, seed):
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(
+        clock, operation_seconds=0, throttle_rate=throttle_rate, seed=seed
+    )
+    cloudformation.instances = {instance: 0.0 for instance in instances}
+    function.cloudformation = cloudformation
+    function.coordination.use(function.coordination.NullCoordinator())
+    stack_instances = [
+        {"name": name, "account_id": account_id, "region": region}
+        for name, account_id, region in instances
+    ]
+    with patch_sleep(clock):
+        if mode == "per instance":
+            ready = all(
+                function.stackset_instance_ready(
+                    stack_instance["name"],
+                    stack_instance["account_id"],
+                    stack_instance["region"],
+                )
+                for stack_instance in stack_instances
+            )
+        else:
+            ready = function.lambda_handler({"stack_instances": stack_instances}, {})[
+                "stack_instances_ready"
+            ]
+    assert ready
+    return cloudformation, clock.now
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[100, 300, 1000])
+    parser.add_argument("--stacksets", type=int, default=3)
+    parser.add_argument("--regions", type=int, default=2)
+    parser.add_argument("--throttle-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    function = load_function(
+        "03_verify_stack_instance_creation", {"AWS_REGION": "eu-west-1"}
+    )
+    regions = ["eu-west-1", "us-east-1", "eu-central-1", "us-west-2"][: args.regions]
+
+    rows = []
+    for accounts in args.accounts:
+        instances = [
+            ("stackset-" + str(stackset), str(100000000000 + account), region)
+            for stackset in range(args.stacksets)
+            for account in range(accounts)
+            for region in regions
+        ]
+        for mode in ["per instance", "batch"]:
+            cloudformation, seconds = verify(
+                function, instances, mode, args.throttle_rate, args.seed
+            )
+            rows.append(
+                [
+                    accounts,
+                    len(instances),
+                    mode,
+                    cloudformation.api_calls,
+                    cloudformation.throttled_calls,
+                    "%.1f" % seconds,
+                ]
+            )
+    print_table(
+        ["accounts", "instances", "mode", "API calls", "throttled", "seconds"], rows
+    )
+
+
+if __name__ == "__main__":
+    main()
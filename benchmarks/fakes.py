@@ -0,0 +1,388 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+In-process stand-ins for the AWS services used by the Lambda functions
+
+Time is virtual: API latency and the sleeps of the functions advance a
+VirtualClock instead of blocking, so hours of rollout run in milliseconds.
+"""
+
+import collections
+import io
+import random
+import time
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+
+class VirtualClock:
+    def __init__(self, now=0.0):
+        self.now = now
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def client_error(code, operation_name, message=None):
+    return ClientError(
+        {"Error": {"Code": code, "Message": message or code}}, operation_name
+    )
+
+
+class FakeEvents:
+    # The before-call hooks of botocore clients, used by the shared layer
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for registered_name, handler in self.handlers:
+            prefix = registered_name.split("*")[0]
+            if event_name.startswith(prefix):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakeClientMeta:
+    def __init__(self):
+        self.events = FakeEvents()
+
+
+class FakeCloudFormation:
+    """
+    Stack instances which become CURRENT a fixed time after their operation
+
+    legacy_jitter reproduces the randrange(10, 20) sleeps the functions used to
+    make before each CloudFormation call. Like CloudFormation, a StackSet runs a
+    single operation at a time and rejects the others with
+    OperationInProgressException, unless managed_execution queues them.
+    failure_rate is the probability of each stack instance of an operation to
+    fail, only for the operations with the failing_parameters ParameterOverrides
+    when they are given.
+    """
+
+    def __init__(
+        self,
+        clock,
+        operation_seconds=60.0,
+        api_latency=0.1,
+        throttle_rate=0.0,
+        legacy_jitter=False,
+        failure_rate=0.0,
+        failing_parameters=None,
+        managed_execution=False,
+        seed=0,
+    ):
+        self.clock = clock
+        self.operation_seconds = operation_seconds
+        self.api_latency = api_latency
+        self.throttle_rate = throttle_rate
+        self.legacy_jitter = legacy_jitter
+        self.failure_rate = failure_rate
+        self.failing_parameters = failing_parameters
+        self.managed_execution = managed_execution
+        self.random = random.Random(seed)
+        self.instances = {}
+        self.parameters = {}
+        self.failed_instances = set()
+        self.operations = {}
+        self.api_calls = 0
+        self.calls = collections.Counter()
+        self.throttled_calls = 0
+        self.rejected_operations = 0
+        self.queued_operations = 0
+        self.meta = FakeClientMeta()
+
+    def _call(self, operation_name):
+        self.meta.events.emit("before-call.cloudformation." + operation_name)
+        if self.legacy_jitter:
+            self.clock.sleep(self.random.randrange(10, 20))
+        self.api_calls += 1
+        self.calls[operation_name] += 1
+        self.clock.advance(self.api_latency)
+        if self.random.random() < self.throttle_rate:
+            self.throttled_calls += 1
+            raise client_error("Throttling", operation_name, "Rate exceeded")
+
+    def _summary(self, key):
+        stackset_name, account_id, region = key
+        done = self.clock.now >= self.instances[key]
+        failed = done and key in self.failed_instances
+        return {
+            "StackSetId": stackset_name + ":stackset-id",
+            "Account": account_id,
+            "Region": region,
+            "Status": "CURRENT" if done and not failed else "OUTDATED",
+            "StackInstanceStatus": {
+                "DetailedStatus": (
+                    "FAILED" if failed else "SUCCEEDED" if done else "RUNNING"
+                )
+            },
+        }
+
+    def list_stack_instances(
+        self,
+        StackSetName,
+        StackInstanceAccount=None,
+        StackInstanceRegion=None,
+        Filters=(),
+        NextToken=None,
+        MaxResults=100,
+        **kwargs
+    ):
+        self._call("ListStackInstances")
+        detailed_statuses = [
+            status_filter["Values"]
+            for status_filter in Filters
+            if status_filter["Name"] == "DETAILED_STATUS"
+        ]
+        summaries = [
+            summary
+            for summary in (
+                self._summary(key)
+                for key in sorted(self.instances)
+                if key[0] == StackSetName
+                and StackInstanceAccount in (None, key[1])
+                and StackInstanceRegion in (None, key[2])
+            )
+            if all(
+                summary["StackInstanceStatus"]["DetailedStatus"] == status
+                for status in detailed_statuses
+            )
+        ]
+        # Pages of MaxResults summaries, the token being the index of the next one
+        start = int(NextToken or 0)
+        response = {"Summaries": summaries[start : start + MaxResults]}
+        if start + MaxResults < len(summaries):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    def _operation_seconds(self):
+        # A fixed duration, or a (min, max) range drawn from for each operation
+        if isinstance(self.operation_seconds, tuple):
+            return self.random.uniform(*self.operation_seconds)
+        return self.operation_seconds
+
+    def describe_stack_instance(
+        self, StackSetName, StackInstanceAccount, StackInstanceRegion, **kwargs
+    ):
+        self._call("DescribeStackInstance")
+        key = (StackSetName, StackInstanceAccount, StackInstanceRegion)
+        if key not in self.instances:
+            raise client_error(
+                "StackInstanceNotFoundException",
+                "DescribeStackInstance",
+                "Stack instance not found",
+            )
+        return {
+            "StackInstance": dict(
+                self._summary(key), ParameterOverrides=self.parameters.get(key, [])
+            )
+        }
+
+    def _operation(
+        self, operation_name, StackSetName, Accounts, Regions, ParameterOverrides=None
+    ):
+        self._call(operation_name)
+        busy_until = max(
+            [
+                operation["DoneAt"]
+                for operation in self.operations.values()
+                if operation["StackSetName"] == StackSetName
+            ]
+            + [self.clock.now]
+        )
+        if busy_until > self.clock.now:
+            if not self.managed_execution:
+                self.rejected_operations += 1
+                raise client_error(
+                    "OperationInProgressException",
+                    operation_name,
+                    "Another Operation on StackSet " + StackSetName + " is in progress",
+                )
+            # Managed execution queues the operation behind the running ones
+            self.queued_operations += 1
+        operation_id = operation_name + "-" + str(self.api_calls)
+        done_at = busy_until + self._operation_seconds()
+        instances = [(StackSetName, a, r) for a in Accounts for r in Regions]
+        failure_rate = (
+            self.failure_rate
+            if self.failing_parameters in (None, ParameterOverrides)
+            else 0.0
+        )
+        failed = {key for key in instances if self.random.random() < failure_rate}
+        self.operations[operation_id] = {
+            "StackSetName": StackSetName,
+            "StartAt": busy_until,
+            "DoneAt": done_at,
+            "Instances": instances,
+            "Failed": failed,
+        }
+        for key in instances:
+            self.instances[key] = done_at
+            self.parameters[key] = ParameterOverrides or []
+            if key in failed:
+                self.failed_instances.add(key)
+            else:
+                self.failed_instances.discard(key)
+        return {"OperationId": operation_id}
+
+    def deploy(self, StackSetName, Accounts, Regions, ParameterOverrides=None):
+        # Stack instances deployed before the run, without an operation
+        for key in [(StackSetName, a, r) for a in Accounts for r in Regions]:
+            self.instances[key] = self.clock.now
+            self.parameters[key] = ParameterOverrides or []
+
+    def _operation_status(self, operation):
+        if self.clock.now < operation["StartAt"]:
+            return "QUEUED"
+        if self.clock.now < operation["DoneAt"]:
+            return "RUNNING"
+        return "FAILED" if operation["Failed"] else "SUCCEEDED"
+
+    def describe_stack_set_operation(self, StackSetName, OperationId, **kwargs):
+        self._call("DescribeStackSetOperation")
+        operation = self.operations[OperationId]
+        return {
+            "StackSetOperation": {
+                "OperationId": OperationId,
+                "Status": self._operation_status(operation),
+            }
+        }
+
+    def list_stack_set_operation_results(self, StackSetName, OperationId, **kwargs):
+        self._call("ListStackSetOperationResults")
+        operation = self.operations[OperationId]
+        status = self._operation_status(operation)
+        summaries = []
+        for key in operation["Instances"]:
+            summary = {"Account": key[1], "Region": key[2], "Status": "RUNNING"}
+            if status == "QUEUED":
+                summary["Status"] = "PENDING"
+            elif status in ["SUCCEEDED", "FAILED"] and key in operation["Failed"]:
+                summary["Status"] = "FAILED"
+                summary["StatusReason"] = "Injected failure"
+            elif status in ["SUCCEEDED", "FAILED"]:
+                summary["Status"] = "SUCCEEDED"
+            summaries.append(summary)
+        return {"Summaries": summaries}
+
+    def create_stack_instances(
+        self, StackSetName, Accounts, Regions, ParameterOverrides=None, **kwargs
+    ):
+        return self._operation(
+            "CreateStackInstances", StackSetName, Accounts, Regions, ParameterOverrides
+        )
+
+    def update_stack_instances(
+        self, StackSetName, Accounts, Regions, ParameterOverrides=None, **kwargs
+    ):
+        return self._operation(
+            "UpdateStackInstances", StackSetName, Accounts, Regions, ParameterOverrides
+        )
+
+    def delete_stack_instances(self, StackSetName, Accounts, Regions, **kwargs):
+        return self._operation("DeleteStackInstances", StackSetName, Accounts, Regions)
+
+
+class FakeS3:
+    """
+    Objects kept in memory, returned as streaming bodies like botocore does
+    """
+
+    class exceptions:
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self, clock, api_latency=0.05):
+        self.clock = clock
+        self.api_latency = api_latency
+        self.objects = {}
+        self.api_calls = 0
+        self.meta = FakeClientMeta()
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.api_calls += 1
+        self.clock.advance(self.api_latency)
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(
+                {"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject"
+            )
+        body = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range[len("bytes=") :].split("-")
+            body = body[int(start) : int(end) + 1]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body))}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.api_calls += 1
+        self.clock.advance(self.api_latency)
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode()
+        return {}
+
+
+class FakeStepFunctions:
+    """
+    Executions recorded as they are started, to be run by the local interpreter
+    """
+
+    def __init__(self, clock, api_latency=0.05):
+        self.clock = clock
+        self.api_latency = api_latency
+        self.executions = []
+        self.api_calls = 0
+        self.meta = FakeClientMeta()
+
+    def start_execution(self, stateMachineArn, input, **kwargs):
+        self.api_calls += 1
+        self.clock.advance(self.api_latency)
+        execution_arn = stateMachineArn + ":execution-" + str(len(self.executions))
+        self.executions.append(
+            {"executionArn": execution_arn, "input": input, "startDate": self.clock.now}
+        )
+        return {"executionArn": execution_arn}
+
+    def describe_execution(self, executionArn):
+        self.api_calls += 1
+        self.clock.advance(self.api_latency)
+        return {"executionArn": executionArn, "status": "SUCCEEDED"}
+
+
+class patch_sleep:
+    """
+    Route time.sleep to a virtual clock, for the functions and the shared layer
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __enter__(self):
+        self.sleep = time.sleep
+        time.sleep = self.clock.sleep
+        return self.clock
+
+    def __exit__(self, *exc_info):
+        time.sleep = self.sleep
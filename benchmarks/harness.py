@@ -0,0 +1,68 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import importlib
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT_DIR, "lambda")
+LAYER_DIR = os.path.join(ROOT_DIR, "layer")
+
+if LAYER_DIR not in sys.path:
+    sys.path.append(LAYER_DIR)
+
+# Keep the metrics and log lines out of the benchmark tables, unless asked for
+os.environ.setdefault("METRICS_ENABLED", "false")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+
+def load_function(function_dir, environ=None):
+    """
+    Import the main module of a Lambda function outside of pytest
+
+    Every function names its module "app", so the module is removed from
+    sys.modules once loaded, allowing several functions to be loaded side by side.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    for key, value in (environ or {}).items():
+        os.environ[key] = value
+
+    function_path = os.path.join(LAMBDA_DIR, function_dir)
+    sys.path.insert(0, function_path)
+    prev_modules = set(sys.modules.keys())
+    try:
+        module = importlib.import_module("app")
+    finally:
+        for key in set(sys.modules.keys()) - prev_modules:
+            if (
+                os.path.dirname(getattr(sys.modules[key], "__file__", None) or "")
+                == function_path
+            ):
+                del sys.modules[key]
+        sys.path.remove(function_path)
+    return module
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(value)) for value in [header] + [row[i] for row in rows])
+        for i, header in enumerate(headers)
+    ]
+    print("  ".join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
@@ -0,0 +1,260 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+End-to-end simulation of a rollout, from the upload of the configuration
+files to the end of the executions
+
+The configuration files are put in a fake S3 bucket and notified to the
+trigger function, which starts its executions on a fake Step Functions. The
+executions then run in the local interpreter of the state machine of
+template.yaml, calling the create and verify functions against a fake
+CloudFormation. Everything runs on a single virtual clock, so the makespan,
+API calls and Lambda-seconds of a rollout of hours are measured in seconds.
+
+Rollouts updating stacksets already deployed with other parameters also report
+the time to recovery of their failed operations, from the end of each one to
+the end of the rollback of its stack instances to their previous parameters.
+"""
+
+import json
+
+from fakes import FakeCloudFormation, FakeS3, FakeStepFunctions, VirtualClock
+from fakes import patch_sleep
+from harness import load_function
+from statemachine import StateMachine, load_definition
+
+BUCKET = "simulation-bucket"
+STATE_MACHINE_ARN = "arn:aws:states:eu-west-1:123456789012:stateMachine:simulation"
+REGIONS = ["eu-west-1", "us-east-1", "ap-southeast-2", "eu-central-1", "us-west-2"]
+MODES = ["files", "batched", "manifest"]
+PARAMETERS = {"Environment": "prod"}
+PREVIOUS_PARAMETERS = {"Environment": "staging"}
+
+_functions = None
+
+
+def load_functions():
+    # Load the three functions once, their modules keep no state between runs
+    # once their clients are replaced
+    global _functions
+    if _functions is None:
+        environ = {"AWS_REGION": "eu-west-1"}
+        trigger = load_function(
+            "01_trigger_step_function", {"STATE_MACHINE": STATE_MACHINE_ARN}
+        )
+        create = load_function("02_create_update_delete_stack_instances", environ)
+        verify = load_function("03_verify_stack_instance_creation", environ)
+        _functions = (trigger, create, verify)
+    return _functions
+
+
+def account_file(account_id, stacksets, regions, chained=False, rollout=False):
+    # Chained stacksets each depend on the previous one, and progressive
+    # rollouts start with the first account as canary
+    return {
+        "account": account_id,
+        "regions": REGIONS[:regions],
+        "stacksets": [
+            dict(
+                {
+                    "name": "stackset-" + str(index),
+                    "parameters": PARAMETERS,
+                },
+                **({"rollout": {"canary_accounts": ["%012d" % 0]}} if rollout else {}),
+                **(
+                    {"depends_on": ["stackset-" + str(index - 1)]}
+                    if chained and index
+                    else {}
+                )
+            )
+            for index in range(stacksets)
+        ],
+    }
+
+
+def upload_events(s3, accounts, stacksets, regions, mode, chained=False, rollout=False):
+    # Put the configuration files in the bucket, and return the S3 events notifying them
+    files = {
+        "accounts/%012d.yaml"
+        % account: account_file("%012d" % account, stacksets, regions, chained, rollout)
+        for account in range(accounts)
+    }
+    if mode == "manifest":
+        files = {"rollout.jsonl": list(files.values())}
+    for key, content in files.items():
+        body = (
+            "\n".join(json.dumps(document) for document in content)
+            if mode == "manifest"
+            else json.dumps(content)
+        )
+        s3.objects[(BUCKET, key)] = body.encode()
+    records = [
+        {"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}} for key in files
+    ]
+    if mode == "batched":
+        return [{"Records": records}]
+    return [{"Records": [record]} for record in records]
+
+
+def simulate(
+    accounts=10,
+    stacksets=3,
+    regions=1,
+    mode="files",
+    operation_seconds=(45, 300),
+    api_latency=0.1,
+    throttle_rate=0.0,
+    failure_rate=0.0,
+    managed_execution=False,
+    coordinated=False,
+    upload_interval=0.0,
+    invocation_seconds=0.05,
+    chained=False,
+    update=False,
+    rollout=False,
+    seed=0,
+):
+    """
+    Roll out stacksets to accounts, returning the usage of the rollout
+
+    mode is how the configuration files are notified: one S3 event per file,
+    a single event for all the files in batching mode, or a single manifest.
+    Chained stacksets each depend on the previous one, and are deployed in
+    as many waves. In update mode, the stack instances are already deployed
+    with other parameters, and the failures are only injected in their update.
+    Progressive rollouts deploy the batched accounts in growing waves after a
+    canary account.
+    """
+    trigger, create, verify = load_functions()
+    coordination = create.coordination
+    clock = VirtualClock()
+    cloudformation = FakeCloudFormation(
+        clock,
+        operation_seconds=operation_seconds,
+        api_latency=api_latency,
+        throttle_rate=throttle_rate,
+        failure_rate=failure_rate,
+        failing_parameters=(create.format_parameters(PARAMETERS) if update else None),
+        managed_execution=managed_execution,
+        seed=seed,
+    )
+    if update:
+        for index in range(stacksets):
+            cloudformation.deploy(
+                "stackset-" + str(index),
+                ["%012d" % account for account in range(accounts)],
+                REGIONS[:regions],
+                create.format_parameters(PREVIOUS_PARAMETERS),
+            )
+    s3 = FakeS3(clock)
+    step_functions = FakeStepFunctions(clock)
+    create.cloudformation = verify.cloudformation = cloudformation
+    trigger.s3 = trigger.payloads.s3 = s3
+    trigger.step_functions = step_functions
+    trigger.BATCH_ACCOUNTS = mode == "batched"
+    trigger.MAX_WORKERS = 1
+    trigger.PLAN_BUCKET = BUCKET
+    create.stack_instances.invalidate()
+    if coordinated:
+        coordination.use(
+            coordination.Coordinator(coordination.MemoryStore(), clock=clock.time)
+        )
+        coordination.throttle_client(cloudformation)
+    else:
+        coordination.use(coordination.NullCoordinator())
+
+    state_machine = StateMachine(
+        load_definition(),
+        {
+            "CreateUpdateDeleteStackInstances": create,
+            "VerifyStackInstanceStatus": verify,
+        },
+        clock,
+        invocation_seconds=invocation_seconds,
+        seed=seed,
+    )
+    trigger_seconds = 0.0
+    with patch_sleep(clock):
+        for index, event in enumerate(
+            upload_events(s3, accounts, stacksets, regions, mode, chained, rollout)
+        ):
+            clock.now = max(clock.now, index * upload_interval)
+            start = clock.now
+            report = trigger.lambda_handler(event, {})
+            assert not report["failures"], report["failures"][0]["error"]
+            clock.advance(invocation_seconds)
+            trigger_seconds += clock.now - start
+        state_machine.run(
+            *[
+                json.loads(execution["input"])
+                for execution in step_functions.executions
+            ],
+            start_times=[
+                execution["startDate"] for execution in step_functions.executions
+            ]
+        )
+    recoveries = recovery_seconds(cloudformation)
+    return {
+        "makespan": clock.now,
+        "executions": len(step_functions.executions),
+        "failed_executions": state_machine.usage["failed_executions"],
+        "operations": len(cloudformation.operations),
+        "rejected_operations": cloudformation.rejected_operations,
+        "queued_operations": cloudformation.queued_operations,
+        "api_calls": cloudformation.api_calls + s3.api_calls + step_functions.api_calls,
+        "cloudformation_calls": dict(cloudformation.calls),
+        "lambda_seconds": state_machine.usage["lambda_seconds"] + trigger_seconds,
+        "invocations": state_machine.usage["invocations"]
+        + report_count(mode, accounts),
+        "transitions": state_machine.usage["transitions"],
+        "failed_operations": len(recoveries),
+        "unrecovered_operations": recoveries.count(None),
+        "recovery_seconds": max(
+            [seconds for seconds in recoveries if seconds is not None], default=None
+        ),
+    }
+
+
+def recovery_seconds(cloudformation):
+    # Time from the end of each failed operation until all its stack instances
+    # were deployed again by a later operation, None if some never were
+    operations = sorted(
+        cloudformation.operations.values(), key=lambda operation: operation["DoneAt"]
+    )
+    recoveries = []
+    for index, operation in enumerate(operations):
+        if not operation["Failed"]:
+            continue
+        recovered_at = [
+            min(
+                [
+                    later["DoneAt"]
+                    for later in operations[index + 1 :]
+                    if key in later["Instances"] and key not in later["Failed"]
+                ],
+                default=None,
+            )
+            for key in operation["Instances"]
+        ]
+        recoveries.append(
+            None if None in recovered_at else max(recovered_at) - operation["DoneAt"]
+        )
+    return recoveries
+
+
+def report_count(mode, accounts):
+    # Invocations of the trigger function, one per S3 event
+    return accounts if mode == "files" else 1
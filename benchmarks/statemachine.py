@@ -0,0 +1,380 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local interpreter of the state machine defined in template.yaml
+
+Executions run on a VirtualClock: Wait states and retry intervals advance the
+clock instead of blocking, and Task states call the handler of the Lambda
+function module registered under the logical id of their resource. Parallel
+branches (Map iterations, concurrent executions) are generators yielding the
+virtual time at which they resume, so they interleave in time order.
+
+Only the subset of the Amazon States Language used by the template is
+supported.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+
+import yaml
+
+from harness import ROOT_DIR
+
+TEMPLATE = os.path.join(ROOT_DIR, "template.yaml")
+
+
+class StatesError(Exception):
+    def __init__(self, error, cause=""):
+        super().__init__(error + ": " + cause)
+        self.error = error
+        self.cause = cause
+
+
+class TemplateLoader(yaml.SafeLoader):
+    pass
+
+
+def construct_intrinsic_function(loader, tag_suffix, node):
+    name = "Ref" if tag_suffix == "Ref" else "Fn::" + tag_suffix
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {name: value}
+
+
+TemplateLoader.add_multi_constructor("!", construct_intrinsic_function)
+
+
+def load_definition(template=TEMPLATE, logical_id="StackSetOrchestrationStateMachine"):
+    with open(template) as template_file:
+        resources = yaml.load(template_file, Loader=TemplateLoader)["Resources"]
+    return resources[logical_id]["Properties"]["Definition"]
+
+
+def find_state(definition, name):
+    # Find a state by name, looking into the iterators of Map states
+    for state_name, state in definition["States"].items():
+        if state_name == name:
+            return state
+        iterator = state.get("ItemProcessor", state.get("Iterator"))
+        if iterator:
+            found = find_state(iterator, name)
+            if found is not None:
+                return found
+    return None
+
+
+def resource_name(resource):
+    # Logical id of the function of a Task resource, such as !GetAtt Function.Arn
+    if isinstance(resource, dict) and "Fn::GetAtt" in resource:
+        attribute = resource["Fn::GetAtt"]
+        return attribute[0] if isinstance(attribute, list) else attribute.split(".")[0]
+    return resource
+
+
+PATH_TOKEN = re.compile(r"\.([^.\[]+)|\[(\d+)\]")
+
+
+def parse_path(path):
+    if not path.startswith("$"):
+        raise ValueError("Invalid path " + path)
+    return [
+        name if name else int(index) for name, index in PATH_TOKEN.findall(path[1:])
+    ]
+
+
+def get_path(data, path):
+    for token in parse_path(path):
+        data = data[token]
+    return data
+
+
+def path_exists(data, path):
+    try:
+        get_path(data, path)
+    except (KeyError, IndexError, TypeError):
+        return False
+    return True
+
+
+def set_path(data, path, value):
+    # A null path discards the value and keeps the input
+    if path is None:
+        return data
+    tokens = parse_path(path)
+    if not tokens:
+        return value
+    data = json.loads(json.dumps(data))
+    parent = data
+    for token in tokens[:-1]:
+        parent = parent.setdefault(token, {})
+    parent[tokens[-1]] = value
+    return data
+
+
+def evaluate_parameters(template, data, context):
+    # Resolve the "key.$" entries of Parameters and ItemSelector fields
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith(".$"):
+                if value.startswith("$$"):
+                    result[key[:-2]] = get_path(context, value[1:])
+                else:
+                    result[key[:-2]] = get_path(data, value)
+            else:
+                result[key] = evaluate_parameters(value, data, context)
+        return result
+    if isinstance(template, list):
+        return [evaluate_parameters(value, data, context) for value in template]
+    return template
+
+
+def evaluate_choice(rule, data):
+    if "And" in rule:
+        return all(evaluate_choice(r, data) for r in rule["And"])
+    if "Or" in rule:
+        return any(evaluate_choice(r, data) for r in rule["Or"])
+    if "Not" in rule:
+        return not evaluate_choice(rule["Not"], data)
+    variable = rule["Variable"]
+    if "IsPresent" in rule:
+        return path_exists(data, variable) == rule["IsPresent"]
+    if not path_exists(data, variable):
+        raise StatesError("States.Runtime", "Invalid path " + variable)
+    value = get_path(data, variable)
+    for operator, compare in [
+        ("BooleanEquals", lambda a, b: a is b),
+        ("StringEquals", lambda a, b: a == b),
+        ("NumericEquals", lambda a, b: a == b),
+        ("NumericGreaterThan", lambda a, b: a > b),
+        ("NumericLessThan", lambda a, b: a < b),
+    ]:
+        if operator in rule:
+            return compare(value, rule[operator])
+    raise NotImplementedError("Unsupported choice rule " + json.dumps(rule))
+
+
+def matches(rules, error):
+    for index, rule in enumerate(rules):
+        if error in rule["ErrorEquals"] or "States.ALL" in rule["ErrorEquals"]:
+            return index, rule
+    return None, None
+
+
+def interleave(branches, max_concurrency=0):
+    """
+    Run generators concurrently in virtual time
+
+    branches yields (key, generator) pairs, started lazily so that no more than
+    max_concurrency generators run at once (0 for no limit). Returns the values
+    returned by the generators, by key.
+    """
+    results = {}
+    running = []
+    sequence = itertools.count()
+
+    def step(key, branch):
+        try:
+            resume_at = next(branch)
+        except StopIteration as stop:
+            results[key] = stop.value
+        else:
+            heapq.heappush(running, (resume_at, next(sequence), key, branch))
+
+    branches = iter(branches)
+    while True:
+        while not max_concurrency or len(running) < max_concurrency:
+            pending = next(branches, None)
+            if pending is None:
+                break
+            step(*pending)
+        if not running:
+            return results
+        resume_at, _, key, branch = heapq.heappop(running)
+        yield resume_at
+        step(key, branch)
+
+
+class StateMachine:
+    def __init__(self, definition, functions, clock, invocation_seconds=0.05, seed=0):
+        self.definition = definition
+        self.functions = functions
+        self.clock = clock
+        self.invocation_seconds = invocation_seconds
+        self.random = random.Random(seed)
+        self.usage = {
+            "lambda_seconds": 0.0,
+            "invocations": 0,
+            "transitions": 0,
+            "retries": 0,
+            "failed_executions": 0,
+        }
+
+    def run(self, *inputs, start_times=None):
+        # Run executions concurrently until they all end, returning their outputs
+        start_times = start_times or [self.clock.now] * len(inputs)
+        executions = interleave(
+            (index, self.execute(data, start_times[index]))
+            for index, data in enumerate(inputs)
+        )
+        try:
+            while True:
+                self.clock.now = next(executions)
+        except StopIteration as stop:
+            outputs = stop.value
+        return [outputs[index] for index in range(len(inputs))]
+
+    def execute(self, data, start_time=None):
+        # A failed execution ends with its error as output, like Step Functions
+        # reports it, without stopping the other executions
+        if start_time is not None and start_time > self.clock.now:
+            yield start_time
+        try:
+            return (yield from self._run_states(self.definition, data))
+        except StatesError as error:
+            self.usage["failed_executions"] += 1
+            return {"Error": error.error, "Cause": error.cause}
+
+    def _run_states(self, definition, data):
+        name = definition["StartAt"]
+        while name is not None:
+            state = definition["States"][name]
+            self.usage["transitions"] += 1
+            run_state = getattr(self, "_run_" + state["Type"].lower())
+            data, name = yield from run_state(state, data)
+        return data
+
+    def _next(self, state):
+        return None if state.get("End") else state["Next"]
+
+    def _run_task(self, state, data):
+        function = self.functions[resource_name(state["Resource"])]
+        attempts = {}
+        while True:
+            start = self.clock.now
+            self.usage["invocations"] += 1
+            try:
+                result = function.lambda_handler(json.loads(json.dumps(data)), {})
+                error = None
+            except Exception as e:
+                error = e
+            self.clock.advance(self.invocation_seconds)
+            self.usage["lambda_seconds"] += self.clock.now - start
+            yield self.clock.now
+
+            if error is None:
+                result = json.loads(json.dumps(result))
+                return set_path(data, state.get("ResultPath", "$"), result), self._next(
+                    state
+                )
+            error_name = type(error).__name__
+            index, retrier = matches(state.get("Retry", []), error_name)
+            if retrier and attempts.get(index, 0) < retrier.get("MaxAttempts", 3):
+                interval = retrier.get("IntervalSeconds", 1) * retrier.get(
+                    "BackoffRate", 2
+                ) ** attempts.get(index, 0)
+                interval = min(interval, retrier.get("MaxDelaySeconds", interval))
+                if retrier.get("JitterStrategy") == "FULL":
+                    interval = self.random.uniform(0, interval)
+                attempts[index] = attempts.get(index, 0) + 1
+                self.usage["retries"] += 1
+                yield self.clock.now + interval
+                continue
+            index, catcher = matches(state.get("Catch", []), error_name)
+            if catcher:
+                error_output = {"Error": error_name, "Cause": str(error)}
+                return (
+                    set_path(data, catcher.get("ResultPath", "$"), error_output),
+                    catcher["Next"],
+                )
+            raise StatesError(error_name, str(error))
+
+    def _run_wait(self, state, data):
+        seconds = (
+            state["Seconds"]
+            if "Seconds" in state
+            else get_path(data, state["SecondsPath"])
+        )
+        yield self.clock.now + seconds
+        return data, self._next(state)
+
+    def _run_choice(self, state, data):
+        for rule in state["Choices"]:
+            if evaluate_choice(rule, data):
+                return data, rule["Next"]
+        if "Default" not in state:
+            raise StatesError("States.NoChoiceMatched")
+        return data, state["Default"]
+        yield
+
+    def _run_pass(self, state, data):
+        if "Parameters" in state:
+            data = set_path(
+                data,
+                state.get("ResultPath", "$"),
+                evaluate_parameters(state["Parameters"], data, {}),
+            )
+        elif "Result" in state:
+            data = set_path(data, state.get("ResultPath", "$"), state["Result"])
+        return data, self._next(state)
+        yield
+
+    def _run_succeed(self, state, data):
+        return data, None
+        yield
+
+    def _run_fail(self, state, data):
+        error = (
+            get_path(data, state["ErrorPath"])
+            if "ErrorPath" in state
+            else state.get("Error", "States.Fail")
+        )
+        cause = (
+            get_path(data, state["CausePath"])
+            if "CausePath" in state
+            else state.get("Cause", "")
+        )
+        raise StatesError(error, cause)
+        yield
+
+    def _run_map(self, state, data):
+        items = get_path(data, state.get("ItemsPath", "$"))
+        max_concurrency = (
+            get_path(data, state["MaxConcurrencyPath"])
+            if "MaxConcurrencyPath" in state
+            else state.get("MaxConcurrency", 0)
+        )
+        iterator = state.get("ItemProcessor", state.get("Iterator"))
+        selector = state.get("ItemSelector", state.get("Parameters"))
+
+        def branches():
+            for index, item in enumerate(items):
+                context = {"Map": {"Item": {"Index": index, "Value": item}}}
+                if selector is not None:
+                    item = evaluate_parameters(selector, data, context)
+                yield index, self._run_states(iterator, item)
+
+        results = yield from interleave(branches(), max_concurrency)
+        results = [results[index] for index in range(len(items))]
+        return set_path(data, state.get("ResultPath", "$"), results), self._next(state)
@@ -13,67 +13,574 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import hashlib
+import heapq
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
+import uuid
 
-import boto3
+from botocore.exceptions import ConnectionError, HTTPClientError
 import yaml
+from stackset_orchestration import (
+    clients,
+    dependencies,
+    logs,
+    metrics,
+    payloads,
+    retry,
+    schema,
+)
 
-s3 = boto3.client("s3")
-step_functions = boto3.client("stepfunctions")
+s3 = clients.lazy_client("s3")
+step_functions = clients.lazy_client("stepfunctions")
+
+# The libyaml bindings parse several times faster than the pure-Python loader
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 STATE_MACHINE_ARN = os.getenv("STATE_MACHINE")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "10"))
+BATCH_ACCOUNTS = os.getenv("BATCH_ACCOUNTS", "false").lower() == "true"
+# Maximum number of StackSets deployed at once, 0 for no limit
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "0"))
+# Maximum number of operations running at once on the same StackSet
+STACKSET_CONCURRENCY = int(os.getenv("STACKSET_CONCURRENCY", "1"))
+CONCURRENCY_SETTINGS = ["max_concurrency", "stackset_concurrency"]
+# Only deploy the stacksets which changed since the last execution of a file
+INCREMENTAL_DEPLOYMENTS = os.getenv("INCREMENTAL_DEPLOYMENTS", "true").lower() == "true"
+# Prefix of the objects recording the stacksets requested by the last execution of each file
+APPLIED_STATE_PREFIX = os.getenv("APPLIED_STATE_PREFIX", ".applied/")
+# Bucket the plans of large executions are offloaded to, none to never offload them
+PLAN_BUCKET = os.getenv("PLAN_BUCKET", "")
+PLAN_PREFIX = os.getenv("PLAN_PREFIX", ".plans/")
+# Size of the execution input above which its plan is offloaded, 0 to always offload it
+PLAN_OFFLOAD_THRESHOLD = int(os.getenv("PLAN_OFFLOAD_THRESHOLD", str(128 * 1024)))
+# Objects describing many accounts, one configuration document per YAML document or JSON line
+MANIFEST_SUFFIXES = tuple(
+    os.getenv("MANIFEST_SUFFIXES", ".manifest.yaml,.manifest.yml,.jsonl").split(",")
+)
+# Maximum number of executions started for a manifest
+MANIFEST_MAX_EXECUTIONS = int(os.getenv("MANIFEST_MAX_EXECUTIONS", "10"))
+# Maximum number of accounts deployed by a single StackSet operation of a manifest
+MANIFEST_BATCH_SIZE = int(os.getenv("MANIFEST_BATCH_SIZE", "100"))
+
+
+class TransientFailureException(Exception):
+    pass
 
 
-def get_config_file(event):
-    # Get event parameters
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    key = urllib.parse.unquote_plus(
-        event["Records"][0]["s3"]["object"]["key"], encoding="utf-8"
+def transient_error(error):
+    # Throttling, server errors and network errors may succeed when the event is retried
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    response = getattr(error, "response", None) or {}
+    return (
+        retry.error_code(error) in retry.RETRYABLE_ERROR_CODES
+        or response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
     )
 
+
+def failed(record, error, **fields):
+    return dict(record, error=repr(error), retryable=transient_error(error), **fields)
+
+
+def get_records(event):
+    # Get event parameters of every record, S3 batches several objects per notification
+    records = []
+    for record in event["Records"]:
+        key = urllib.parse.unquote_plus(record["s3"]["object"]["key"], encoding="utf-8")
+        # Applied states and plans are written to the configuration bucket by the function itself
+        if key.startswith((APPLIED_STATE_PREFIX, PLAN_PREFIX)):
+            continue
+        records.append({"bucket": record["s3"]["bucket"]["name"], "key": key})
+    return records
+
+
+def get_config_file(bucket, key):
     # Get object config file
     try:
         config_file = s3.get_object(Bucket=bucket, Key=key)
     except Exception as e:
-        print(e)
+        logs.error(
+            "Failed to get the configuration file",
+            bucket=bucket,
+            key=key,
+            error=repr(e),
+        )
         raise e
     return config_file
 
 
 def parse(config_file):
-    # Parse yaml file
-    try:
-        parsed_config_file = yaml.safe_load(config_file["Body"])
-    except yaml.YAMLError as exc:
-        return exc
-    return parsed_config_file
+    # Parse yaml file, and validate it into its normalized form
+    return schema.normalize(yaml.load(config_file["Body"], Loader=YAML_LOADER))
 
 
 def add_account_information(config_file):
     for stackset in config_file["stacksets"]:
-        stackset["account"] = config_file["account"]
+        # Stacksets targeting organizational units are not deployed to the account of the file
+        if "deployment_targets" not in stackset:
+            stackset["account"] = config_file["account"]
+        # Regions listed at the top level of the file apply to every stackset without regions
+        if "regions" in config_file and "regions" not in stackset:
+            stackset["regions"] = config_file["regions"]
         if "terminate" in config_file and config_file["terminate"]:
             stackset["terminate"] = config_file["terminate"]
     return config_file
 
 
+def applied_state_key(key):
+    return APPLIED_STATE_PREFIX + key + ".json"
+
+
+def stackset_digest(stackset):
+    return hashlib.sha256(json.dumps(stackset, sort_keys=True).encode()).hexdigest()
+
+
+def get_applied_state(bucket, key):
+    # Get the stacksets requested by the last execution of the file, and whether
+    # this execution succeeded
+    try:
+        applied_state_object = s3.get_object(Bucket=bucket, Key=applied_state_key(key))
+    except s3.exceptions.NoSuchKey:
+        return None
+    applied_state = json.loads(applied_state_object["Body"].read())
+    try:
+        execution = step_functions.describe_execution(
+            executionArn=applied_state["execution_arn"]
+        )
+    except step_functions.exceptions.ExecutionDoesNotExist:
+        # Step Functions forgets executions 90 days after they end, their
+        # stacksets are then deployed again
+        applied_state["succeeded"] = False
+        return applied_state
+    applied_state["succeeded"] = execution["status"] == "SUCCEEDED"
+    return applied_state
+
+
+def save_applied_state(bucket, key, config_file, execution_arn):
+    applied_state = {
+        "execution_arn": execution_arn,
+        "stacksets": {
+            stackset["name"]: {
+                "digest": stackset_digest(stackset),
+                "stackset": stackset,
+            }
+            for stackset in config_file["stacksets"]
+        },
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=applied_state_key(key),
+        Body=json.dumps(applied_state).encode(),
+        ContentType="application/json",
+    )
+
+
+def diff_stacksets(applied_state, config_file):
+    # Compare the stacksets of the file with the ones last applied, by name
+    applied_stacksets = applied_state["stacksets"] if applied_state else {}
+    stacksets = {stackset["name"]: stackset for stackset in config_file["stacksets"]}
+    diff = {"added": [], "changed": [], "removed": [], "unchanged": []}
+    for name, stackset in stacksets.items():
+        if name not in applied_stacksets:
+            diff["added"].append(stackset)
+        elif (
+            not applied_state["succeeded"]
+            or stackset_digest(stackset) != applied_stacksets[name]["digest"]
+        ):
+            # Stacksets of a failed execution are not known to be applied
+            diff["changed"].append(stackset)
+        else:
+            diff["unchanged"].append(stackset)
+    for name, applied_stackset in applied_stacksets.items():
+        if name in stacksets:
+            continue
+        # Stacksets terminated by a successful execution are already gone
+        if applied_state["succeeded"] and applied_stackset["stackset"].get("terminate"):
+            continue
+        diff["removed"].append(applied_stackset["stackset"])
+    return diff
+
+
+def terminated_stacksets(diff):
+    return [dict(stackset, terminate=True) for stackset in diff["removed"]]
+
+
+def delta_config_file(config_file, diff):
+    # Deploy the added and changed stacksets, and terminate the removed ones
+    delta = dict(config_file)
+    delta["stacksets"] = diff["added"] + diff["changed"] + terminated_stacksets(diff)
+    return delta
+
+
+def add_stacksets(groups, config_file):
+    # Add the stacksets of a configuration file to the groups sharing their name and parameters
+    for stackset in config_file["stacksets"]:
+        group = {key: value for key, value in stackset.items() if key != "account"}
+        group_key = json.dumps(group, sort_keys=True)
+        # A stackset targeting organizational units already covers all their accounts
+        if "deployment_targets" in stackset:
+            groups.setdefault(group_key, stackset)
+            continue
+        # Accounts are kept as the keys of a dict, to deduplicate them in order
+        group = groups.setdefault(group_key, dict(group, accounts={}))
+        group["accounts"][str(stackset["account"])] = None
+
+
+def group_stacksets(config_files):
+    # Group the stacksets sharing the same name and parameters across accounts,
+    # so that each group is deployed with a single StackSet operation
+    groups = {}
+    settings = {}
+    for config_file in config_files:
+        add_stacksets(groups, config_file)
+        # Keep the most conservative concurrency settings of the configuration files
+        for setting in CONCURRENCY_SETTINGS:
+            if config_file.get(setting):
+                settings[setting] = min(
+                    settings.get(setting, config_file[setting]), config_file[setting]
+                )
+    for group in groups.values():
+        if "accounts" in group:
+            group["accounts"] = list(group["accounts"])
+    return dict({"stacksets": list(groups.values())}, **settings)
+
+
+def order_stacksets(config_file):
+    # Group the stacksets by StackSet, so that the operations on a StackSet run
+    # at most stackset_concurrency at a time while different StackSets run in parallel,
+    # and sort the groups in waves run after the waves of the StackSets they depend on
+    stackset_concurrency = config_file.pop("stackset_concurrency", STACKSET_CONCURRENCY)
+    max_concurrency = config_file.pop("max_concurrency", MAX_CONCURRENCY)
+    stacksets = config_file.pop("stacksets")
+    stackset_groups = {}
+    for stackset in stacksets:
+        stackset_groups.setdefault(stackset["name"], []).append(
+            {key: value for key, value in stackset.items() if key != "depends_on"}
+        )
+    config_file["waves"] = [
+        {
+            "max_concurrency": max_concurrency,
+            "stackset_groups": [
+                {
+                    "name": name,
+                    "max_concurrency": stackset_concurrency,
+                    "stacksets": stackset_groups[name],
+                }
+                for name in wave
+            ],
+        }
+        for wave in dependencies.waves(stacksets)
+    ]
+    return config_file
+
+
+def offload_plan(config_file):
+    # Keep the execution input under the payload limit of Step Functions, by
+    # passing each iteration a reference to its stackset instead of the stackset
+    if not PLAN_BUCKET:
+        return config_file
+    size = len(json.dumps(config_file).encode())
+    if PLAN_OFFLOAD_THRESHOLD and size <= PLAN_OFFLOAD_THRESHOLD:
+        return config_file
+    # A single object holds the stacksets of every wave
+    offloaded_groups = iter(
+        payloads.offload(
+            [
+                group
+                for wave in config_file["waves"]
+                for group in wave["stackset_groups"]
+            ],
+            PLAN_BUCKET,
+            PLAN_PREFIX + uuid.uuid4().hex + ".jsonl",
+        )
+    )
+    return dict(
+        config_file,
+        waves=[
+            dict(
+                wave,
+                stackset_groups=[
+                    next(offloaded_groups) for _ in wave["stackset_groups"]
+                ],
+            )
+            for wave in config_file["waves"]
+        ],
+    )
+
+
 def trigger_step_function(config_file):
     # Start step function
-    print(
-        "Trigerring Step functions with these values: "
-        + json.dumps(config_file, indent=2)
+    config_file = offload_plan(config_file)
+    execution_input = json.dumps(config_file)
+    logs.info(
+        "Triggering the step function",
+        waves=len(config_file["waves"]),
+        stackset_groups=sum(
+            len(wave["stackset_groups"]) for wave in config_file["waves"]
+        ),
+        input_bytes=len(execution_input),
     )
+    logs.debug("Step function input", input=config_file)
     response = step_functions.start_execution(
-        stateMachineArn=STATE_MACHINE_ARN, input=json.dumps(config_file)
+        stateMachineArn=STATE_MACHINE_ARN, input=execution_input
     )
     return response
 
 
+def is_manifest(key):
+    return key.endswith(MANIFEST_SUFFIXES)
+
+
+def parse_manifest(key, config_file):
+    # Yield the configuration documents of a manifest one at a time, so that
+    # the object is read as a stream instead of being loaded at once
+    body = config_file["Body"]
+    if key.endswith(".jsonl"):
+        for line in body.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for document in yaml.load_all(body, Loader=YAML_LOADER):
+            if document is not None:
+                yield document
+
+
+def load_documents(record):
+    # Load and validate the configuration documents of a manifest
+    config_file = get_config_file(record["bucket"], record["key"])
+    for index, document in enumerate(parse_manifest(record["key"], config_file)):
+        try:
+            document = add_account_information(schema.normalize(document))
+        except Exception as e:
+            raise ValueError("Document " + str(index + 1) + ": " + str(e)) from e
+        yield document
+
+
+def batch_accounts(stacksets, batch_size):
+    # Split the accounts of each group into batches deployed by separate StackSet
+    # operations, unless a progressive rollout splits them into its waves, which
+    # are then no larger than the batches
+    batches = []
+    for stackset in stacksets:
+        accounts = stackset.get("accounts")
+        if not accounts or len(accounts) <= batch_size:
+            batches.append(stackset)
+            continue
+        if "rollout" in stackset:
+            rollout = stackset["rollout"]
+            batches.append(
+                dict(
+                    stackset,
+                    rollout=dict(
+                        rollout,
+                        max_wave=min(rollout.get("max_wave", batch_size), batch_size),
+                    ),
+                )
+            )
+            continue
+        for start in range(0, len(accounts), batch_size):
+            batches.append(
+                dict(stackset, accounts=accounts[start : start + batch_size])
+            )
+    return batches
+
+
+def plan_executions(stacksets, max_executions):
+    # Spread the StackSets over at most max_executions executions, keeping all
+    # the batches of a StackSet in the same execution so that they do not collide,
+    # along with the StackSets it depends on so that they are deployed in order
+    components = dependencies.components(stacksets)
+    batches = {}
+    for stackset in stacksets:
+        batches.setdefault(components[stackset["name"]], []).append(stackset)
+    executions = [[] for _ in range(max(1, min(max_executions, len(batches))))]
+    # Largest StackSets first, each to the execution with the fewest batches
+    loads = [(0, index) for index in range(len(executions))]
+    for component in sorted(batches, key=lambda component: -len(batches[component])):
+        load, index = heapq.heappop(loads)
+        executions[index].extend(batches[component])
+        heapq.heappush(loads, (load + len(batches[component]), index))
+    return [execution for execution in executions if execution]
+
+
+def process_manifest(record):
+    # Start a bounded number of executions for all the accounts of a manifest
+    try:
+        config_file = group_stacksets(load_documents(record))
+    except Exception as e:
+        return [failed(record, e)]
+    stacksets = batch_accounts(config_file.pop("stacksets"), MANIFEST_BATCH_SIZE)
+    results = []
+    for execution_stacksets in plan_executions(stacksets, MANIFEST_MAX_EXECUTIONS):
+        names = list(
+            dict.fromkeys(stackset["name"] for stackset in execution_stacksets)
+        )
+        try:
+            response = trigger_step_function(
+                order_stacksets(dict(config_file, stacksets=execution_stacksets))
+            )
+        except Exception as e:
+            results.append(failed(record, e, stacksets=names))
+            continue
+        results.append(
+            dict(record, stacksets=names, executionArn=response["executionArn"])
+        )
+    if not results:
+        return [dict(record, unchanged=True)]
+    return results
+
+
+def load_record(record):
+    # Load and parse a configuration file, failures are reported per record
+    try:
+        config_file = get_config_file(record["bucket"], record["key"])
+        config_file = parse(config_file)
+        config_file = add_account_information(config_file)
+        # The configuration file is consumed when the execution input is built
+        applied_config_file = dict(config_file)
+        if INCREMENTAL_DEPLOYMENTS and not config_file.get("terminate"):
+            diff = diff_stacksets(
+                get_applied_state(record["bucket"], record["key"]), config_file
+            )
+            logs.info(
+                "Stacksets changed since the applied state",
+                bucket=record["bucket"],
+                key=record["key"],
+                **{change: len(diff[change]) for change in diff}
+            )
+            config_file = delta_config_file(config_file, diff)
+            # Removed stacksets stay in the applied state until an execution
+            # terminating them succeeds, to be terminated again otherwise
+            applied_config_file["stacksets"] = applied_config_file[
+                "stacksets"
+            ] + terminated_stacksets(diff)
+    except Exception as e:
+        return failed(record, e)
+    return dict(
+        record, config_file=config_file, applied_config_file=applied_config_file
+    )
+
+
+def record_execution(record, execution_arn):
+    # Keep the stacksets requested by the execution, to compare the next version
+    # of the file with. Terminated stacksets are kept with their terminate flag,
+    # so that uploading the file without it deploys them again
+    applied_config_file = record.pop("applied_config_file")
+    if INCREMENTAL_DEPLOYMENTS:
+        try:
+            save_applied_state(
+                record["bucket"], record["key"], applied_config_file, execution_arn
+            )
+        except Exception as e:
+            logs.warning(
+                "Failed to save the applied state",
+                bucket=record["bucket"],
+                key=record["key"],
+                error=repr(e),
+            )
+    return dict(record, executionArn=execution_arn)
+
+
+def unchanged_record(record):
+    record.pop("applied_config_file")
+    return dict(record, unchanged=True)
+
+
+def process_record(record):
+    # Start one execution per configuration file
+    record = load_record(record)
+    if "error" in record:
+        return record
+    config_file = record.pop("config_file")
+    if not config_file["stacksets"]:
+        return unchanged_record(record)
+    try:
+        response = trigger_step_function(order_stacksets(config_file))
+    except Exception as e:
+        record.pop("applied_config_file")
+        return failed(record, e)
+    return record_execution(record, response["executionArn"])
+
+
+def process_records(records, executor):
+    # Start a single execution for every configuration file of the event
+    records = list(executor.map(load_record, records))
+    loaded_records = [record for record in records if "error" not in record]
+    config_files = [record.pop("config_file") for record in loaded_records]
+    if not any(config_file["stacksets"] for config_file in config_files):
+        return [
+            record if "error" in record else unchanged_record(record)
+            for record in records
+        ]
+    # Groups are split into batches like the ones of manifests, as the stack
+    # instances of each StackSet operation are checked by a single invocation
+    config_file = group_stacksets(config_files)
+    config_file["stacksets"] = batch_accounts(
+        config_file["stacksets"], MANIFEST_BATCH_SIZE
+    )
+    try:
+        response = trigger_step_function(order_stacksets(config_file))
+    except Exception as e:
+        for record in loaded_records:
+            record.pop("applied_config_file")
+        return [
+            record if "error" in record else failed(record, e) for record in records
+        ]
+    return [
+        (
+            record
+            if "error" in record
+            else record_execution(record, response["executionArn"])
+        )
+        for record in records
+    ]
+
+
 def lambda_handler(event, context):
-    config_file = get_config_file(event)
-    config_file = parse(config_file)
-    config_file = add_account_information(config_file)
-    response = trigger_step_function(config_file)
-    return response["executionArn"]
+    records = get_records(event)
+    max_workers = max(1, min(MAX_WORKERS, len(records)))
+    # Manifests are processed on their own, whatever the batching mode
+    manifests = [record for record in records if is_manifest(record["key"])]
+    records = [record for record in records if not is_manifest(record["key"])]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if BATCH_ACCOUNTS:
+            results = process_records(records, executor)
+        else:
+            results = list(executor.map(process_record, records))
+        for manifest_results in executor.map(process_manifest, manifests):
+            results.extend(manifest_results)
+
+    report = {
+        "executions": [result for result in results if "executionArn" in result],
+        "unchanged": [result for result in results if "unchanged" in result],
+        "failures": [result for result in results if "error" in result],
+    }
+    metrics.emit(
+        {
+            "ExecutionsStarted": (len(report["executions"]), "Count"),
+            "FilesUnchanged": (len(report["unchanged"]), "Count"),
+            "FilesFailed": (len(report["failures"]), "Count"),
+        }
+    )
+    for failure in report["failures"]:
+        logs.error(
+            "Failed to process the configuration file",
+            bucket=failure["bucket"],
+            key=failure["key"],
+            error=failure["error"],
+            retryable=failure["retryable"],
+        )
+    # Let S3 retry the event when a file may succeed on another attempt, the
+    # files already started being unchanged by then, or deployed again as no-ops
+    retryable_failures = [
+        failure for failure in report["failures"] if failure["retryable"]
+    ]
+    if retryable_failures:
+        raise TransientFailureException(
+            str(len(retryable_failures))
+            + " configuration files failed with transient errors"
+        )
+    return report
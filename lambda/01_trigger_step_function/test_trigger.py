@@ -1,7 +1,11 @@
+import copy
 from datetime import datetime
+import io
 import json
 import os
+import uuid
 
+from botocore.response import StreamingBody
 from botocore.stub import Stubber
 import pytest
 
@@ -18,6 +22,7 @@ lambda_module = pytest.fixture(
             "module_name": "app",
             "environ": {
                 "STATE_MACHINE": "step_function_test_arn",
+                "INCREMENTAL_DEPLOYMENTS": "false",
             },
         }
     ],
@@ -38,14 +43,25 @@ def test_trigger_step_function(lambda_module):
     s3_response = {"Body": s3_object_mock_content}
     step_functions_expected_input = {
         "account": "123456789876",
-        "stacksets": [
+        "waves": [
             {
-                "name": "vpc",
-                "parameters": {
-                    "CidrBlock": "10.0.0.0/24",
-                    "EnableDnsHostnames": "true",
-                },
-                "account": "123456789876",
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 1,
+                        "stacksets": [
+                            {
+                                "name": "vpc",
+                                "parameters": {
+                                    "CidrBlock": "10.0.0.0/24",
+                                    "EnableDnsHostnames": "true",
+                                },
+                                "account": "123456789876",
+                            }
+                        ],
+                    }
+                ],
             }
         ],
     }
@@ -72,7 +88,17 @@ def test_trigger_step_function(lambda_module):
     s3.deactivate()
     step_functions.deactivate()
     # Then
-    assert response == "execution_arn"
+    assert response == {
+        "executions": [
+            {
+                "bucket": "test-bucket",
+                "key": "test-key",
+                "executionArn": "execution_arn",
+            }
+        ],
+        "unchanged": [],
+        "failures": [],
+    }
 
 
 def test_trigger_step_function_terminate(lambda_module):
@@ -89,15 +115,26 @@ def test_trigger_step_function_terminate(lambda_module):
     step_functions_expected_input = {
         "account": "123456789876",
         "terminate": True,
-        "stacksets": [
+        "waves": [
             {
-                "name": "vpc",
-                "parameters": {
-                    "CidrBlock": "10.0.0.0/24",
-                    "EnableDnsHostnames": "true",
-                },
-                "account": "123456789876",
-                "terminate": True,
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 1,
+                        "stacksets": [
+                            {
+                                "name": "vpc",
+                                "parameters": {
+                                    "CidrBlock": "10.0.0.0/24",
+                                    "EnableDnsHostnames": "true",
+                                },
+                                "account": "123456789876",
+                                "terminate": True,
+                            }
+                        ],
+                    }
+                ],
             }
         ],
     }
@@ -125,4 +162,1011 @@ def test_trigger_step_function_terminate(lambda_module):
     s3.deactivate()
     step_functions.deactivate()
     # Then
-    assert response == "execution_arn"
+    assert response == {
+        "executions": [
+            {
+                "bucket": "test-bucket",
+                "key": "test-key",
+                "executionArn": "execution_arn",
+            }
+        ],
+        "unchanged": [],
+        "failures": [],
+    }
+
+
+def test_trigger_step_function_many_records(lambda_module, monkeypatch):
+    """
+    Given several account configuration objects are notified in the same s3 event
+    When the handler is called
+    Then a step function is triggered for every object, and failing objects are reported without stopping the others
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "MAX_WORKERS", 1)
+    s3_object_mock_content = open(
+        os.path.join(__location__, "test_files/sample_account.yaml"), "r"
+    ).read()
+    event = copy.deepcopy(test_event)
+    for key in ["test-key-2", "test-key-3"]:
+        record = copy.deepcopy(test_event["Records"][0])
+        record["s3"]["object"]["key"] = key
+        event["Records"].append(record)
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": s3_object_mock_content},
+        {"Bucket": "test-bucket", "Key": "test-key"},
+    )
+    s3.add_client_error(
+        "get_object",
+        "NoSuchKey",
+        expected_params={"Bucket": "test-bucket", "Key": "test-key-2"},
+    )
+    s3.add_response(
+        "get_object",
+        {"Body": s3_object_mock_content},
+        {"Bucket": "test-bucket", "Key": "test-key-3"},
+    )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    for execution_arn in ["execution_arn_1", "execution_arn_3"]:
+        step_functions.add_response(
+            "start_execution",
+            {"executionArn": execution_arn, "startDate": datetime(2010, 1, 1)},
+        )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    assert response["executions"] == [
+        {"bucket": "test-bucket", "key": "test-key", "executionArn": "execution_arn_1"},
+        {
+            "bucket": "test-bucket",
+            "key": "test-key-3",
+            "executionArn": "execution_arn_3",
+        },
+    ]
+    assert [failure["key"] for failure in response["failures"]] == ["test-key-2"]
+    assert "NoSuchKey" in response["failures"][0]["error"]
+
+
+@pytest.mark.parametrize(
+    "service,operation,error_code,http_status_code",
+    [
+        ("s3", "get_object", "SlowDown", 503),
+        ("step_functions", "start_execution", "ThrottlingException", 400),
+    ],
+)
+def test_trigger_step_function_transient_failure(
+    lambda_module, monkeypatch, service, operation, error_code, http_status_code
+):
+    """
+    Given two account configuration objects notified in the same s3 event, one of them failing with a transient error
+    When the handler is called
+    Then the other object is still deployed, and the handler raises an error for S3 to retry the event
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "MAX_WORKERS", 1)
+    s3_object_mock_content = open(
+        os.path.join(__location__, "test_files/sample_account.yaml"), "r"
+    ).read()
+    event = copy.deepcopy(test_event)
+    record = copy.deepcopy(test_event["Records"][0])
+    record["s3"]["object"]["key"] = "test-key-2"
+    event["Records"].append(record)
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": s3_object_mock_content},
+        {"Bucket": "test-bucket", "Key": "test-key"},
+    )
+    if service == "s3":
+        s3.add_client_error(operation, error_code, http_status_code=http_status_code)
+    else:
+        s3.add_response(
+            "get_object",
+            {"Body": s3_object_mock_content},
+            {"Bucket": "test-bucket", "Key": "test-key-2"},
+        )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "start_execution",
+        {"executionArn": "execution_arn_1", "startDate": datetime(2010, 1, 1)},
+    )
+    if service == "step_functions":
+        step_functions.add_client_error(
+            operation, error_code, http_status_code=http_status_code
+        )
+    s3.activate()
+    step_functions.activate()
+    # When
+    with pytest.raises(lambda_module.TransientFailureException):
+        lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    s3.assert_no_pending_responses()
+    step_functions.assert_no_pending_responses()
+
+
+def test_trigger_step_function_batch_accounts(lambda_module, monkeypatch):
+    """
+    Given configuration objects of several accounts are notified in the same s3 event, in batching mode
+    When the handler is called
+    Then a single step function is triggered, with the stacksets sharing their parameters grouped across accounts, and the most conservative concurrency settings
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "MAX_WORKERS", 1)
+    monkeypatch.setattr(lambda_module, "BATCH_ACCOUNTS", True)
+    config_files = [
+        "account: '111111111111'\n"
+        "stackset_concurrency: 2\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "  parameters:\n"
+        "    CidrBlock: '10.0.0.0/24'\n",
+        "account: '222222222222'\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "  parameters:\n"
+        "    CidrBlock: '10.0.0.0/24'\n"
+        "- name: subnets\n",
+        "account: '333333333333'\n"
+        "max_concurrency: 5\n"
+        "stackset_concurrency: 3\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "  parameters:\n"
+        "    CidrBlock: '10.1.0.0/24'\n",
+    ]
+    event = copy.deepcopy(test_event)
+    for key in ["test-key-2", "test-key-3"]:
+        record = copy.deepcopy(test_event["Records"][0])
+        record["s3"]["object"]["key"] = key
+        event["Records"].append(record)
+    step_functions_expected_input = {
+        "waves": [
+            {
+                "max_concurrency": 5,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 2,
+                        "stacksets": [
+                            {
+                                "name": "vpc",
+                                "parameters": {"CidrBlock": "10.0.0.0/24"},
+                                "accounts": ["111111111111", "222222222222"],
+                            },
+                            {
+                                "name": "vpc",
+                                "parameters": {"CidrBlock": "10.1.0.0/24"},
+                                "accounts": ["333333333333"],
+                            },
+                        ],
+                    },
+                    {
+                        "name": "subnets",
+                        "max_concurrency": 2,
+                        "stacksets": [
+                            {"name": "subnets", "accounts": ["222222222222"]}
+                        ],
+                    },
+                ],
+            }
+        ],
+    }
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    for key, config_file in zip(["test-key", "test-key-2", "test-key-3"], config_files):
+        s3.add_response(
+            "get_object", {"Body": config_file}, {"Bucket": "test-bucket", "Key": key}
+        )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "start_execution",
+        {"executionArn": "execution_arn", "startDate": datetime(2010, 1, 1)},
+        {
+            "stateMachineArn": "step_function_test_arn",
+            "input": json.dumps(step_functions_expected_input),
+        },
+    )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    assert [execution["executionArn"] for execution in response["executions"]] == [
+        "execution_arn"
+    ] * 3
+    assert response["failures"] == []
+
+
+def test_trigger_step_function_batch_accounts_batch_size(lambda_module, monkeypatch):
+    """
+    Given configuration objects of more accounts than the batch size are notified in the same s3 event, in batching mode
+    When the handler is called
+    Then the accounts sharing the stackset parameters are split into batches of at most the batch size
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "MAX_WORKERS", 1)
+    monkeypatch.setattr(lambda_module, "BATCH_ACCOUNTS", True)
+    monkeypatch.setattr(lambda_module, "MANIFEST_BATCH_SIZE", 2)
+    accounts = ["111111111111", "222222222222", "333333333333"]
+    event = {"Records": []}
+    for account_id in accounts:
+        record = copy.deepcopy(test_event["Records"][0])
+        record["s3"]["object"]["key"] = account_id
+        event["Records"].append(record)
+    step_functions_expected_input = {
+        "waves": [
+            {
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 1,
+                        "stacksets": [
+                            {"name": "vpc", "accounts": accounts[:2]},
+                            {"name": "vpc", "accounts": accounts[2:]},
+                        ],
+                    }
+                ],
+            }
+        ],
+    }
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    for account_id in accounts:
+        s3.add_response(
+            "get_object",
+            {"Body": "account: '" + account_id + "'\nstacksets:\n- name: vpc\n"},
+            {"Bucket": "test-bucket", "Key": account_id},
+        )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "start_execution",
+        {"executionArn": "execution_arn", "startDate": datetime(2010, 1, 1)},
+        {
+            "stateMachineArn": "step_function_test_arn",
+            "input": json.dumps(step_functions_expected_input),
+        },
+    )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    step_functions.assert_no_pending_responses()
+    assert response["failures"] == []
+
+
+def streaming_body(content):
+    body = json.dumps(content).encode()
+    return StreamingBody(io.BytesIO(body), len(body))
+
+
+def applied_state(lambda_module, stacksets, execution_arn="previous_execution_arn"):
+    return {
+        "execution_arn": execution_arn,
+        "stacksets": {
+            stackset["name"]: {
+                "digest": lambda_module.stackset_digest(stackset),
+                "stackset": stackset,
+            }
+            for stackset in stacksets
+        },
+    }
+
+
+def test_trigger_step_function_incremental(lambda_module, monkeypatch):
+    """
+    Given a new version of an account configuration object, whose previous version was applied
+    When the handler is called
+    Then a step function is triggered with the changed and removed stacksets only, the removed ones being terminated
+    And the removed stacksets are kept in the applied state until their termination succeeds
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "INCREMENTAL_DEPLOYMENTS", True)
+    config_file = (
+        "account: '123456789876'\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "  parameters:\n"
+        "    CidrBlock: '10.1.0.0/24'\n"
+        "- name: dns\n"
+    )
+    vpc = {
+        "name": "vpc",
+        "parameters": {"CidrBlock": "10.0.0.0/24"},
+        "account": "123456789876",
+    }
+    dns = {"name": "dns", "account": "123456789876"}
+    subnets = {"name": "subnets", "account": "123456789876"}
+    step_functions_expected_input = {
+        "account": "123456789876",
+        "waves": [
+            {
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 1,
+                        "stacksets": [
+                            dict(vpc, parameters={"CidrBlock": "10.1.0.0/24"})
+                        ],
+                    },
+                    {
+                        "name": "subnets",
+                        "max_concurrency": 1,
+                        "stacksets": [dict(subnets, terminate=True)],
+                    },
+                ],
+            }
+        ],
+    }
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": config_file},
+        {"Bucket": "test-bucket", "Key": "test-key"},
+    )
+    s3.add_response(
+        "get_object",
+        {"Body": streaming_body(applied_state(lambda_module, [vpc, dns, subnets]))},
+        {"Bucket": "test-bucket", "Key": ".applied/test-key.json"},
+    )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "test-bucket",
+            "Key": ".applied/test-key.json",
+            "Body": json.dumps(
+                applied_state(
+                    lambda_module,
+                    [
+                        dict(vpc, parameters={"CidrBlock": "10.1.0.0/24"}),
+                        dns,
+                        dict(subnets, terminate=True),
+                    ],
+                    execution_arn="execution_arn",
+                )
+            ).encode(),
+            "ContentType": "application/json",
+        },
+    )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "describe_execution",
+        {
+            "executionArn": "previous_execution_arn",
+            "stateMachineArn": "step_function_test_arn",
+            "status": "SUCCEEDED",
+            "startDate": datetime(2010, 1, 1),
+        },
+        {"executionArn": "previous_execution_arn"},
+    )
+    step_functions.add_response(
+        "start_execution",
+        {"executionArn": "execution_arn", "startDate": datetime(2010, 1, 1)},
+        {
+            "stateMachineArn": "step_function_test_arn",
+            "input": json.dumps(step_functions_expected_input),
+        },
+    )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(test_event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    s3.assert_no_pending_responses()
+    assert response["executions"] == [
+        {"bucket": "test-bucket", "key": "test-key", "executionArn": "execution_arn"}
+    ]
+
+
+def test_trigger_step_function_incremental_unchanged(lambda_module, monkeypatch):
+    """
+    Given an account configuration object uploaded again without changes
+    When the handler is called, along with the notification of an applied state object
+    Then no step function is triggered, and the object is reported unchanged
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "INCREMENTAL_DEPLOYMENTS", True)
+    config_file = "account: '123456789876'\nstacksets:\n- name: dns\n"
+    dns = {"name": "dns", "account": "123456789876"}
+    event = copy.deepcopy(test_event)
+    record = copy.deepcopy(test_event["Records"][0])
+    record["s3"]["object"]["key"] = ".applied/test-key.json"
+    event["Records"].append(record)
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": config_file},
+        {"Bucket": "test-bucket", "Key": "test-key"},
+    )
+    s3.add_response(
+        "get_object",
+        {"Body": streaming_body(applied_state(lambda_module, [dns]))},
+        {"Bucket": "test-bucket", "Key": ".applied/test-key.json"},
+    )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "describe_execution",
+        {
+            "executionArn": "previous_execution_arn",
+            "stateMachineArn": "step_function_test_arn",
+            "status": "SUCCEEDED",
+            "startDate": datetime(2010, 1, 1),
+        },
+    )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    step_functions.assert_no_pending_responses()
+    assert response == {
+        "executions": [],
+        "unchanged": [{"bucket": "test-bucket", "key": "test-key", "unchanged": True}],
+        "failures": [],
+    }
+
+
+def test_get_applied_state_expired_execution(lambda_module):
+    """
+    Given the applied state of a file whose last execution was forgotten by Step Functions
+    When the applied state is read
+    Then the execution is not known to have succeeded, instead of failing
+    """
+    # Given
+    dns = {"name": "dns", "account": "123456789876"}
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object", {"Body": streaming_body(applied_state(lambda_module, [dns]))}
+    )
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_client_error("describe_execution", "ExecutionDoesNotExist")
+    s3.activate()
+    step_functions.activate()
+    # When
+    state = lambda_module.get_applied_state("test-bucket", "test-key")
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    assert state["succeeded"] is False
+    assert lambda_module.diff_stacksets(state, {"stacksets": [dns]})["changed"] == [dns]
+
+
+def test_diff_stacksets_after_failed_execution(lambda_module):
+    """
+    Given the applied state of a file whose last execution failed
+    When the stacksets of the file are compared with it
+    Then every stackset of the file is deployed again
+    """
+    # Given
+    dns = {"name": "dns", "account": "123456789876"}
+    state = dict(applied_state(lambda_module, [dns]), succeeded=False)
+    # When
+    diff = lambda_module.diff_stacksets(state, {"stacksets": [dns]})
+    # Then
+    assert diff == {"added": [], "changed": [dns], "removed": [], "unchanged": []}
+
+
+def test_trigger_step_function_incremental_terminate(lambda_module, monkeypatch):
+    """
+    Given an account configuration object with the terminate field set to True, with incremental deployments
+    When the handler is called
+    Then the terminated stacksets are recorded in the applied state, so that the previous version of the file differs from it
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "INCREMENTAL_DEPLOYMENTS", True)
+    config_file = "account: '123456789876'\nterminate: true\nstacksets:\n- name: dns\n"
+    dns = {"name": "dns", "account": "123456789876"}
+    terminated_state = applied_state(
+        lambda_module, [dict(dns, terminate=True)], execution_arn="execution_arn"
+    )
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": config_file},
+        {"Bucket": "test-bucket", "Key": "test-key"},
+    )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "test-bucket",
+            "Key": ".applied/test-key.json",
+            "Body": json.dumps(terminated_state).encode(),
+            "ContentType": "application/json",
+        },
+    )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "start_execution",
+        {"executionArn": "execution_arn", "startDate": datetime(2010, 1, 1)},
+    )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(test_event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    s3.assert_no_pending_responses()
+    assert response["failures"] == []
+    diff = lambda_module.diff_stacksets(
+        dict(terminated_state, succeeded=True), {"stacksets": [dns]}
+    )
+    assert diff["changed"] == [dns]
+
+
+@pytest.mark.parametrize("succeeded,removed", [(False, True), (True, False)])
+def test_diff_stacksets_terminated(lambda_module, succeeded, removed):
+    """
+    Given the applied state of a file whose last execution terminated a removed stackset
+    When the stacksets of the file are compared with it
+    Then the stackset is terminated again if that execution did not succeed, and left out otherwise
+    """
+    # Given
+    dns = {"name": "dns", "account": "123456789876"}
+    vpc = {"name": "vpc", "account": "123456789876"}
+    state = dict(
+        applied_state(lambda_module, [dns, dict(vpc, terminate=True)]),
+        succeeded=succeeded,
+    )
+    # When
+    diff = lambda_module.diff_stacksets(state, {"stacksets": [dns]})
+    # Then
+    assert diff["removed"] == ([dict(vpc, terminate=True)] if removed else [])
+    assert lambda_module.delta_config_file({"stacksets": [dns]}, diff)["stacksets"] == (
+        [dns, dict(vpc, terminate=True)] if removed else []
+    )
+
+
+def test_add_account_information_regions(lambda_module):
+    """
+    Given an account configuration listing regions at the top level and for one stackset
+    When the account information is added to its stacksets
+    Then the stacksets without regions are deployed to the regions of the file
+    """
+    # Given
+    config_file = lambda_module.parse(
+        {
+            "Body": "account: '123456789876'\n"
+            "regions: [eu-west-1, us-east-1]\n"
+            "stacksets:\n"
+            "- name: vpc\n"
+            "- name: dns\n"
+            "  regions: [us-east-1]\n"
+        }
+    )
+    # When
+    config_file = lambda_module.add_account_information(config_file)
+    # Then
+    assert config_file["stacksets"] == [
+        {
+            "name": "vpc",
+            "account": "123456789876",
+            "regions": ["eu-west-1", "us-east-1"],
+        },
+        {"name": "dns", "regions": ["us-east-1"], "account": "123456789876"},
+    ]
+
+
+def test_trigger_step_function_invalid_preferences(lambda_module):
+    """
+    Given an account configuration object with invalid operation preferences
+    When the handler is called
+    Then no step function is triggered, and the object is reported as a failure
+    """
+    # Given
+    config_file = (
+        "account: '123456789876'\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "  max_concurrent_count: 5\n"
+        "  max_concurrent_percentage: 50\n"
+    )
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response("get_object", {"Body": config_file})
+    s3.activate()
+    # When
+    response = lambda_module.lambda_handler(test_event, {})
+    s3.deactivate()
+    # Then
+    assert response["executions"] == []
+    assert response["failures"][0]["error"].startswith("InvalidConfigFile(")
+    assert "Invalid operation preferences of stackset vpc" in (
+        response["failures"][0]["error"]
+    )
+
+
+def test_group_stacksets_organizational_units(lambda_module):
+    """
+    Given account configurations with a stackset targeting an organizational unit, and another deployed to the accounts
+    When their stacksets are grouped
+    Then the stackset of the organizational unit is deployed once, without accounts
+    """
+    # Given
+    baseline = {
+        "name": "baseline",
+        "deployment_targets": {"organizational_units": ["ou-abcd-11111111"]},
+    }
+    config_files = [
+        lambda_module.add_account_information(
+            {
+                "account": account_id,
+                "stacksets": [dict(baseline), {"name": "vpc"}],
+            }
+        )
+        for account_id in ["111111111111", "222222222222"]
+    ]
+    # When
+    result = lambda_module.group_stacksets(config_files)
+    # Then
+    assert result == {
+        "stacksets": [
+            baseline,
+            {"name": "vpc", "accounts": ["111111111111", "222222222222"]},
+        ]
+    }
+
+
+def test_trigger_step_function_manifest(lambda_module, monkeypatch):
+    """
+    Given a multi-document YAML manifest describing several accounts is pushed to an s3 bucket
+    When the handler is called
+    Then the manifest is inverted into batches of accounts per StackSet, spread over a bounded number of executions
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "MANIFEST_BATCH_SIZE", 2)
+    monkeypatch.setattr(lambda_module, "MANIFEST_MAX_EXECUTIONS", 2)
+    manifest = "".join(
+        "---\n"
+        "account: '" + account_id + "'\n"
+        "stacksets:\n"
+        "- name: vpc\n"
+        "- name: dns\n"
+        for account_id in ["111111111111", "222222222222", "333333333333"]
+    ) + ("---\n" "account: '444444444444'\n" "stacksets:\n" "- name: subnets\n")
+    event = copy.deepcopy(test_event)
+    event["Records"][0]["s3"]["object"]["key"] = "rollout.manifest.yaml"
+    executions_expected_input = [
+        {
+            "waves": [
+                {
+                    "max_concurrency": 0,
+                    "stackset_groups": [
+                        {
+                            "name": "vpc",
+                            "max_concurrency": 1,
+                            "stacksets": [
+                                {
+                                    "name": "vpc",
+                                    "accounts": ["111111111111", "222222222222"],
+                                },
+                                {"name": "vpc", "accounts": ["333333333333"]},
+                            ],
+                        },
+                        {
+                            "name": "subnets",
+                            "max_concurrency": 1,
+                            "stacksets": [
+                                {"name": "subnets", "accounts": ["444444444444"]}
+                            ],
+                        },
+                    ],
+                }
+            ],
+        },
+        {
+            "waves": [
+                {
+                    "max_concurrency": 0,
+                    "stackset_groups": [
+                        {
+                            "name": "dns",
+                            "max_concurrency": 1,
+                            "stacksets": [
+                                {
+                                    "name": "dns",
+                                    "accounts": ["111111111111", "222222222222"],
+                                },
+                                {"name": "dns", "accounts": ["333333333333"]},
+                            ],
+                        }
+                    ],
+                }
+            ],
+        },
+    ]
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": manifest},
+        {"Bucket": "test-bucket", "Key": "rollout.manifest.yaml"},
+    )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    for index, execution_input in enumerate(executions_expected_input):
+        step_functions.add_response(
+            "start_execution",
+            {
+                "executionArn": "execution_arn_" + str(index),
+                "startDate": datetime(2010, 1, 1),
+            },
+            {
+                "stateMachineArn": "step_function_test_arn",
+                "input": json.dumps(execution_input),
+            },
+        )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    step_functions.assert_no_pending_responses()
+    assert response["executions"] == [
+        {
+            "bucket": "test-bucket",
+            "key": "rollout.manifest.yaml",
+            "stacksets": ["vpc", "subnets"],
+            "executionArn": "execution_arn_0",
+        },
+        {
+            "bucket": "test-bucket",
+            "key": "rollout.manifest.yaml",
+            "stacksets": ["dns"],
+            "executionArn": "execution_arn_1",
+        },
+    ]
+    assert response["failures"] == []
+
+
+def test_trigger_step_function_invalid_manifest(lambda_module):
+    """
+    Given a JSON Lines manifest with an invalid document is pushed to an s3 bucket
+    When the handler is called
+    Then no execution is started, and the manifest is reported as a failure naming the document
+    """
+    # Given
+    manifest = "\n".join(
+        [
+            json.dumps({"account": "111111111111", "stacksets": [{"name": "vpc"}]}),
+            "",
+            json.dumps(
+                {
+                    "account": "222222222222",
+                    "stacksets": [{"name": "vpc", "call_as": "ADMIN"}],
+                }
+            ),
+        ]
+    ).encode()
+    event = copy.deepcopy(test_event)
+    event["Records"][0]["s3"]["object"]["key"] = "rollout.jsonl"
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": StreamingBody(io.BytesIO(manifest), len(manifest))},
+        {"Bucket": "test-bucket", "Key": "rollout.jsonl"},
+    )
+    s3.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    s3.deactivate()
+    # Then
+    assert response["executions"] == []
+    assert len(response["failures"]) == 1
+    assert response["failures"][0]["key"] == "rollout.jsonl"
+    assert response["failures"][0]["error"].startswith(
+        "ValueError('Document 2: Invalid configuration file: "
+        "Invalid deployment targets of stackset vpc"
+    )
+
+
+def test_trigger_step_function_offloaded_plan(lambda_module, monkeypatch):
+    """
+    Given an account configuration object whose execution input exceeds the offload threshold
+    When the handler is called
+    Then its stacksets are written to a plan object, and the execution input only references their lines
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "PLAN_BUCKET", "plan-bucket")
+    monkeypatch.setattr(lambda_module, "PLAN_OFFLOAD_THRESHOLD", 1)
+    monkeypatch.setattr(uuid, "uuid4", lambda: uuid.UUID(int=1))
+    config_file = "account: '123456789876'\n" "stacksets:\n" "- name: vpc\n"
+    line = json.dumps({"name": "vpc", "account": "123456789876"}) + "\n"
+    plan_key = ".plans/" + uuid.UUID(int=1).hex + ".jsonl"
+    step_functions_expected_input = {
+        "account": "123456789876",
+        "waves": [
+            {
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 1,
+                        "stacksets": [
+                            {
+                                "name": "vpc",
+                                "plan": {
+                                    "bucket": "plan-bucket",
+                                    "key": plan_key,
+                                    "range": [0, len(line) - 1],
+                                },
+                            }
+                        ],
+                    }
+                ],
+            }
+        ],
+    }
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": config_file},
+        {"Bucket": "test-bucket", "Key": "test-key"},
+    )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "plan-bucket",
+            "Key": plan_key,
+            "Body": line.encode(),
+            "ContentType": "application/x-ndjson",
+        },
+    )
+    ## Step Functions mock configuration
+    step_functions = Stubber(lambda_module.step_functions)
+    step_functions.add_response(
+        "start_execution",
+        {"executionArn": "execution_arn", "startDate": datetime(2010, 1, 1)},
+        {
+            "stateMachineArn": "step_function_test_arn",
+            "input": json.dumps(step_functions_expected_input),
+        },
+    )
+    s3.activate()
+    step_functions.activate()
+    # When
+    response = lambda_module.lambda_handler(test_event, {})
+    s3.deactivate()
+    step_functions.deactivate()
+    # Then
+    s3.assert_no_pending_responses()
+    assert [execution["executionArn"] for execution in response["executions"]] == [
+        "execution_arn"
+    ]
+
+
+def test_order_stacksets_dependencies(lambda_module):
+    """
+    Given account configurations with a stackset depending on another
+    When their stacksets are grouped and ordered
+    Then the StackSets run in waves, the dependent one after its dependency
+    """
+    # Given
+    config_files = [
+        lambda_module.add_account_information(
+            {
+                "account": account_id,
+                "stacksets": [
+                    {"name": "subnets", "depends_on": ["vpc"]},
+                    {"name": "vpc"},
+                    {"name": "dns"},
+                ],
+            }
+        )
+        for account_id in ["111111111111", "222222222222"]
+    ]
+    # When
+    result = lambda_module.order_stacksets(lambda_module.group_stacksets(config_files))
+    # Then
+    accounts = ["111111111111", "222222222222"]
+    assert result == {
+        "waves": [
+            {
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "vpc",
+                        "max_concurrency": 1,
+                        "stacksets": [{"name": "vpc", "accounts": accounts}],
+                    },
+                    {
+                        "name": "dns",
+                        "max_concurrency": 1,
+                        "stacksets": [{"name": "dns", "accounts": accounts}],
+                    },
+                ],
+            },
+            {
+                "max_concurrency": 0,
+                "stackset_groups": [
+                    {
+                        "name": "subnets",
+                        "max_concurrency": 1,
+                        "stacksets": [{"name": "subnets", "accounts": accounts}],
+                    }
+                ],
+            },
+        ]
+    }
+
+
+def test_plan_executions_dependencies(lambda_module):
+    """
+    Given the batches of StackSets, two of them depending on each other
+    When they are spread over executions
+    Then the dependent StackSets are deployed by the same execution
+    """
+    # Given
+    stacksets = [
+        {"name": "vpc", "accounts": ["111111111111"]},
+        {"name": "dns", "accounts": ["111111111111"]},
+        {"name": "subnets", "accounts": ["111111111111"], "depends_on": ["vpc"]},
+        {"name": "logs", "accounts": ["111111111111"]},
+    ]
+    # When
+    executions = lambda_module.plan_executions(stacksets, 3)
+    # Then
+    assert sorted(
+        sorted(stackset["name"] for stackset in execution) for execution in executions
+    ) == [["dns"], ["logs"], ["subnets", "vpc"]]
+
+
+def test_batch_accounts_rollout(lambda_module):
+    """
+    Given a group of more accounts than the batch size, with a progressive rollout
+    When its accounts are split into batches
+    Then the group is kept whole, its waves being capped at the batch size
+    """
+    # Given
+    accounts = ["%012d" % account for account in range(5)]
+    stacksets = [
+        {"name": "vpc", "accounts": accounts, "rollout": {"max_wave": 3}},
+        {"name": "dns", "accounts": accounts, "rollout": {"first_wave": 2}},
+    ]
+    # When
+    batches = lambda_module.batch_accounts(stacksets, 2)
+    # Then
+    assert batches == [
+        {"name": "vpc", "accounts": accounts, "rollout": {"max_wave": 2}},
+        {
+            "name": "dns",
+            "accounts": accounts,
+            "rollout": {"first_wave": 2, "max_wave": 2},
+        },
+    ]
@@ -13,15 +13,42 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
-from random import randrange
-import time
+import uuid
 
-import boto3
+from stackset_orchestration import (
+    clients,
+    coordination,
+    inventory,
+    logs,
+    metrics,
+    payloads,
+    polling,
+    preferences,
+    retry,
+    rollout,
+    targets,
+)
 
-cloudformation = boto3.client("cloudformation")
+cloudformation = clients.lazy_client("cloudformation", coordination.throttle_client)
 
 AWS_REGION = os.environ["AWS_REGION"]
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "10"))
+# Stack instances an invocation describes to find the ones already up to date
+PLAN_MAX_STACK_INSTANCES = int(os.getenv("PLAN_MAX_STACK_INSTANCES", "100"))
+
+
+# Errors of an operation planned from an outdated inventory
+INVENTORY_MISS_ERROR_CODES = {
+    "create": ["NameAlreadyExistsException"],
+    "update": ["StackInstanceNotFoundException"],
+}
+
+
+class StackSetLeaseUnavailableException(Exception):
+    pass
 
 
 def format_parameters(parameters):
@@ -31,60 +58,518 @@ def format_parameters(parameters):
     return formatted_parameters
 
 
-def stackinstance_exists(stackset_name, account_id, region):
-    # Add jitter
-    time.sleep(randrange(10, 20))
-    stack_instance_size = len(
-        cloudformation.list_stack_instances(
+def list_stack_instance_pages(stackset_name, **call_as_arguments):
+    # List every stack instance of the stackset with a single paginated call
+    return retry.paginate(
+        cloudformation.list_stack_instances,
+        StackSetName=stackset_name,
+        **call_as_arguments
+    )
+
+
+stack_instances = inventory.StackInstanceInventory(list_stack_instance_pages)
+
+
+def get_account_ids(event):
+    # A batched stackset carries every account sharing its parameters
+    if "accounts" in event:
+        return [str(account_id) for account_id in event["accounts"]]
+    return [str(event["account"])]
+
+
+def parameter_values(parameter_overrides):
+    return {
+        parameter["ParameterKey"]: parameter.get("ParameterValue")
+        for parameter in parameter_overrides
+    }
+
+
+def describe_parameters(stackset_name, instances, call_as_arguments):
+    # Get the parameters of the instances up to date with their stackset, which
+    # are the ones to roll back to, describing them in parallel
+    summaries = stack_instances.instances(stackset_name, **call_as_arguments)
+    instances = [
+        instance
+        for instance in instances
+        if summaries.get(instance, {}).get("Status", "CURRENT") == "CURRENT"
+    ]
+    if not instances:
+        return {}
+    properties = metrics.get_properties()
+
+    def describe(instance):
+        metrics.set_properties(**properties)
+        return retry.call(
+            cloudformation.describe_stack_instance,
             StackSetName=stackset_name,
-            StackInstanceAccount=account_id,
-            StackInstanceRegion=region,
-        )["Summaries"]
+            StackInstanceAccount=instance[0],
+            StackInstanceRegion=instance[1],
+            **call_as_arguments
+        )["StackInstance"]
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(instances))) as executor:
+        return {
+            instance: parameter_values(stack_instance.get("ParameterOverrides", []))
+            for instance, stack_instance in zip(
+                instances, executor.map(describe, instances)
+            )
+            if stack_instance["Status"] == "CURRENT"
+        }
+
+
+def get_regions(event):
+    # Stacksets are deployed to the region of the function unless regions are listed
+    return event["regions"] if "regions" in event else [AWS_REGION]
+
+
+def needs_action(
+    action, account_id, region, existing_instances, parameter_overrides, parameters
+):
+    # Instances are updated unless they are CURRENT and already have the parameters
+    if (account_id, region) not in existing_instances:
+        return action == "create"
+    return action == "update" and parameters.get((account_id, region)) != (
+        parameter_values(parameter_overrides)
+    )
+
+
+def rollback_operations(accounts, regions, previous_parameters):
+    # Group the accounts of an update by the parameters their instances had,
+    # into the operations restoring them. The instances which were not CURRENT
+    # are left out, having no known good parameters to go back to
+    accounts_by_parameters = {}
+    for account_id in accounts:
+        regions_by_parameters = {}
+        for region in regions:
+            if (account_id, region) in previous_parameters:
+                parameters = json.dumps(
+                    previous_parameters[(account_id, region)], sort_keys=True
+                )
+                regions_by_parameters.setdefault(parameters, []).append(region)
+        for parameters, rollback_regions in regions_by_parameters.items():
+            accounts_by_parameters.setdefault(
+                (parameters, tuple(rollback_regions)), []
+            ).append(account_id)
+    return [
+        {
+            "action": "rollback",
+            "accounts": rollback_accounts,
+            "regions": list(rollback_regions),
+            "parameters": json.loads(parameters),
+        }
+        for (parameters, rollback_regions), rollback_accounts in (
+            accounts_by_parameters.items()
+        )
+    ]
+
+
+def plan_operations(
+    stackset_name,
+    account_ids,
+    regions,
+    terminate_stack_instance,
+    parameter_overrides,
+    call_as_arguments,
+):
+    # Group accounts into as few StackSet operations as possible, leaving out
+    # the instances which would not change
+    if terminate_stack_instance:
+        return [{"action": "delete", "accounts": account_ids, "regions": regions}]
+    existing_instances = stack_instances.instances(stackset_name, **call_as_arguments)
+    previous_parameters = describe_parameters(
+        stackset_name,
+        [
+            (account_id, region)
+            for account_id in account_ids
+            for region in regions
+            if (account_id, region) in existing_instances
+        ],
+        call_as_arguments,
+    )
+    operations = []
+    for action in ["create", "update"]:
+        # An operation covers every region of its accounts, so the accounts
+        # needing the action in the same regions share an operation
+        accounts_by_regions = {}
+        for account_id in account_ids:
+            action_regions = tuple(
+                region
+                for region in regions
+                if needs_action(
+                    action,
+                    account_id,
+                    region,
+                    existing_instances,
+                    parameter_overrides,
+                    previous_parameters,
+                )
+            )
+            if action_regions:
+                accounts_by_regions.setdefault(action_regions, []).append(account_id)
+        for action_regions, accounts in accounts_by_regions.items():
+            operation = {
+                "action": action,
+                "accounts": accounts,
+                "regions": list(action_regions),
+            }
+            rollback = rollback_operations(
+                accounts, action_regions, previous_parameters
+            )
+            if action == "update" and rollback:
+                operation["rollback"] = rollback
+            operations.append(operation)
+    return operations
+
+
+def plan_target_operations(
+    stackset_name,
+    deployment_targets,
+    regions,
+    terminate_stack_instance,
+    call_as_arguments,
+):
+    # Organizational units are created in the regions where none of their
+    # accounts has an instance yet, and updated in the others
+    if terminate_stack_instance:
+        return [
+            {
+                "action": "delete",
+                "deployment_targets": deployment_targets,
+                "regions": regions,
+            }
+        ]
+    organizational_units = deployment_targets["OrganizationalUnitIds"]
+    deployed_regions = set(
+        summary["Region"]
+        for summary in stack_instances.instances(
+            stackset_name, **call_as_arguments
+        ).values()
+        if summary.get("OrganizationalUnitId") in organizational_units
+    )
+    operations = [
+        {
+            "action": "create",
+            "deployment_targets": deployment_targets,
+            "regions": [r for r in regions if r not in deployed_regions],
+        },
+        {
+            "action": "update",
+            "deployment_targets": deployment_targets,
+            "regions": [r for r in regions if r in deployed_regions],
+        },
+    ]
+    return [operation for operation in operations if operation["regions"]]
+
+
+def plan_event_operations(
+    event, stackset_name, regions, terminate_stack_instance, parameter_overrides
+):
+    # Plan the operations of the accounts or organizational units of the stackset
+    if "deployment_targets" in event:
+        return plan_target_operations(
+            stackset_name,
+            targets.deployment_targets(event),
+            regions,
+            terminate_stack_instance,
+            targets.call_as_arguments(event),
+        )
+    account_ids = get_account_ids(event)
+    if "rollout" in event:
+        # Progressive rollouts deploy their waves one after the other, each wave
+        # being planned by the invocation starting it
+        return [
+            batch
+            for wave, accounts in enumerate(
+                rollout.waves(account_ids, event["rollout"])
+            )
+            for batch in plan_batches(accounts, regions, wave)
+        ]
+    if (
+        terminate_stack_instance
+        or len(account_ids) * len(regions) <= PLAN_MAX_STACK_INSTANCES
+    ):
+        return plan_operations(
+            stackset_name,
+            account_ids,
+            regions,
+            terminate_stack_instance,
+            parameter_overrides,
+            targets.call_as_arguments(event),
+        )
+    return plan_batches(account_ids, regions)
+
+
+def plan_batches(account_ids, regions, wave=None):
+    # Split accounts into batches planned by separate invocations, so that an
+    # invocation describes at most PLAN_MAX_STACK_INSTANCES stack instances
+    size = max(1, PLAN_MAX_STACK_INSTANCES // len(regions))
+    batches = []
+    for start in range(0, len(account_ids), size):
+        batch = {
+            "action": "plan",
+            "accounts": account_ids[start : start + size],
+            "regions": regions,
+        }
+        if wave is not None:
+            batch["wave"] = wave
+        batches.append(batch)
+    return batches
+
+
+def plan_batch(event, stackset_name, operations, parameter_overrides):
+    # Replace the next batch of accounts by its operations, grouping its accounts
+    # into as few operations as the ones of other stacksets
+    if not operations or operations[0]["action"] != "plan":
+        return operations
+    batch = operations[0]
+    batch_operations = plan_operations(
+        stackset_name,
+        batch["accounts"],
+        batch["regions"],
+        event.get("terminate", False),
+        parameter_overrides,
+        targets.call_as_arguments(event),
     )
-    return True if stack_instance_size > 0 else False
+    if "wave" in batch:
+        for operation in batch_operations:
+            operation["wave"] = batch["wave"]
+    return batch_operations + operations[1:]
+
+
+def get_operation(
+    operation,
+    stackset_name,
+    parameter_overrides,
+    operation_preferences,
+    call_as_arguments,
+):
+    # Get the CloudFormation function and arguments performing the operation
+    operation_arguments = {"StackSetName": stackset_name}
+    if "deployment_targets" in operation:
+        operation_arguments["DeploymentTargets"] = operation["deployment_targets"]
+    else:
+        operation_arguments["Accounts"] = operation["accounts"]
+    if operation["action"] == "delete":
+        operation_function = cloudformation.delete_stack_instances
+        operation_arguments["RetainStacks"] = False
+    else:
+        operation_function = (
+            cloudformation.create_stack_instances
+            if operation["action"] == "create"
+            else cloudformation.update_stack_instances
+        )
+        # A rollback restores the parameters the instances had before the update
+        operation_arguments["ParameterOverrides"] = (
+            format_parameters(operation["parameters"])
+            if "parameters" in operation
+            else parameter_overrides
+        )
+    operation_arguments["Regions"] = operation["regions"]
+    operation_arguments["OperationPreferences"] = operation_preferences
+    operation_arguments.update(call_as_arguments)
+    return operation_function, operation_arguments
+
+
+def inventory_miss(operation, error):
+    # Check if the operation failed because the stack instances were not as listed
+    if operation["action"] not in INVENTORY_MISS_ERROR_CODES:
+        return False
+    if retry.error_code(error) in INVENTORY_MISS_ERROR_CODES[operation["action"]]:
+        return True
+    message = getattr(error, "response", {}).get("Error", {}).get("Message", "")
+    return operation["action"] == "create" and "already exist" in message
+
+
+def operation_settings(event, operation):
+    # Rollbacks only use their defaults, and waves the preferences of their rollout
+    if operation["action"] == "rollback":
+        return {}
+    if "wave" in operation:
+        return rollout.wave_settings(event)
+    return event
+
+
+def perform_operation(event, operation, stackset_name, parameter_overrides):
+    operation_function, operation_arguments = get_operation(
+        operation,
+        stackset_name,
+        parameter_overrides,
+        preferences.operation_preferences(
+            operation_settings(event, operation),
+            operation["action"],
+            operation["regions"],
+        ),
+        targets.call_as_arguments(event),
+    )
+    # Perform operation, backing off only while another operation is in progress
+    response = retry.call(operation_function, **operation_arguments)
+    if "accounts" in operation:
+        stack_instances.record(
+            stackset_name,
+            operation["accounts"],
+            operation["regions"],
+            operation["action"] != "delete",
+        )
+    else:
+        # The accounts of organizational units are only known to CloudFormation
+        stack_instances.invalidate(stackset_name)
+    return response
+
+
+def start_operation(event, stackset_name, operations, parameter_overrides):
+    # Start the first operation, returning the operations left and its response,
+    # or no response if there is nothing to change, or no batch planned yet
+    operations = plan_batch(event, stackset_name, operations, parameter_overrides)
+    if not operations or operations[0]["action"] == "plan":
+        return operations, None
+    operation = operations[0]
+    try:
+        return operations, perform_operation(
+            event, operation, stackset_name, parameter_overrides
+        )
+    except Exception as error:
+        if not inventory_miss(operation, error):
+            raise
+        # List the stack instances again and plan the accounts of the operation the other way
+        logs.warning("Stack instances changed since they were listed", error=str(error))
+        stack_instances.invalidate(stackset_name)
+        if "accounts" in operation:
+            replanned_operations = plan_operations(
+                stackset_name,
+                operation["accounts"],
+                operation["regions"],
+                False,
+                parameter_overrides,
+                targets.call_as_arguments(event),
+            )
+            # The operations replacing one of a wave stay in its wave
+            if "wave" in operation:
+                for replanned_operation in replanned_operations:
+                    replanned_operation["wave"] = operation["wave"]
+        else:
+            replanned_operations = plan_event_operations(
+                event, stackset_name, operation["regions"], False, parameter_overrides
+            )
+        operations = replanned_operations + operations[1:]
+        if not operations or operations[0]["action"] == "plan":
+            return operations, None
+        return operations, perform_operation(
+            event, operations[0], stackset_name, parameter_overrides
+        )
 
 
 def lambda_handler(event, context):
-    # Get stackset instance information
-    account_id = str(event["account"])
+    # Get stackset instance information, from the plan of the execution when it was offloaded
+    event = payloads.load(event)
     terminate_stack_instance = event["terminate"] if "terminate" in event else False
     stackset_name = event["name"]
     parameter_overrides = (
         format_parameters(event["parameters"]) if "parameters" in event else []
     )
 
-    # Check if the operation is create, update or delete
-    if terminate_stack_instance:
-        operation_function = cloudformation.delete_stack_instances
-        operation_arguments = {
-            "StackSetName": stackset_name,
-            "Accounts": [account_id],
-            "RetainStacks": False,
-            "Regions": [AWS_REGION],
-        }
-    else:
-        operation_function = (
-            cloudformation.update_stack_instances
-            if stackinstance_exists(stackset_name, account_id, AWS_REGION)
-            else cloudformation.create_stack_instances
+    metrics.set_properties(StackSet=stackset_name, Account=event.get("account"))
+
+    # Queue behind the operations of other executions on the same StackSet
+    coordinator = coordination.coordinator()
+    lease_owner = uuid.uuid4().hex
+    if not coordinator.acquire_stackset(stackset_name, lease_owner):
+        metrics.count("LeaseUnavailable")
+        raise StackSetLeaseUnavailableException(
+            "StackSet " + stackset_name + " is in use by another execution"
         )
-        operation_arguments = {
-            "StackSetName": stackset_name,
-            "Accounts": [account_id],
-            "ParameterOverrides": parameter_overrides,
-            "Regions": [AWS_REGION],
-        }
 
-    # Add jitter
-    time.sleep(randrange(10, 20))
-    # Perform operation
-    response = operation_function(**operation_arguments)
-    print(response)
+    try:
+        # Check if the operation is create, update or delete, unless it has been planned already
+        operations = (
+            event["stackset_operations_pending"]
+            if "stackset_operations_pending" in event
+            else plan_event_operations(
+                event,
+                stackset_name,
+                get_regions(event),
+                terminate_stack_instance,
+                parameter_overrides,
+            )
+        )
+        operations, response = start_operation(
+            event, stackset_name, operations, parameter_overrides
+        )
+    except Exception:
+        coordinator.release_stackset(stackset_name, lease_owner)
+        raise
+
+    # Skip the verification when every stack instance already has the parameters,
+    # going on with the next batch of accounts if there is one
+    if response is None:
+        coordinator.release_stackset(stackset_name, lease_owner)
+        if operations:
+            logs.info(
+                "Stack instances of the batch are unchanged",
+                batches_pending=len(operations),
+            )
+            event["stackset_operations_pending"] = operations
+        else:
+            logs.info("Stack instances are unchanged")
+            metrics.count("UnchangedStackSets")
+            event.pop("stackset_operations_pending", None)
+        event.pop("wait_seconds", None)
+        event.pop("stackset_instance_retry", None)
+        event["stackset_instance_unchanged"] = True
+        return payloads.compact(event)
+    event.pop("stackset_instance_unchanged", None)
+    event.pop("stackset_instance_retry", None)
+    operation = operations[0]
+    logs.info(
+        "Started the StackSet operation",
+        operation_id=response["OperationId"],
+        action=operation["action"],
+        wave=operation.get("wave"),
+        operations_pending=len(operations) - 1,
+    )
+    metrics.count("OperationsStarted", Action=operation["action"])
+
+    # Keep the parameters to restore if the update fails, with the ones of the
+    # operations already done
+    if "rollback" in operation:
+        event["stackset_rollback"] = (
+            event.get("stackset_rollback", []) + operation["rollback"]
+        )
+
+    # Keep the operations still to be performed once this one is done
+    if len(operations) > 1:
+        event["stackset_operations_pending"] = operations[1:]
+    else:
+        event.pop("stackset_operations_pending", None)
 
     # Update stackset instance in creation data
-    event["stackset_instance_in_treatment"] = {
+    stackset_instance_in_treatment = {
         "name": stackset_name,
-        "account_id": account_id,
+        "operation_id": response["OperationId"],
     }
+    if "deployment_targets" in operation:
+        stackset_instance_in_treatment["organizational_units"] = operation[
+            "deployment_targets"
+        ]["OrganizationalUnitIds"]
+    elif "accounts" in event:
+        stackset_instance_in_treatment["accounts"] = operation["accounts"]
+    else:
+        stackset_instance_in_treatment["account_id"] = operation["accounts"][0]
+    if "regions" in event:
+        stackset_instance_in_treatment["regions"] = operation["regions"]
+    if "call_as" in event:
+        stackset_instance_in_treatment["call_as"] = event["call_as"]
+    if coordinator.enabled:
+        stackset_instance_in_treatment["lease_owner"] = lease_owner
+    event["stackset_instance_in_treatment"] = stackset_instance_in_treatment
 
-    return event
+    # Let the state machine wait for the operation before verifying it
+    target_count = (
+        len(operation["accounts"])
+        if "accounts" in operation
+        else len(operation["deployment_targets"]["OrganizationalUnitIds"])
+    )
+    event["wait_seconds"] = polling.wait_seconds(
+        0, target_count * len(operation["regions"])
+    )
+
+    return payloads.compact(event)
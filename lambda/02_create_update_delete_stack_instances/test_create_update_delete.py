@@ -1,3 +1,7 @@
+import io
+import json
+
+from botocore.response import StreamingBody
 from botocore.stub import Stubber
 import pytest
 
@@ -16,15 +20,35 @@ lambda_module = pytest.fixture(
     ],
 )(lambda_module)
 
+CREATE_OPERATION_PREFERENCES = {
+    "MaxConcurrentPercentage": 100,
+    "FailureTolerancePercentage": 0,
+    "RegionConcurrencyType": "PARALLEL",
+    "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+}
+UPDATE_OPERATION_PREFERENCES = {
+    "MaxConcurrentPercentage": 25,
+    "FailureTolerancePercentage": 0,
+    "RegionConcurrencyType": "SEQUENTIAL",
+    "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+}
+DELETE_OPERATION_PREFERENCES = dict(CREATE_OPERATION_PREFERENCES)
+
+
+@pytest.fixture(autouse=True)
+def stack_instances(lambda_module):
+    # Start every test without cached stack instance listings
+    lambda_module.stack_instances.invalidate()
+    return lambda_module.stack_instances
+
 
-def test_handler_create(lambda_module, monkeypatch):
+def test_handler_create(lambda_module):
     """
     Given a setup function input for creating stack instances
     When the handler is called
     Then the CreateStackInstances action of the CloudFormation API is called with the stackset parameters
     """
     # Given
-    monkeypatch.setattr(lambda_module.time, "sleep", lambda _: None)
     stackset_name = "vpc"
     account_id = "123456789876"
     region = "eu-west-1"
@@ -44,21 +68,20 @@ def test_handler_create(lambda_module, monkeypatch):
         "account": account_id,
         "stackset_instance_in_treatment": {
             "name": stackset_name,
+            "operation_id": "operation-id",
             "account_id": account_id,
         },
+        "wait_seconds": 10,
     }
     cloudformation_create_expected_params = {
         "StackSetName": stackset_name,
         "Accounts": [account_id],
         "ParameterOverrides": parameter_overrides,
         "Regions": [region],
+        "OperationPreferences": CREATE_OPERATION_PREFERENCES,
     }
     cloudformation_create_response = {"OperationId": "operation-id"}
-    cloudformation_list_expected_params = {
-        "StackSetName": stackset_name,
-        "StackInstanceAccount": account_id,
-        "StackInstanceRegion": region,
-    }
+    cloudformation_list_expected_params = {"StackSetName": stackset_name}
     cloudformation_list_response = {"Summaries": []}
     ## Cloudformation mock configuration
     cloudformation = Stubber(lambda_module.cloudformation)
@@ -80,14 +103,14 @@ def test_handler_create(lambda_module, monkeypatch):
     assert response == expected_step_function_output
 
 
-def test_handler_update(lambda_module, monkeypatch):
+def test_handler_update(lambda_module):
     """
     Given a setup function input for updating stack instances
     When the handler is called
     Then the UpdateStackInstances action of the CloudFormation API is called with the stackset parameters
+    And the previous parameters of the stack instance are kept to roll it back
     """
     # Given
-    monkeypatch.setattr(lambda_module.time, "sleep", lambda _: None)
     stackset_name = "vpc"
     account_id = "123456789876"
     region = "eu-west-1"
@@ -105,23 +128,33 @@ def test_handler_update(lambda_module, monkeypatch):
         "name": stackset_name,
         "parameters": parameters,
         "account": account_id,
+        "stackset_rollback": [
+            {
+                "action": "rollback",
+                "accounts": [account_id],
+                "regions": [region],
+                "parameters": {
+                    "CidrBlock": "10.0.1.0/24",
+                    "EnableDnsHostnames": "true",
+                },
+            }
+        ],
         "stackset_instance_in_treatment": {
             "name": stackset_name,
+            "operation_id": "operation-id",
             "account_id": account_id,
         },
+        "wait_seconds": 10,
     }
     cloudformation_create_expected_params = {
         "StackSetName": stackset_name,
         "Accounts": [account_id],
         "ParameterOverrides": parameter_overrides,
         "Regions": [region],
+        "OperationPreferences": UPDATE_OPERATION_PREFERENCES,
     }
     cloudformation_create_response = {"OperationId": "operation-id"}
-    cloudformation_list_expected_params = {
-        "StackSetName": stackset_name,
-        "StackInstanceAccount": account_id,
-        "StackInstanceRegion": region,
-    }
+    cloudformation_list_expected_params = {"StackSetName": stackset_name}
     cloudformation_list_response = {
         "Summaries": [
             {
@@ -136,6 +169,22 @@ def test_handler_update(lambda_module, monkeypatch):
             }
         ]
     }
+    cloudformation_describe_expected_params = {
+        "StackSetName": stackset_name,
+        "StackInstanceAccount": account_id,
+        "StackInstanceRegion": region,
+    }
+    cloudformation_describe_response = {
+        "StackInstance": {
+            "Account": account_id,
+            "Region": region,
+            "Status": "CURRENT",
+            "ParameterOverrides": [
+                {"ParameterKey": "CidrBlock", "ParameterValue": "10.0.1.0/24"},
+                {"ParameterKey": "EnableDnsHostnames", "ParameterValue": "true"},
+            ],
+        }
+    }
     ## Cloudformation mock configuration
     cloudformation = Stubber(lambda_module.cloudformation)
     cloudformation.add_response(
@@ -143,6 +192,11 @@ def test_handler_update(lambda_module, monkeypatch):
         cloudformation_list_response,
         cloudformation_list_expected_params,
     )
+    cloudformation.add_response(
+        "describe_stack_instance",
+        cloudformation_describe_response,
+        cloudformation_describe_expected_params,
+    )
     cloudformation.add_response(
         "update_stack_instances",
         cloudformation_create_response,
@@ -156,14 +210,13 @@ def test_handler_update(lambda_module, monkeypatch):
     assert response == expected_step_function_output
 
 
-def test_handler_delete(lambda_module, monkeypatch):
+def test_handler_delete(lambda_module):
     """
     Given a setup function input for updating stack instances
     When the handler is called
     Then the DeleteStackInstances action of the CloudFormation API is called with the stackset parameters
     """
     # Given
-    monkeypatch.setattr(lambda_module.time, "sleep", lambda _: None)
     stackset_name = "vpc"
     account_id = "123456789876"
     region = "eu-west-1"
@@ -181,14 +234,17 @@ def test_handler_delete(lambda_module, monkeypatch):
         "terminate": True,
         "stackset_instance_in_treatment": {
             "name": stackset_name,
+            "operation_id": "operation-id",
             "account_id": account_id,
         },
+        "wait_seconds": 10,
     }
     cloudformation_expected_params = {
         "StackSetName": stackset_name,
         "Accounts": [account_id],
         "RetainStacks": False,
         "Regions": [region],
+        "OperationPreferences": DELETE_OPERATION_PREFERENCES,
     }
     cloudformation_response = {"OperationId": "operation-id"}
     ## Cloudformation mock configuration
@@ -204,3 +260,814 @@ def test_handler_delete(lambda_module, monkeypatch):
     cloudformation.deactivate()
     # Then
     assert response == expected_step_function_output
+
+
+def test_handler_batch(lambda_module):
+    """
+    Given a setup function input for a stackset shared by several accounts, some of them already having an instance
+    When the handler is called
+    Then a single CreateStackInstances action is called for the new accounts, and the update of the other accounts is kept pending
+    """
+    # Given
+    stackset_name = "vpc"
+    region = "eu-west-1"
+    parameters = {"CidrBlock": "10.0.0.0/24"}
+    parameter_overrides = [
+        {"ParameterKey": "CidrBlock", "ParameterValue": "10.0.0.0/24"},
+    ]
+    step_function_input = {
+        "name": stackset_name,
+        "parameters": parameters,
+        "accounts": ["111111111111", "222222222222", "333333333333"],
+    }
+    expected_step_function_output = {
+        "name": stackset_name,
+        "parameters": parameters,
+        "accounts": ["111111111111", "222222222222", "333333333333"],
+        "stackset_operations_pending": [
+            {"action": "update", "accounts": ["222222222222"], "regions": [region]},
+        ],
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "accounts": ["111111111111", "333333333333"],
+        },
+        "wait_seconds": 11,
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {
+                    "StackSetId": "vpc:stackset-id",
+                    "Region": region,
+                    "Account": "222222222222",
+                    "Status": "OUTDATED",
+                }
+            ]
+        },
+        {"StackSetName": stackset_name},
+    )
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": ["111111111111", "333333333333"],
+            "ParameterOverrides": parameter_overrides,
+            "Regions": [region],
+            "OperationPreferences": CREATE_OPERATION_PREFERENCES,
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert response == expected_step_function_output
+
+
+def test_handler_batch_pending(lambda_module):
+    """
+    Given a setup function input for a batched stackset with a pending operation
+    When the handler is called
+    Then the pending operation is performed without checking the stackset instances again
+    """
+    # Given
+    stackset_name = "vpc"
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": ["111111111111", "222222222222"],
+        "stackset_operations_pending": [
+            {
+                "action": "update",
+                "accounts": ["222222222222"],
+                "regions": ["eu-west-1"],
+            },
+        ],
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "accounts": ["111111111111"],
+        },
+        "stackset_instance_ready": True,
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "update_stack_instances",
+        {"OperationId": "operation-id-2"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": ["222222222222"],
+            "ParameterOverrides": [],
+            "Regions": ["eu-west-1"],
+            "OperationPreferences": UPDATE_OPERATION_PREFERENCES,
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert "stackset_operations_pending" not in response
+    assert response["stackset_instance_in_treatment"] == {
+        "name": stackset_name,
+        "operation_id": "operation-id-2",
+        "accounts": ["222222222222"],
+    }
+
+
+def test_handler_rollback(lambda_module):
+    """
+    Given a setup function input with a pending rollback of a failed update
+    When the handler is called
+    Then the stack instances are updated back to their previous parameters at full concurrency
+    """
+    # Given
+    stackset_name = "vpc"
+    accounts = ["111111111111", "222222222222"]
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": accounts,
+        "parameters": {"CidrBlock": "10.0.1.0/24"},
+        "stackset_operations_pending": [
+            {
+                "action": "rollback",
+                "accounts": accounts,
+                "regions": ["eu-west-1"],
+                "parameters": {"CidrBlock": "10.0.0.0/24"},
+            },
+        ],
+        "stackset_instance_rollback": {"outcome": "terminal", "message": "failed"},
+        "stackset_instance_ready": True,
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "update_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": accounts,
+            "ParameterOverrides": [
+                {"ParameterKey": "CidrBlock", "ParameterValue": "10.0.0.0/24"}
+            ],
+            "Regions": ["eu-west-1"],
+            "OperationPreferences": {
+                "MaxConcurrentPercentage": 100,
+                "FailureTolerancePercentage": 100,
+                "RegionConcurrencyType": "PARALLEL",
+                "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+            },
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert "stackset_operations_pending" not in response
+    assert "stackset_rollback" not in response
+    assert response["stackset_instance_rollback"]["message"] == "failed"
+    assert response["stackset_instance_in_treatment"]["accounts"] == accounts
+
+
+def test_handler_stackset_lease(lambda_module, monkeypatch):
+    """
+    Given a setup function input for a StackSet, with coordination enabled
+    When the handler is called while another execution holds the StackSet, then once it is released
+    Then the handler first raises without calling CloudFormation, then operates and keeps the lease for the verification
+    """
+    # Given
+    coordinator = lambda_module.coordination.Coordinator(
+        lambda_module.coordination.MemoryStore()
+    )
+    monkeypatch.setattr(lambda_module.coordination, "_coordinator", coordinator)
+    coordinator.acquire_stackset("vpc", "other-execution")
+    step_function_input = {"name": "vpc", "account": "123456789876", "terminate": True}
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "delete_stack_instances", {"OperationId": "operation-id"}
+    )
+    cloudformation.activate()
+    # When
+    with pytest.raises(lambda_module.StackSetLeaseUnavailableException):
+        lambda_module.lambda_handler(dict(step_function_input), {})
+    coordinator.release_stackset("vpc", "other-execution")
+    response = lambda_module.lambda_handler(dict(step_function_input), {})
+    cloudformation.deactivate()
+    # Then
+    lease_owner = response["stackset_instance_in_treatment"]["lease_owner"]
+    assert not coordinator.acquire_stackset("vpc", "other-execution")
+    assert coordinator.acquire_stackset("vpc", lease_owner)
+
+
+def test_handler_inventory_cached(lambda_module):
+    """
+    Given a stackset whose instances have been listed by a previous invocation
+    When the handler is called for another account, then for the account created
+    Then the instances are not listed again, and the created account is updated
+    """
+    # Given
+    stackset_name = "vpc"
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances", {"Summaries": []}, {"StackSetName": stackset_name}
+    )
+    for action in ["create", "create"]:
+        cloudformation.add_response(
+            action + "_stack_instances", {"OperationId": "operation-id"}
+        )
+    cloudformation.add_response(
+        "describe_stack_instance",
+        {
+            "StackInstance": {
+                "Account": "111111111111",
+                "Region": "eu-west-1",
+                "Status": "OUTDATED",
+            }
+        },
+    )
+    cloudformation.add_response(
+        "update_stack_instances", {"OperationId": "operation-id"}
+    )
+    cloudformation.activate()
+    # When
+    for account_id in ["111111111111", "222222222222", "111111111111"]:
+        lambda_module.lambda_handler({"name": stackset_name, "account": account_id}, {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+
+
+def test_handler_inventory_miss(lambda_module, stack_instances):
+    """
+    Given a cached listing in which the instance of an account is missing, although it has been created since
+    When the handler is called for the account
+    Then the CreateStackInstances error invalidates the listing, and the instance is updated instead
+    """
+    # Given
+    stackset_name = "vpc"
+    account_id = "123456789876"
+    region = "eu-west-1"
+    summary = {
+        "StackSetId": "vpc:stackset-id",
+        "Region": region,
+        "Account": account_id,
+        "Status": "OUTDATED",
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances", {"Summaries": []}, {"StackSetName": stackset_name}
+    )
+    cloudformation.add_client_error(
+        "create_stack_instances",
+        service_error_code="NameAlreadyExistsException",
+        service_message="Stack instance already exists",
+    )
+    cloudformation.add_response(
+        "list_stack_instances",
+        {"Summaries": [summary]},
+        {"StackSetName": stackset_name},
+    )
+    cloudformation.add_response(
+        "update_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": [account_id],
+            "ParameterOverrides": [],
+            "Regions": [region],
+            "OperationPreferences": UPDATE_OPERATION_PREFERENCES,
+        },
+    )
+    cloudformation.activate()
+    stack_instances.instances(stackset_name)
+    # When
+    response = lambda_module.lambda_handler(
+        {"name": stackset_name, "account": account_id}, {}
+    )
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response["stackset_instance_in_treatment"]["operation_id"] == "operation-id"
+    assert stack_instances.exists(stackset_name, account_id, region)
+
+
+def test_handler_unchanged(lambda_module, monkeypatch):
+    """
+    Given a setup function input for an existing stack instance which already has the parameters
+    When the handler is called
+    Then no StackSet operation is performed, the lease is released and the input is marked unchanged
+    """
+    # Given
+    coordinator = lambda_module.coordination.Coordinator(
+        lambda_module.coordination.MemoryStore()
+    )
+    monkeypatch.setattr(lambda_module.coordination, "_coordinator", coordinator)
+    stackset_name = "vpc"
+    account_id = "123456789876"
+    region = "eu-west-1"
+    step_function_input = {
+        "name": stackset_name,
+        "parameters": {"CidrBlock": "10.0.0.0/24"},
+        "account": account_id,
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {"Summaries": [{"Account": account_id, "Region": region, "Status": "CURRENT"}]},
+        {"StackSetName": stackset_name},
+    )
+    cloudformation.add_response(
+        "describe_stack_instance",
+        {
+            "StackInstance": {
+                "Account": account_id,
+                "Region": region,
+                "Status": "CURRENT",
+                "ParameterOverrides": [
+                    {"ParameterKey": "CidrBlock", "ParameterValue": "10.0.0.0/24"}
+                ],
+            }
+        },
+        {
+            "StackSetName": stackset_name,
+            "StackInstanceAccount": account_id,
+            "StackInstanceRegion": region,
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(dict(step_function_input), {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response == dict(step_function_input, stackset_instance_unchanged=True)
+    assert coordinator.acquire_stackset(stackset_name, "other-execution")
+
+
+def test_handler_batch_unchanged(lambda_module, monkeypatch):
+    """
+    Given a setup function input for a batched stackset, one existing account already having the parameters
+    When the handler is called
+    Then only the accounts to change are part of the planned operations
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "MAX_WORKERS", 1)
+    stackset_name = "vpc"
+    region = "eu-west-1"
+    accounts = ["111111111111", "222222222222", "333333333333"]
+    step_function_input = {"name": stackset_name, "accounts": accounts}
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {"Account": account_id, "Region": region, "Status": "CURRENT"}
+                for account_id in accounts[1:]
+            ]
+        },
+    )
+    for account_id, overrides in [
+        ("222222222222", []),
+        ("333333333333", [{"ParameterKey": "CidrBlock", "ParameterValue": "x"}]),
+    ]:
+        cloudformation.add_response(
+            "describe_stack_instance",
+            {
+                "StackInstance": {
+                    "Account": account_id,
+                    "Region": region,
+                    "Status": "CURRENT",
+                    "ParameterOverrides": overrides,
+                }
+            },
+        )
+    cloudformation.add_response(
+        "create_stack_instances", {"OperationId": "operation-id"}
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert response["stackset_instance_in_treatment"]["accounts"] == ["111111111111"]
+    assert response["stackset_operations_pending"] == [
+        {
+            "action": "update",
+            "accounts": ["333333333333"],
+            "regions": [region],
+            "rollback": [
+                {
+                    "action": "rollback",
+                    "accounts": ["333333333333"],
+                    "regions": [region],
+                    "parameters": {"CidrBlock": "x"},
+                }
+            ],
+        }
+    ]
+
+
+def test_handler_batch_plan_limit(lambda_module, monkeypatch):
+    """
+    Given a setup function input for a batched stackset with more stack instances than an invocation describes
+    When the handler is called
+    Then the accounts are planned by batches of at most as many stack instances, the first one being started
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "PLAN_MAX_STACK_INSTANCES", 4)
+    stackset_name = "vpc"
+    regions = ["eu-west-1", "us-east-1"]
+    accounts = ["111111111111", "222222222222", "333333333333"]
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": accounts,
+        "regions": regions,
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response("list_stack_instances", {"Summaries": []})
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": accounts[:2],
+            "ParameterOverrides": [],
+            "Regions": regions,
+            "OperationPreferences": CREATE_OPERATION_PREFERENCES,
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response["stackset_operations_pending"] == [
+        {"action": "plan", "accounts": accounts[2:], "regions": regions}
+    ]
+
+
+def test_handler_rollout(lambda_module):
+    """
+    Given a setup function input for a batched stackset with a progressive rollout and a canary account
+    When the handler is called
+    Then the canary account is created first at full concurrency, the other accounts being left to the next waves
+    """
+    # Given
+    stackset_name = "vpc"
+    accounts = ["%012d" % account for account in range(1, 8)]
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": accounts,
+        "max_concurrent_count": 1,
+        "rollout": {"canary_accounts": ["000000000004"]},
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response("list_stack_instances", {"Summaries": []})
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": ["000000000004"],
+            "ParameterOverrides": [],
+            "Regions": ["eu-west-1"],
+            "OperationPreferences": CREATE_OPERATION_PREFERENCES,
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert response["stackset_instance_in_treatment"]["accounts"] == ["000000000004"]
+    assert response["stackset_operations_pending"] == [
+        {
+            "action": "plan",
+            "wave": 1,
+            "accounts": ["000000000001"],
+            "regions": ["eu-west-1"],
+        },
+        {
+            "action": "plan",
+            "wave": 2,
+            "accounts": [
+                "000000000002",
+                "000000000003",
+                "000000000005",
+                "000000000006",
+                "000000000007",
+            ],
+            "regions": ["eu-west-1"],
+        },
+    ]
+
+
+def test_handler_rollout_unchanged_wave(lambda_module):
+    """
+    Given a setup function input for a rollout whose first wave already has the parameters
+    When the handler is called, then again for the pending waves
+    Then the first invocation only checks the first wave and keeps the next one pending, and the second one updates it
+    """
+    # Given
+    stackset_name = "vpc"
+    region = "eu-west-1"
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": ["111111111111", "222222222222"],
+        "parameters": {"CidrBlock": "10.0.0.0/24"},
+        "rollout": {},
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {"Account": account_id, "Region": region, "Status": "CURRENT"}
+                for account_id in ["111111111111", "222222222222"]
+            ]
+        },
+    )
+    for account_id, cidr_block in [
+        ("111111111111", "10.0.0.0/24"),
+        ("222222222222", "10.0.1.0/24"),
+    ]:
+        cloudformation.add_response(
+            "describe_stack_instance",
+            {
+                "StackInstance": {
+                    "Account": account_id,
+                    "Region": region,
+                    "Status": "CURRENT",
+                    "ParameterOverrides": [
+                        {"ParameterKey": "CidrBlock", "ParameterValue": cidr_block}
+                    ],
+                }
+            },
+            {
+                "StackSetName": stackset_name,
+                "StackInstanceAccount": account_id,
+                "StackInstanceRegion": region,
+            },
+        )
+    cloudformation.add_response(
+        "update_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": ["222222222222"],
+            "ParameterOverrides": [
+                {"ParameterKey": "CidrBlock", "ParameterValue": "10.0.0.0/24"}
+            ],
+            "Regions": [region],
+            "OperationPreferences": dict(
+                UPDATE_OPERATION_PREFERENCES, MaxConcurrentPercentage=100
+            ),
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(dict(step_function_input), {})
+    pending_response = lambda_module.lambda_handler(dict(response), {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response["stackset_instance_unchanged"] is True
+    assert response["stackset_operations_pending"] == [
+        {
+            "action": "plan",
+            "wave": 1,
+            "accounts": ["222222222222"],
+            "regions": [region],
+        }
+    ]
+    assert "stackset_instance_unchanged" not in pending_response
+    assert "stackset_operations_pending" not in pending_response
+    assert pending_response["stackset_instance_in_treatment"]["accounts"] == [
+        "222222222222"
+    ]
+
+
+def test_handler_multi_region(lambda_module):
+    """
+    Given a setup function input for a batched stackset deployed to several regions, one account having an instance in one of them
+    When the handler is called, then again for the pending operations
+    Then the accounts missing the same regions share an operation, and the regions of an operation are deployed in parallel
+    """
+    # Given
+    stackset_name = "vpc"
+    regions = ["eu-west-1", "us-east-1"]
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": ["111111111111", "222222222222"],
+        "regions": regions,
+        "max_concurrent_percentage": 50,
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {"Account": "111111111111", "Region": "eu-west-1", "Status": "OUTDATED"}
+            ]
+        },
+    )
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": ["111111111111"],
+            "ParameterOverrides": [],
+            "Regions": ["us-east-1"],
+            "OperationPreferences": dict(
+                CREATE_OPERATION_PREFERENCES, MaxConcurrentPercentage=50
+            ),
+        },
+    )
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id-2"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": ["222222222222"],
+            "ParameterOverrides": [],
+            "Regions": regions,
+            "OperationPreferences": dict(
+                CREATE_OPERATION_PREFERENCES, MaxConcurrentPercentage=50
+            ),
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    pending_response = lambda_module.lambda_handler(dict(response), {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response["stackset_instance_in_treatment"]["regions"] == ["us-east-1"]
+    assert response["stackset_operations_pending"] == [
+        {"action": "create", "accounts": ["222222222222"], "regions": regions},
+        {"action": "update", "accounts": ["111111111111"], "regions": ["eu-west-1"]},
+    ]
+    assert pending_response["stackset_instance_in_treatment"] == {
+        "name": stackset_name,
+        "operation_id": "operation-id-2",
+        "accounts": ["222222222222"],
+        "regions": regions,
+    }
+    assert pending_response["wait_seconds"] == 11
+
+
+def test_handler_organizational_units(lambda_module):
+    """
+    Given a setup function input for a service-managed stackset targeting an organizational unit already deployed in one of its regions
+    When the handler is called as delegated administrator
+    Then the organizational unit is created in the other region with a single operation, and its update is kept pending
+    """
+    # Given
+    stackset_name = "baseline"
+    organizational_unit = "ou-abcd-11111111"
+    step_function_input = {
+        "name": stackset_name,
+        "regions": ["eu-west-1", "us-east-1"],
+        "call_as": "DELEGATED_ADMIN",
+        "deployment_targets": {"organizational_units": [organizational_unit]},
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {
+                    "Account": "111111111111",
+                    "Region": "eu-west-1",
+                    "Status": "CURRENT",
+                    "OrganizationalUnitId": organizational_unit,
+                }
+            ]
+        },
+        {"StackSetName": stackset_name, "CallAs": "DELEGATED_ADMIN"},
+    )
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "DeploymentTargets": {"OrganizationalUnitIds": [organizational_unit]},
+            "ParameterOverrides": [],
+            "Regions": ["us-east-1"],
+            "OperationPreferences": CREATE_OPERATION_PREFERENCES,
+            "CallAs": "DELEGATED_ADMIN",
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response["stackset_instance_in_treatment"] == {
+        "name": stackset_name,
+        "operation_id": "operation-id",
+        "organizational_units": [organizational_unit],
+        "regions": ["us-east-1"],
+        "call_as": "DELEGATED_ADMIN",
+    }
+    assert response["stackset_operations_pending"] == [
+        {
+            "action": "update",
+            "deployment_targets": {"OrganizationalUnitIds": [organizational_unit]},
+            "regions": ["eu-west-1"],
+        }
+    ]
+
+
+def test_handler_offloaded_plan(lambda_module):
+    """
+    Given a setup function input referencing its stackset in an offloaded plan
+    When the handler is called
+    Then only the line of the stackset is read, and the returned state keeps the reference instead of the stackset
+    """
+    # Given
+    stackset_name = "vpc-offloaded"
+    account_id = "123456789876"
+    line = (
+        json.dumps(
+            {
+                "name": stackset_name,
+                "parameters": {"CidrBlock": "10.0.0.0/24"},
+                "account": account_id,
+            }
+        )
+        + "\n"
+    ).encode()
+    plan = {
+        "bucket": "bucket",
+        "key": "plan.jsonl",
+        "range": [100, 100 + len(line) - 1],
+    }
+    step_function_input = {"name": stackset_name, "plan": plan}
+    ## S3 mock configuration
+    s3 = Stubber(lambda_module.payloads.s3)
+    s3.add_response(
+        "get_object",
+        {"Body": StreamingBody(io.BytesIO(line), len(line))},
+        {
+            "Bucket": "bucket",
+            "Key": "plan.jsonl",
+            "Range": "bytes=100-" + str(100 + len(line) - 1),
+        },
+    )
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances", {"Summaries": []}, {"StackSetName": stackset_name}
+    )
+    cloudformation.add_response(
+        "create_stack_instances",
+        {"OperationId": "operation-id"},
+        {
+            "StackSetName": stackset_name,
+            "Accounts": [account_id],
+            "ParameterOverrides": [
+                {"ParameterKey": "CidrBlock", "ParameterValue": "10.0.0.0/24"}
+            ],
+            "Regions": ["eu-west-1"],
+            "OperationPreferences": CREATE_OPERATION_PREFERENCES,
+        },
+    )
+    s3.activate()
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    s3.deactivate()
+    cloudformation.deactivate()
+    # Then
+    s3.assert_no_pending_responses()
+    assert response == {
+        "name": stackset_name,
+        "plan": plan,
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "account_id": account_id,
+        },
+        "wait_seconds": 10,
+    }
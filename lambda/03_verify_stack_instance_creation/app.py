@@ -15,82 +15,582 @@
 
 import json
 import os
-from random import randrange
-import time
 
-import boto3
+from stackset_orchestration import (
+    clients,
+    coordination,
+    logs,
+    metrics,
+    payloads,
+    polling,
+    retry,
+    targets,
+)
 
-cloudformation = boto3.client("cloudformation")
+cloudformation = clients.lazy_client("cloudformation", coordination.throttle_client)
 REGION = os.environ["AWS_REGION"]
 
+OPERATION_IN_PROGRESS_STATUSES = ["QUEUED", "RUNNING", "STOPPING"]
+
+# Outcomes of stack instances and operation results
+READY = "ready"
+IN_PROGRESS = "in_progress"
+SKIPPED = "skipped"
+RETRYABLE = "retryable"
+TERMINAL = "terminal"
+
+# DetailedStatus of stack instances, or Status of operation results, by outcome
+FAILED_STATUSES = ["FAILED", "FAILED_IMPORT", "INOPERABLE"]
+CANCELLED_STATUSES = ["CANCELLED"]
+SKIPPED_STATUSES = ["SKIPPED_SUSPENDED_ACCOUNT"]
+# Failures caused by the service rather than by the template, which another operation may fix
+RETRYABLE_REASONS = [
+    "Rate exceeded",
+    "Throttling",
+    "InternalFailure",
+    "ServiceUnavailable",
+]
+# Operations run again after retryable failures, before they fail the execution
+RETRYABLE_MAX_ATTEMPTS = int(os.getenv("RETRYABLE_MAX_ATTEMPTS", "2"))
+# Failed instances kept in the state, the message lists all of them
+FAILURE_MAX_INSTANCES = int(os.getenv("FAILURE_MAX_INSTANCES", "20"))
+
 
 class StacksetCreationError(Exception):
-    pass
+    def __init__(self, failure):
+        super().__init__(failure["message"])
+        self.failure = failure
+
+
+def classify(status, reason=""):
+    # Outcome of a DetailedStatus or operation result Status
+    if status in FAILED_STATUSES:
+        if any(marker in reason for marker in RETRYABLE_REASONS):
+            return RETRYABLE
+        return TERMINAL
+    if status in CANCELLED_STATUSES:
+        return RETRYABLE
+    if status in SKIPPED_STATUSES:
+        return SKIPPED
+    if status == "SUCCEEDED":
+        return READY
+    return IN_PROGRESS
+
+
+def classify_stack_instance(stackset_instance):
+    status = stackset_instance["Status"]
+    reason = stackset_instance.get("StatusReason", "")
+    if status == "INOPERABLE":
+        return TERMINAL
+    if "StackInstanceStatus" in stackset_instance:
+        outcome = classify(
+            stackset_instance["StackInstanceStatus"]["DetailedStatus"], reason
+        )
+        # A succeeded instance still has to catch up with its StackSet
+        if outcome == READY and status != "CURRENT":
+            return IN_PROGRESS
+        return outcome
+    # Without a detailed status, an outdated instance with an error has failed
+    if status == "OUTDATED" and "Error" in reason:
+        return classify("FAILED", reason)
+    return READY if status == "CURRENT" else IN_PROGRESS
+
+
+def failed_instance(summary):
+    # Machine-readable description of a failed stack instance or operation result
+    instance = {
+        "account": summary.get("Account"),
+        "region": summary.get("Region"),
+        "status": summary.get("StackInstanceStatus", {}).get(
+            "DetailedStatus", summary["Status"]
+        ),
+        "status_reason": summary.get("StatusReason", ""),
+    }
+    if summary.get("OrganizationalUnitId"):
+        instance["organizational_unit"] = summary["OrganizationalUnitId"]
+    return instance
+
+
+def format_result(result):
+    instance = failed_instance(result)
+    return (
+        str(instance["account"])
+        + "/"
+        + str(instance["region"])
+        + ": "
+        + instance["status"]
+        + " "
+        + instance["status_reason"]
+    )
+
+
+def failure(outcome, summaries, message=None, reason=None):
+    instances = [failed_instance(summary) for summary in summaries]
+    return {
+        "outcome": outcome,
+        "reason": reason or instances[0]["status"],
+        "message": message or "; ".join(map(format_result, summaries)),
+        "failed_instances": len(instances),
+        "instances": instances[:FAILURE_MAX_INSTANCES],
+    }
+
+
+def check_outcomes(summaries, outcomes, message=None):
+    # Fail fast on terminal failures, and on retryable ones once nothing is in progress
+    for outcome in [TERMINAL, RETRYABLE]:
+        failed = [
+            summary
+            for summary, summary_outcome in zip(summaries, outcomes)
+            if summary_outcome == outcome
+        ]
+        if failed and (outcome == TERMINAL or IN_PROGRESS not in outcomes):
+            raise StacksetCreationError(
+                failure(outcome, failed, message and message(failed))
+            )
 
 
 def check_stackset_instance_for_errors(stackset_instance):
+    check_outcomes([stackset_instance], [classify_stack_instance(stackset_instance)])
 
-    if "StatusReason" in stackset_instance:
-        stackset_instance_status = stackset_instance["Status"]
-        stackset_instance_status_reason = stackset_instance["StatusReason"]
 
-        # Raise exception if there is an error while creating the stackset instance
-        if (
-            stackset_instance_status == "OUTDATED"
-            and "Error" in stackset_instance_status_reason
-        ):
-            raise StacksetCreationError(stackset_instance_status_reason)
+def list_stackset_instances(
+    stackset_name, instances, detailed_status=None, call_as_arguments=None
+):
+    # Get the summaries of the (account, region) instances of a StackSet with a
+    # single paginated scan, narrowed to the account or region they all share
+    accounts = set(account_id for account_id, region in instances)
+    regions = set(region for account_id, region in instances)
+    arguments = dict(call_as_arguments or {})
+    if len(accounts) == 1:
+        arguments["StackInstanceAccount"] = next(iter(accounts))
+    if len(regions) == 1:
+        arguments["StackInstanceRegion"] = next(iter(regions))
+    if detailed_status:
+        arguments["Filters"] = [{"Name": "DETAILED_STATUS", "Values": detailed_status}]
+    summaries = {}
+    for page in retry.paginate(
+        cloudformation.list_stack_instances, StackSetName=stackset_name, **arguments
+    ):
+        for summary in page["Summaries"]:
+            instance = (summary["Account"], summary["Region"])
+            if instance in instances:
+                summaries[instance] = summary
+    return summaries
 
 
 def stackset_instance_ready(stackset_name, account_id, region):
+    return stackset_instances_ready(stackset_name, [account_id], [region])
 
-    # Add jitter
-    time.sleep(randrange(10, 20))
-    # Get stackset instance information
-    stackset_instance = cloudformation.list_stack_instances(
+
+def stackset_instances_ready(stackset_name, account_ids, regions):
+
+    # Get the stackset instances of every account and region of the batch with a single paginated call
+    instances = set(
+        (account_id, region) for account_id in account_ids for region in regions
+    )
+    stackset_instances = list_stackset_instances(stackset_name, instances)
+    logs.debug("Recovered stack instances", summaries=list(stackset_instances.values()))
+
+    # Check for errors in every stackset instance creation, missing instances being in progress
+    summaries = list(stackset_instances.values())
+    outcomes = [classify_stack_instance(summary) for summary in summaries]
+    if len(stackset_instances) < len(instances):
+        outcomes.append(IN_PROGRESS)
+    check_outcomes(summaries, outcomes)
+
+    return all(outcome in [READY, SKIPPED] for outcome in outcomes)
+
+
+def stack_instance_result(stack_instance, summary):
+    # Readiness of a stack instance of a batch verification, failures being
+    # reported per instance instead of failing the whole batch
+    result = dict(stack_instance, found=summary is not None, ready=False)
+    if summary is None:
+        return result
+    result["status"] = summary["Status"]
+    if "StackInstanceStatus" in summary:
+        result["detailed_status"] = summary["StackInstanceStatus"]["DetailedStatus"]
+    result["outcome"] = classify_stack_instance(summary)
+    try:
+        check_stackset_instance_for_errors(summary)
+    except StacksetCreationError as e:
+        result["error"] = str(e)
+        return result
+    result["ready"] = result["outcome"] == READY
+    return result
+
+
+def verify_stack_instances(stack_instances, detailed_status=None):
+    # Verify many stack instances at once, with a single paginated scan per
+    # StackSet instead of a call per instance
+    stack_instances = [
+        dict(
+            stack_instance,
+            account_id=str(stack_instance["account_id"]),
+            region=stack_instance.get("region", REGION),
+        )
+        for stack_instance in stack_instances
+    ]
+    stacksets = {}
+    for stack_instance in stack_instances:
+        stackset = (stack_instance["name"], stack_instance.get("call_as"))
+        stacksets.setdefault(stackset, set()).add(
+            (stack_instance["account_id"], stack_instance["region"])
+        )
+    summaries = {
+        (stackset_name, call_as): list_stackset_instances(
+            stackset_name,
+            instances,
+            detailed_status,
+            targets.call_as_arguments({"call_as": call_as} if call_as else {}),
+        )
+        for (stackset_name, call_as), instances in stacksets.items()
+    }
+    return [
+        stack_instance_result(
+            stack_instance,
+            summaries[(stack_instance["name"], stack_instance.get("call_as"))].get(
+                (stack_instance["account_id"], stack_instance["region"])
+            ),
+        )
+        for stack_instance in stack_instances
+    ]
+
+
+def stackset_operation_results(stackset_name, operation_id, call_as_arguments):
+    # Get the result of every account and region of the operation with a single paginated call
+    results = []
+    for page in retry.paginate(
+        cloudformation.list_stack_set_operation_results,
+        StackSetName=stackset_name,
+        OperationId=operation_id,
+        **call_as_arguments
+    ):
+        results.extend(page["Summaries"])
+    return results
+
+
+def results_by_organizational_unit(results):
+    # Count the results of the accounts of each organizational unit by status
+    summary = {}
+    for result in results:
+        statuses = summary.setdefault(result["OrganizationalUnitId"], {})
+        statuses[result["Status"]] = statuses.get(result["Status"], 0) + 1
+    return summary
+
+
+def results_message(failed_results):
+    if not all("OrganizationalUnitId" in result for result in failed_results):
+        return "; ".join(map(format_result, failed_results))
+    # Group the failed accounts of organizational units by unit
+    failures = {}
+    for result in failed_results:
+        failures.setdefault(result["OrganizationalUnitId"], []).append(
+            format_result(result)
+        )
+    return "; ".join(
+        organizational_unit + " (" + ", ".join(unit_failures) + ")"
+        for organizational_unit, unit_failures in failures.items()
+    )
+
+
+def check_stackset_operation_results_for_errors(results):
+
+    # Raise exception if the operation failed on any account
+    check_outcomes(
+        results,
+        [
+            classify(result["Status"], result.get("StatusReason", ""))
+            for result in results
+        ],
+        results_message,
+    )
+
+
+def stackset_operation_ready(stackset_name, operation_id, batched, call_as_arguments):
+
+    # Get stackset operation information, a single call whatever the number of instances
+    stackset_operation = retry.call(
+        cloudformation.describe_stack_set_operation,
         StackSetName=stackset_name,
-        StackInstanceAccount=account_id,
-        StackInstanceRegion=region,
+        OperationId=operation_id,
+        **call_as_arguments
+    )["StackSetOperation"]
+    stackset_operation_status = stackset_operation["Status"]
+    logs.info(
+        "StackSet operation status",
+        sampled=stackset_operation_status in OPERATION_IN_PROGRESS_STATUSES,
+        operation_id=operation_id,
+        status=stackset_operation_status,
+    )
+
+    if stackset_operation_status in OPERATION_IN_PROGRESS_STATUSES:
+        return False
+
+    # Check the per-account results of batched or failed operations, a stopped
+    # operation failing whatever its results
+    if stackset_operation_status != "STOPPED" and (
+        batched or stackset_operation_status != "SUCCEEDED"
+    ):
+        results = stackset_operation_results(
+            stackset_name, operation_id, call_as_arguments
+        )
+        if any("OrganizationalUnitId" in result for result in results):
+            logs.info(
+                "Results by organizational unit",
+                results=results_by_organizational_unit(results),
+            )
+        check_stackset_operation_results_for_errors(results)
+    if stackset_operation_status != "SUCCEEDED":
+        raise StacksetCreationError(
+            failure(
+                TERMINAL,
+                [],
+                "StackSet operation "
+                + operation_id
+                + " "
+                + stackset_operation_status
+                + " "
+                + stackset_operation.get("StatusReason", ""),
+                "OPERATION_" + stackset_operation_status,
+            )
+        )
+
+    return True
+
+
+def get_regions(stackset_instance):
+    return stackset_instance["regions"] if "regions" in stackset_instance else [REGION]
+
+
+def count_stack_instances(stackset_instance):
+    # Organizational units count as one target, their accounts being unknown here
+    if "organizational_units" in stackset_instance:
+        target_count = len(stackset_instance["organizational_units"])
+    elif "accounts" in stackset_instance:
+        target_count = len(stackset_instance["accounts"])
+    else:
+        target_count = 1
+    return target_count * len(get_regions(stackset_instance))
+
+
+def release_stackset(stackset_instance):
+    # Let other executions operate on the StackSet once the operation is over
+    if "lease_owner" in stackset_instance:
+        coordination.coordinator().release_stackset(
+            stackset_instance["name"], stackset_instance.pop("lease_owner")
+        )
+
+
+def renew_stackset(stackset_instance):
+    # Keep the StackSet for as long as the operation runs
+    if (
+        "lease_owner" in stackset_instance
+        and not coordination.coordinator().acquire_stackset(
+            stackset_instance["name"], stackset_instance["lease_owner"]
+        )
+    ):
+        logs.warning("Lost the lease of the StackSet")
+
+
+def merge_rollback_operations(rollback_operations):
+    # Restore the instances sharing their previous parameters and regions with
+    # a single operation, however many operations updated them
+    accounts_by_parameters = {}
+    for operation in rollback_operations:
+        accounts = accounts_by_parameters.setdefault(
+            (
+                json.dumps(operation["parameters"], sort_keys=True),
+                tuple(operation["regions"]),
+            ),
+            [],
+        )
+        accounts.extend(
+            account_id
+            for account_id in operation["accounts"]
+            if account_id not in accounts
+        )
+    return [
+        {
+            "action": "rollback",
+            "accounts": accounts,
+            "regions": list(regions),
+            "parameters": json.loads(parameters),
+        }
+        for (parameters, regions), accounts in accounts_by_parameters.items()
+    ]
+
+
+def rollback_event(event, failure):
+    # Restore the parameters the updated instances had, the failure failing the
+    # execution once they are back
+    operations = merge_rollback_operations(event.pop("stackset_rollback"))
+    logs.error(
+        "StackSet operation failed, rolling back the updated stack instances",
+        failure=failure,
+        rollback_operations=len(operations),
     )
-    print("Recovered stacket instance: ")
-    print(stackset_instance)
+    metrics.count("RollbacksStarted")
+    event["stackset_instance_rollback"] = failure
+    event["stackset_operations_pending"] = operations
+    # The failed operation is over, the rollback goes on like a pending operation
+    event["stackset_instance_ready"] = True
+    return payloads.compact(event)
 
-    stackset_instance = stackset_instance["Summaries"][0]
 
-    # Check for errors in stackset instance creation
-    check_stackset_instance_for_errors(stackset_instance)
+def rolled_back_failure(event, rollback_failure=None):
+    # Report the failure which started the rollback, and how the rollback ended
+    failure = event.pop("stackset_instance_rollback")
+    recovery_seconds = failure.pop("recovery_seconds", 0)
+    if rollback_failure is not None:
+        logs.error("StackSet rollback failed", failure=rollback_failure)
+        metrics.count("RollbacksFailed")
+        return dict(
+            failure,
+            rolled_back=False,
+            rollback_failure=rollback_failure,
+            message=failure["message"]
+            + " (rollback failed: "
+            + rollback_failure["message"]
+            + ")",
+        )
+    logs.warning("StackSet rollback succeeded", recovery_seconds=recovery_seconds)
+    metrics.emit(
+        {
+            "RollbacksSucceeded": (1, "Count"),
+            "TimeToRecovery": (recovery_seconds, "Seconds"),
+        }
+    )
+    return dict(
+        failure,
+        rolled_back=True,
+        message=failure["message"] + " (rolled back to the previous parameters)",
+    )
+
+
+def failed_event(event, failure):
+    # Run the operation again after a retryable failure, roll back the updated
+    # instances, or put the failure in the state for the state machine to fail
+    # the execution without waiting
+    stackset_instance = event["stackset_instance_in_treatment"]
+    release_stackset(stackset_instance)
+    metrics.count("OperationsFailed", Outcome=failure["outcome"])
+    attempts = event.get("stackset_operation_attempts", 0)
+    event.pop("stackset_instance_ready", None)
+    event.pop("wait_seconds", None)
+    if "stackset_instance_rollback" in event:
+        event["stackset_instance_failure"] = rolled_back_failure(event, failure)
+    elif failure["outcome"] == RETRYABLE and attempts < RETRYABLE_MAX_ATTEMPTS:
+        logs.warning("StackSet operation failed, running it again", failure=failure)
+        event["stackset_operation_attempts"] = attempts + 1
+        event["stackset_instance_retry"] = True
+        # The operation is planned again, skipping the instances already up to date
+        event.pop("stackset_operations_pending", None)
+    elif "stackset_rollback" in event:
+        return rollback_event(event, failure)
+    else:
+        logs.error("StackSet operation failed", failure=failure)
+        event["stackset_instance_failure"] = failure
+    return payloads.compact(event)
 
-    stackset_instance_status = stackset_instance["Status"]
 
-    return True if stackset_instance_status == "CURRENT" else False
+def verify_stack_instances_event(event):
+    # Batch mode, returning the readiness of every stack instance of the event
+    results = verify_stack_instances(
+        event["stack_instances"], event.get("detailed_status")
+    )
+    logs.info(
+        "Verified stack instances",
+        stack_instances=len(results),
+        ready=sum(1 for result in results if result["ready"]),
+        failed=sum(1 for result in results if "error" in result),
+    )
+    return dict(
+        event,
+        stack_instances=results,
+        stack_instances_ready=all(result["ready"] for result in results),
+    )
 
 
 def lambda_handler(event, context):
-    # Wait for stackset instance creation
-    print("Waiting for stackset instance to be processed...")
-    time.sleep(30)
+    if "stack_instances" in event:
+        return verify_stack_instances_event(event)
+
+    # The state machine has already waited for the stackset instance to be processed
     # Get stackset instance information
-    print("Received event: " + json.dumps(event, indent=2))
+    event = payloads.load(event)
     stackset_instance = event["stackset_instance_in_treatment"]
     terminate_stack_instance = event["terminate"] if "terminate" in event else False
     stackset_name = stackset_instance["name"]
-    account_id = str(stackset_instance["account_id"])
-    print("StackSet instance: " + json.dumps(stackset_instance, indent=2))
-    print("StackSet Name: " + stackset_name)
-    print("AccountId: " + account_id)
+    metrics.set_properties(
+        StackSet=stackset_name, Account=stackset_instance.get("account_id")
+    )
+    logs.debug("Received event", event=event)
+    metrics.count("VerifyIterations")
 
     # Update stackset instance status, or fail the pipeline if there is an error
     try:
-        event["stackset_instance_ready"] = (
-            True
-            if terminate_stack_instance
-            else stackset_instance_ready(stackset_name, account_id, REGION)
-        )
+        if "operation_id" in stackset_instance:
+            event["stackset_instance_ready"] = stackset_operation_ready(
+                stackset_name,
+                stackset_instance["operation_id"],
+                count_stack_instances(stackset_instance) > 1
+                or "organizational_units" in stackset_instance,
+                targets.call_as_arguments(stackset_instance),
+            )
+        elif terminate_stack_instance:
+            event["stackset_instance_ready"] = True
+        elif count_stack_instances(stackset_instance) > 1:
+            account_ids = (
+                [str(account_id) for account_id in stackset_instance["accounts"]]
+                if "accounts" in stackset_instance
+                else [str(stackset_instance["account_id"])]
+            )
+            event["stackset_instance_ready"] = stackset_instances_ready(
+                stackset_name, account_ids, get_regions(stackset_instance)
+            )
+        else:
+            account_id = str(stackset_instance["account_id"])
+            event["stackset_instance_ready"] = stackset_instance_ready(
+                stackset_name, account_id, REGION
+            )
     except StacksetCreationError as e:
-        print("StacksetCreationError")
-        print(e)
-        raise e
+        return failed_event(event, e.failure)
+
+    # Let the state machine wait before verifying again, instead of sleeping here
+    if event["stackset_instance_ready"]:
+        release_stackset(stackset_instance)
+        time_to_ready = stackset_instance.get("waited_seconds", 0) + event.get(
+            "wait_seconds", 0
+        )
+        metrics.emit(
+            {
+                "OperationsSucceeded": (1, "Count"),
+                "TimeToReady": (time_to_ready, "Seconds"),
+            }
+        )
+        event.pop("wait_seconds", None)
+        # The next pending operation gets its own attempts
+        event.pop("stackset_operation_attempts", None)
+        # Fail the execution with its failure once its rollback is done
+        if "stackset_instance_rollback" in event:
+            rollback = event["stackset_instance_rollback"]
+            rollback["recovery_seconds"] = (
+                rollback.get("recovery_seconds", 0) + time_to_ready
+            )
+            if "stackset_operations_pending" not in event:
+                event["stackset_instance_failure"] = rolled_back_failure(event)
+    else:
+        renew_stackset(stackset_instance)
+        waited_seconds = stackset_instance.get("waited_seconds", 0) + event.get(
+            "wait_seconds", 0
+        )
+        stackset_instance["waited_seconds"] = waited_seconds
+        event["wait_seconds"] = polling.wait_seconds(
+            waited_seconds, count_stack_instances(stackset_instance)
+        )
 
-    print("Outgoing event: " + json.dumps(event, indent=2))
+    event = payloads.compact(event)
+    logs.debug("Outgoing event", event=event)
 
     return event
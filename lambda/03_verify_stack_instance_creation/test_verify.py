@@ -1,3 +1,6 @@
+from datetime import datetime
+import json
+
 import pytest
 
 from botocore.stub import Stubber
@@ -18,14 +21,13 @@ lambda_module = pytest.fixture(
 )(lambda_module)
 
 
-def test_verify_create_update_not_ready(lambda_module, monkeypatch):
+def test_verify_create_update_not_ready(lambda_module):
     """
     Given a setup function input for verifying stack instances, when the stackset instance is not ready
     When the handler is called
-    Then handler return a dict with the stackset_instance_ready variable set to False
+    Then handler return a dict with the stackset_instance_ready variable set to False, and a longer wait before the next verification
     """
     # Given
-    monkeypatch.setattr(lambda_module.time, "sleep", lambda _: None)
     stackset_name = "vpc"
     account_id = "123456789876"
     region = "eu-west-1"
@@ -38,6 +40,7 @@ def test_verify_create_update_not_ready(lambda_module, monkeypatch):
             "name": stackset_name,
             "account_id": account_id,
         },
+        "wait_seconds": 10,
     }
     step_function_expected_output = {
         "name": stackset_name,
@@ -46,8 +49,10 @@ def test_verify_create_update_not_ready(lambda_module, monkeypatch):
         "stackset_instance_in_treatment": {
             "name": stackset_name,
             "account_id": account_id,
+            "waited_seconds": 10,
         },
         "stackset_instance_ready": False,
+        "wait_seconds": 12,
     }
     cloudformation_list_expected_params = {
         "StackSetName": stackset_name,
@@ -62,7 +67,7 @@ def test_verify_create_update_not_ready(lambda_module, monkeypatch):
                 "Account": account_id,
                 "Status": "OUTDATED",
                 "StatusReason": "StatusReason",
-                "StackInstanceStatus": {"DetailedStatus": "SUCCESS"},
+                "StackInstanceStatus": {"DetailedStatus": "SUCCEEDED"},
                 "OrganizationalUnitId": "",
                 "DriftStatus": "NOT_CHECKED",
             }
@@ -83,14 +88,13 @@ def test_verify_create_update_not_ready(lambda_module, monkeypatch):
     assert response == step_function_expected_output
 
 
-def test_verify_create_update_ready(lambda_module, monkeypatch):
+def test_verify_create_update_ready(lambda_module):
     """
     Given a setup function input for verifying stack instances, when the stackset instance is ready
     When the handler is called
     Then handler return a dict with the stackset_instance_ready variable set to True
     """
     # Given
-    monkeypatch.setattr(lambda_module.time, "sleep", lambda _: None)
     stackset_name = "vpc"
     account_id = "123456789876"
     region = "eu-west-1"
@@ -127,7 +131,7 @@ def test_verify_create_update_ready(lambda_module, monkeypatch):
                 "Account": account_id,
                 "Status": "CURRENT",
                 "StatusReason": "StatusReason",
-                "StackInstanceStatus": {"DetailedStatus": "SUCCESS"},
+                "StackInstanceStatus": {"DetailedStatus": "SUCCEEDED"},
                 "OrganizationalUnitId": "",
                 "DriftStatus": "NOT_CHECKED",
             }
@@ -148,14 +152,13 @@ def test_verify_create_update_ready(lambda_module, monkeypatch):
     assert response == step_function_expected_output
 
 
-def test_verify_delete(lambda_module, monkeypatch):
+def test_verify_delete(lambda_module):
     """
     Given a setup function input for verifying the deletion stack instances
     When the handler is called
     Then handler return a dict with the stackset_instance_ready variable set to True
     """
     # Given
-    monkeypatch.setattr(lambda_module.time, "sleep", lambda _: None)
     stackset_name = "vpc"
     account_id = "123456789876"
     region = "eu-west-1"
@@ -194,7 +197,7 @@ def test_verify_delete(lambda_module, monkeypatch):
                 "Account": account_id,
                 "Status": "OUTDATED",
                 "StatusReason": "StatusReason",
-                "StackInstanceStatus": {"DetailedStatus": "SUCCESS"},
+                "StackInstanceStatus": {"DetailedStatus": "SUCCEEDED"},
                 "OrganizationalUnitId": "",
                 "DriftStatus": "NOT_CHECKED",
             }
@@ -213,3 +216,943 @@ def test_verify_delete(lambda_module, monkeypatch):
     cloudformation.deactivate()
     # Then
     assert response == step_function_expected_output
+
+
+def test_verify_batch(lambda_module):
+    """
+    Given a setup function input for verifying the stack instances of several accounts, without operation id
+    When the handler is called
+    Then the stack instances are listed once, and the batch is ready only when every instance is CURRENT
+    """
+    # Given
+    stackset_name = "vpc"
+    region = "eu-west-1"
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": ["111111111111", "222222222222"],
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "accounts": ["111111111111", "222222222222"],
+        },
+    }
+    cloudformation_list_expected_params = {
+        "StackSetName": stackset_name,
+        "StackInstanceRegion": region,
+    }
+
+    def summary(account_id, status):
+        return {
+            "StackSetId": "vpc:stackset-id",
+            "Region": region,
+            "Account": account_id,
+            "Status": status,
+        }
+
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                summary("111111111111", "CURRENT"),
+                summary("222222222222", "OUTDATED"),
+                summary("444444444444", "OUTDATED"),
+            ]
+        },
+        cloudformation_list_expected_params,
+    )
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                summary("111111111111", "CURRENT"),
+                summary("222222222222", "CURRENT"),
+                summary("444444444444", "OUTDATED"),
+            ]
+        },
+        cloudformation_list_expected_params,
+    )
+    cloudformation.activate()
+    # When
+    not_ready_response = lambda_module.lambda_handler(dict(step_function_input), {})
+    ready_response = lambda_module.lambda_handler(dict(step_function_input), {})
+    cloudformation.deactivate()
+    # Then
+    assert not_ready_response["stackset_instance_ready"] is False
+    assert ready_response["stackset_instance_ready"] is True
+
+
+def stackset_operation(status):
+    return {
+        "StackSetOperation": {
+            "OperationId": "operation-id",
+            "StackSetId": "vpc:stackset-id",
+            "Action": "CREATE",
+            "Status": status,
+            "CreationTimestamp": datetime(2010, 1, 1),
+        }
+    }
+
+
+def stackset_operation_result(
+    account_id, status, reason="StatusReason", region="eu-west-1"
+):
+    return {
+        "Account": account_id,
+        "Region": region,
+        "Status": status,
+        "StatusReason": reason,
+    }
+
+
+def test_verify_operation(lambda_module):
+    """
+    Given a setup function input for verifying a stackset operation
+    When the handler is called while the operation runs, then once it has succeeded
+    Then the operation is described once per call, and the stackset_instance_ready variable follows its status
+    """
+    # Given
+    stackset_name = "vpc"
+    step_function_input = {
+        "name": stackset_name,
+        "account": "123456789876",
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+        },
+    }
+    cloudformation_describe_expected_params = {
+        "StackSetName": stackset_name,
+        "OperationId": "operation-id",
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    for status in ["RUNNING", "SUCCEEDED"]:
+        cloudformation.add_response(
+            "describe_stack_set_operation",
+            stackset_operation(status),
+            cloudformation_describe_expected_params,
+        )
+    cloudformation.activate()
+    # When
+    running_response = lambda_module.lambda_handler(dict(step_function_input), {})
+    succeeded_response = lambda_module.lambda_handler(dict(step_function_input), {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert running_response["stackset_instance_ready"] is False
+    assert succeeded_response["stackset_instance_ready"] is True
+
+
+def test_verify_operation_failed(lambda_module):
+    """
+    Given a setup function input for verifying a stackset operation which failed
+    When the handler is called
+    Then a terminal failure with the reason of the failed account is put in the state
+    """
+    # Given
+    stackset_name = "vpc"
+    step_function_input = {
+        "name": stackset_name,
+        "account": "123456789876",
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+        },
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("FAILED")
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {
+            "Summaries": [
+                stackset_operation_result(
+                    "123456789876", "FAILED", "Resource CREATE_FAILED"
+                )
+            ]
+        },
+        {"StackSetName": stackset_name, "OperationId": "operation-id"},
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert "stackset_instance_ready" not in response
+    assert response["stackset_instance_failure"] == {
+        "outcome": "terminal",
+        "reason": "FAILED",
+        "message": "123456789876/eu-west-1: FAILED Resource CREATE_FAILED",
+        "failed_instances": 1,
+        "instances": [
+            {
+                "account": "123456789876",
+                "region": "eu-west-1",
+                "status": "FAILED",
+                "status_reason": "Resource CREATE_FAILED",
+            }
+        ],
+    }
+
+
+def test_verify_batch_operation(lambda_module):
+    """
+    Given a setup function input for verifying a batched stackset operation which was cancelled on some accounts
+    When the handler is called
+    Then the per-account results are listed, and the operation is planned again without the pending operations
+    """
+    # Given
+    stackset_name = "vpc"
+    step_function_input = {
+        "name": stackset_name,
+        "accounts": ["111111111111", "222222222222"],
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "accounts": ["111111111111", "222222222222"],
+        },
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("SUCCEEDED")
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {
+            "Summaries": [stackset_operation_result("111111111111", "SUCCEEDED")],
+            "NextToken": "token",
+        },
+        {"StackSetName": stackset_name, "OperationId": "operation-id"},
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {"Summaries": [stackset_operation_result("222222222222", "CANCELLED")]},
+        {
+            "StackSetName": stackset_name,
+            "OperationId": "operation-id",
+            "NextToken": "token",
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(
+        dict(step_function_input, stackset_operations_pending=[{"action": "update"}]),
+        {},
+    )
+    cloudformation.deactivate()
+    # Then
+    assert response["stackset_instance_retry"] is True
+    assert response["stackset_operation_attempts"] == 1
+    assert "stackset_operations_pending" not in response
+    assert "stackset_instance_failure" not in response
+
+
+def test_verify_operation_releases_stackset(lambda_module, monkeypatch):
+    """
+    Given a setup function input for verifying a stackset operation holding the StackSet lease
+    When the handler is called while the operation runs, then once it has succeeded
+    Then the lease is kept while the operation runs, and released once it is over
+    """
+    # Given
+    coordinator = lambda_module.coordination.Coordinator(
+        lambda_module.coordination.MemoryStore()
+    )
+    monkeypatch.setattr(lambda_module.coordination, "_coordinator", coordinator)
+    coordinator.acquire_stackset("vpc", "lease-owner")
+    step_function_input = {
+        "name": "vpc",
+        "account": "123456789876",
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+            "lease_owner": "lease-owner",
+        },
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    for status in ["RUNNING", "SUCCEEDED"]:
+        cloudformation.add_response(
+            "describe_stack_set_operation", stackset_operation(status)
+        )
+    cloudformation.activate()
+    # When
+    running_response = lambda_module.lambda_handler(step_function_input, {})
+    running_lease_free = coordinator.acquire_stackset("vpc", "other-execution")
+    succeeded_response = lambda_module.lambda_handler(running_response, {})
+    cloudformation.deactivate()
+    # Then
+    assert running_lease_free is False
+    assert "lease_owner" not in succeeded_response["stackset_instance_in_treatment"]
+    assert coordinator.acquire_stackset("vpc", "other-execution")
+
+
+def test_verify_multi_region_operation(lambda_module):
+    """
+    Given a setup function input for verifying a stackset operation on several regions of an account
+    When the handler is called once the operation is over
+    Then the results of every region are checked, and the failure of the failed region is put in the state
+    """
+    # Given
+    stackset_name = "vpc"
+    step_function_input = {
+        "name": stackset_name,
+        "account": "123456789876",
+        "regions": ["eu-west-1", "us-east-1"],
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+            "regions": ["eu-west-1", "us-east-1"],
+        },
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("SUCCEEDED")
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {
+            "Summaries": [
+                stackset_operation_result("123456789876", "SUCCEEDED"),
+                stackset_operation_result(
+                    "123456789876", "FAILED", "Quota exceeded", "us-east-1"
+                ),
+            ]
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    failure = response["stackset_instance_failure"]
+    assert failure["message"] == "123456789876/us-east-1: FAILED Quota exceeded"
+    assert [instance["region"] for instance in failure["instances"]] == ["us-east-1"]
+
+
+def test_verify_organizational_units_operation(lambda_module):
+    """
+    Given a setup function input for verifying a stackset operation on organizational units, as delegated administrator
+    When the handler is called once the operation is over, with failed accounts in one unit
+    Then the results are listed, and the failure groups the failed accounts by organizational unit
+    """
+    # Given
+    stackset_name = "baseline"
+    step_function_input = {
+        "name": stackset_name,
+        "stackset_instance_in_treatment": {
+            "name": stackset_name,
+            "operation_id": "operation-id",
+            "organizational_units": ["ou-abcd-11111111", "ou-abcd-22222222"],
+            "call_as": "DELEGATED_ADMIN",
+        },
+    }
+    results = [
+        dict(
+            stackset_operation_result("111111111111", "SUCCEEDED"),
+            **{"OrganizationalUnitId": "ou-abcd-11111111"}
+        ),
+        dict(
+            stackset_operation_result("222222222222", "FAILED", "Denied"),
+            **{"OrganizationalUnitId": "ou-abcd-22222222"}
+        ),
+        dict(
+            stackset_operation_result("333333333333", "FAILED", "Denied"),
+            **{"OrganizationalUnitId": "ou-abcd-22222222"}
+        ),
+    ]
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation",
+        stackset_operation("SUCCEEDED"),
+        {
+            "StackSetName": stackset_name,
+            "OperationId": "operation-id",
+            "CallAs": "DELEGATED_ADMIN",
+        },
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {"Summaries": results},
+        {
+            "StackSetName": stackset_name,
+            "OperationId": "operation-id",
+            "CallAs": "DELEGATED_ADMIN",
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert lambda_module.results_by_organizational_unit(results) == {
+        "ou-abcd-11111111": {"SUCCEEDED": 1},
+        "ou-abcd-22222222": {"FAILED": 2},
+    }
+    failure = response["stackset_instance_failure"]
+    assert failure["message"] == (
+        "ou-abcd-22222222 (222222222222/eu-west-1: FAILED Denied, "
+        "333333333333/eu-west-1: FAILED Denied)"
+    )
+    assert set(
+        instance["organizational_unit"] for instance in failure["instances"]
+    ) == {"ou-abcd-22222222"}
+
+
+def test_verify_operation_metrics(lambda_module, capsys):
+    """
+    Given a setup function input for verifying a stackset operation which has waited 40 seconds
+    When the handler is called once the operation has succeeded
+    Then the verify iteration, the API call, the outcome and the time to ready are emitted as metrics, tagged with the stackset and account without using them as dimensions
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "wait_seconds": 20,
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+            "waited_seconds": 20,
+        },
+    }
+    ## Cloudformation mock configuration
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation",
+        stackset_operation("SUCCEEDED"),
+        {"StackSetName": "vpc", "OperationId": "operation-id"},
+    )
+    cloudformation.activate()
+    capsys.readouterr()
+    # When
+    lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    lines = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if '"_aws"' in line
+    ]
+    metrics = {
+        metric["Name"]: line[metric["Name"]]
+        for line in lines
+        for metric in line["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    }
+    assert metrics["VerifyIterations"] == 1
+    assert metrics["ApiCalls"] == 1
+    assert metrics["OperationsSucceeded"] == 1
+    assert metrics["TimeToReady"] == 40
+    assert all(line["StackSet"] == "vpc" for line in lines)
+    assert all(line["Account"] == "123456789876" for line in lines)
+    assert not any(
+        {"StackSet", "Account"}
+        & set(line["_aws"]["CloudWatchMetrics"][0]["Dimensions"][0])
+        for line in lines
+    )
+
+
+def test_verify_stack_instances(lambda_module):
+    """
+    Given a batch of stack instances of two StackSets, one of them failed and one of them missing
+    When the handler is called
+    Then the stack instances of each StackSet are listed with a single paginated scan, and the readiness of every instance is returned
+    """
+    # Given
+    event = {
+        "stack_instances": [
+            {"name": "vpc", "account_id": "111111111111"},
+            {"name": "vpc", "account_id": 222222222222, "region": "us-east-1"},
+            {"name": "vpc", "account_id": "333333333333"},
+            {"name": "dns", "account_id": "111111111111", "call_as": "SELF"},
+        ]
+    }
+
+    def summary(account_id, region, status, reason=None):
+        result = {
+            "StackSetId": "stackset-id",
+            "Region": region,
+            "Account": account_id,
+            "Status": status,
+            "StackInstanceStatus": {
+                "DetailedStatus": "SUCCEEDED" if status == "CURRENT" else "FAILED"
+            },
+        }
+        if reason:
+            result["StatusReason"] = reason
+        return result
+
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                summary("111111111111", "eu-west-1", "CURRENT"),
+                summary("111111111111", "us-east-1", "CURRENT"),
+            ],
+            "NextToken": "token",
+        },
+        {"StackSetName": "vpc"},
+    )
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                summary("222222222222", "us-east-1", "OUTDATED", "Error: limit"),
+            ]
+        },
+        {"StackSetName": "vpc", "NextToken": "token"},
+    )
+    cloudformation.add_response(
+        "list_stack_instances",
+        {"Summaries": [summary("111111111111", "eu-west-1", "CURRENT")]},
+        {
+            "StackSetName": "dns",
+            "CallAs": "SELF",
+            "StackInstanceAccount": "111111111111",
+            "StackInstanceRegion": "eu-west-1",
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    cloudformation.deactivate()
+    # Then
+    cloudformation.assert_no_pending_responses()
+    assert response["stack_instances_ready"] is False
+    assert response["stack_instances"] == [
+        {
+            "name": "vpc",
+            "account_id": "111111111111",
+            "region": "eu-west-1",
+            "found": True,
+            "ready": True,
+            "status": "CURRENT",
+            "detailed_status": "SUCCEEDED",
+            "outcome": "ready",
+        },
+        {
+            "name": "vpc",
+            "account_id": "222222222222",
+            "region": "us-east-1",
+            "found": True,
+            "ready": False,
+            "status": "OUTDATED",
+            "detailed_status": "FAILED",
+            "outcome": "terminal",
+            "error": "222222222222/us-east-1: FAILED Error: limit",
+        },
+        {
+            "name": "vpc",
+            "account_id": "333333333333",
+            "region": "eu-west-1",
+            "found": False,
+            "ready": False,
+        },
+        {
+            "name": "dns",
+            "account_id": "111111111111",
+            "call_as": "SELF",
+            "region": "eu-west-1",
+            "found": True,
+            "ready": True,
+            "status": "CURRENT",
+            "detailed_status": "SUCCEEDED",
+            "outcome": "ready",
+        },
+    ]
+
+
+def test_verify_stack_instances_detailed_status(lambda_module):
+    """
+    Given a batch of stack instances and a detailed status
+    When the handler is called
+    Then the stack instances are listed with a DETAILED_STATUS filter, those which do not match being not found
+    """
+    # Given
+    event = {
+        "detailed_status": "RUNNING",
+        "stack_instances": [
+            {"name": "vpc", "account_id": "111111111111"},
+            {"name": "vpc", "account_id": "222222222222"},
+        ],
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {
+                    "Region": "eu-west-1",
+                    "Account": "222222222222",
+                    "Status": "OUTDATED",
+                    "StackInstanceStatus": {"DetailedStatus": "RUNNING"},
+                }
+            ]
+        },
+        {
+            "StackSetName": "vpc",
+            "StackInstanceRegion": "eu-west-1",
+            "Filters": [{"Name": "DETAILED_STATUS", "Values": "RUNNING"}],
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(event, {})
+    cloudformation.deactivate()
+    # Then
+    assert [
+        (result["account_id"], result["found"], result.get("detailed_status"))
+        for result in response["stack_instances"]
+    ] == [("111111111111", False, None), ("222222222222", True, "RUNNING")]
+    assert response["stack_instances_ready"] is False
+
+
+@pytest.mark.parametrize(
+    "status,detailed_status,reason,outcome",
+    [
+        ("CURRENT", "SUCCEEDED", "", "ready"),
+        ("OUTDATED", "SUCCEEDED", "", "in_progress"),
+        ("OUTDATED", "PENDING", "", "in_progress"),
+        ("OUTDATED", "RUNNING", "", "in_progress"),
+        ("OUTDATED", "FAILED", "Resource CREATE_FAILED", "terminal"),
+        ("OUTDATED", "FAILED", "Rate exceeded", "retryable"),
+        ("OUTDATED", "CANCELLED", "", "retryable"),
+        ("INOPERABLE", "INOPERABLE", "", "terminal"),
+        ("OUTDATED", "SKIPPED_SUSPENDED_ACCOUNT", "", "skipped"),
+        ("OUTDATED", None, "Error: limit exceeded", "terminal"),
+        ("OUTDATED", None, "User initiated stop", "in_progress"),
+        ("CURRENT", None, "", "ready"),
+    ],
+)
+def test_classify_stack_instance(
+    lambda_module, status, detailed_status, reason, outcome
+):
+    """
+    Given a stack instance summary
+    When it is classified
+    Then its outcome follows its DetailedStatus, or its status and reason without one
+    """
+    # Given
+    summary = {"Account": "111111111111", "Region": "eu-west-1", "Status": status}
+    if detailed_status:
+        summary["StackInstanceStatus"] = {"DetailedStatus": detailed_status}
+    if reason:
+        summary["StatusReason"] = reason
+    # When
+    result = lambda_module.classify_stack_instance(summary)
+    # Then
+    assert result == outcome
+
+
+def test_verify_batch_fails_fast(lambda_module):
+    """
+    Given a setup function input for verifying the stack instances of several accounts, one failed while another runs
+    When the handler is called
+    Then the failure is put in the state without waiting for the running instance
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "accounts": ["111111111111", "222222222222", "333333333333"],
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "accounts": ["111111111111", "222222222222", "333333333333"],
+        },
+    }
+
+    def summary(account_id, status, detailed_status):
+        return {
+            "Region": "eu-west-1",
+            "Account": account_id,
+            "Status": status,
+            "StatusReason": "Resource CREATE_FAILED",
+            "StackInstanceStatus": {"DetailedStatus": detailed_status},
+        }
+
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                summary("111111111111", "OUTDATED", "RUNNING"),
+                summary("222222222222", "OUTDATED", "FAILED"),
+                summary("333333333333", "OUTDATED", "SKIPPED_SUSPENDED_ACCOUNT"),
+            ]
+        },
+        {"StackSetName": "vpc", "StackInstanceRegion": "eu-west-1"},
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    failure = response["stackset_instance_failure"]
+    assert (failure["outcome"], failure["reason"]) == ("terminal", "FAILED")
+    assert [instance["account"] for instance in failure["instances"]] == [
+        "222222222222"
+    ]
+
+
+def test_verify_skipped_instances_ready(lambda_module):
+    """
+    Given a setup function input for verifying the stack instances of several accounts, one of them suspended
+    When the handler is called once the others are CURRENT
+    Then the batch is ready, the suspended account being skipped
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "accounts": ["111111111111", "222222222222"],
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "accounts": ["111111111111", "222222222222"],
+        },
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "list_stack_instances",
+        {
+            "Summaries": [
+                {
+                    "Region": "eu-west-1",
+                    "Account": "111111111111",
+                    "Status": "CURRENT",
+                    "StackInstanceStatus": {"DetailedStatus": "SUCCEEDED"},
+                },
+                {
+                    "Region": "eu-west-1",
+                    "Account": "222222222222",
+                    "Status": "OUTDATED",
+                    "StackInstanceStatus": {
+                        "DetailedStatus": "SKIPPED_SUSPENDED_ACCOUNT"
+                    },
+                },
+            ]
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert response["stackset_instance_ready"] is True
+
+
+def test_verify_retryable_attempts(lambda_module, monkeypatch):
+    """
+    Given a setup function input for verifying an operation which has already been run again after retryable failures
+    When the handler is called, the operation being cancelled again
+    Then the retryable failure is put in the state, to fail the execution
+    """
+    # Given
+    monkeypatch.setattr(lambda_module, "RETRYABLE_MAX_ATTEMPTS", 2)
+    step_function_input = {
+        "name": "vpc",
+        "account": "123456789876",
+        "stackset_operation_attempts": 2,
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+        },
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("FAILED")
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {"Summaries": [stackset_operation_result("123456789876", "CANCELLED")]},
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert "stackset_instance_retry" not in response
+    failure = response["stackset_instance_failure"]
+    assert (failure["outcome"], failure["reason"]) == ("retryable", "CANCELLED")
+
+
+def test_verify_retried_operation_ready(lambda_module):
+    """
+    Given a setup function input for verifying an operation run again after a retryable failure, with operations pending
+    When the handler is called once the operation has succeeded
+    Then its attempts are reset, so that the next pending operation gets its own attempts
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "accounts": ["123456789876", "123456789877"],
+        "stackset_operation_attempts": 1,
+        "stackset_operations_pending": [
+            {"action": "update", "accounts": ["123456789877"], "regions": ["eu-west-1"]}
+        ],
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "accounts": ["123456789876"],
+        },
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("SUCCEEDED")
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert response["stackset_instance_ready"] is True
+    assert "stackset_operation_attempts" not in response
+    assert "stackset_operations_pending" in response
+
+
+def test_verify_stopped_operation(lambda_module):
+    """
+    Given a setup function input for verifying a stackset operation which was stopped
+    When the handler is called
+    Then a terminal failure is put in the state, without listing the results
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "account": "123456789876",
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+        },
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("STOPPED")
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    failure = response["stackset_instance_failure"]
+    assert (failure["outcome"], failure["reason"]) == ("terminal", "OPERATION_STOPPED")
+    assert failure["message"].startswith("StackSet operation operation-id STOPPED")
+
+
+def test_verify_failed_update_rolls_back(lambda_module):
+    """
+    Given a setup function input for verifying an update of several accounts, which kept their previous parameters
+    When the handler is called, the update having failed in one account
+    Then a single operation restoring the previous parameters of every updated account is pending
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "accounts": ["111111111111", "222222222222"],
+        "stackset_rollback": [
+            {
+                "action": "rollback",
+                "accounts": ["111111111111"],
+                "regions": ["eu-west-1"],
+                "parameters": {"CidrBlock": "10.0.0.0/24"},
+            },
+            {
+                "action": "rollback",
+                "accounts": ["222222222222"],
+                "regions": ["eu-west-1"],
+                "parameters": {"CidrBlock": "10.0.0.0/24"},
+            },
+        ],
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "accounts": ["111111111111", "222222222222"],
+        },
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation("FAILED")
+    )
+    cloudformation.add_response(
+        "list_stack_set_operation_results",
+        {
+            "Summaries": [
+                stackset_operation_result("111111111111", "SUCCEEDED"),
+                stackset_operation_result("222222222222", "FAILED"),
+            ]
+        },
+    )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert "stackset_instance_failure" not in response
+    assert "stackset_rollback" not in response
+    assert response["stackset_instance_ready"] is True
+    assert response["stackset_instance_rollback"]["outcome"] == "terminal"
+    assert response["stackset_operations_pending"] == [
+        {
+            "action": "rollback",
+            "accounts": ["111111111111", "222222222222"],
+            "regions": ["eu-west-1"],
+            "parameters": {"CidrBlock": "10.0.0.0/24"},
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "operation_status,result_status,rolled_back",
+    [("SUCCEEDED", "SUCCEEDED", True), ("FAILED", "FAILED", False)],
+)
+def test_verify_rollback(lambda_module, operation_status, result_status, rolled_back):
+    """
+    Given a setup function input for verifying the rollback of a failed update
+    When the handler is called once the rollback is over
+    Then the failure of the update is put in the state, telling whether the instances were rolled back
+    """
+    # Given
+    step_function_input = {
+        "name": "vpc",
+        "account": "123456789876",
+        "stackset_instance_rollback": {
+            "outcome": "terminal",
+            "reason": "FAILED",
+            "message": "123456789876/eu-west-1: FAILED",
+            "recovery_seconds": 10,
+        },
+        "stackset_instance_in_treatment": {
+            "name": "vpc",
+            "operation_id": "operation-id",
+            "account_id": "123456789876",
+        },
+        "wait_seconds": 20,
+    }
+    cloudformation = Stubber(lambda_module.cloudformation)
+    cloudformation.add_response(
+        "describe_stack_set_operation", stackset_operation(operation_status)
+    )
+    if operation_status == "FAILED":
+        cloudformation.add_response(
+            "list_stack_set_operation_results",
+            {"Summaries": [stackset_operation_result("123456789876", result_status)]},
+        )
+    cloudformation.activate()
+    # When
+    response = lambda_module.lambda_handler(step_function_input, {})
+    cloudformation.deactivate()
+    # Then
+    assert "stackset_instance_rollback" not in response
+    failure = response["stackset_instance_failure"]
+    assert (failure["reason"], failure["rolled_back"]) == ("FAILED", rolled_back)
+    assert failure["message"].startswith("123456789876/eu-west-1: FAILED (")
+    assert "recovery_seconds" not in failure
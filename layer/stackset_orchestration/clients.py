@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Factory of the boto3 clients of the functions
+
+Clients are created on first use rather than at import, then cached for the
+warm invocations of the function. They share a botocore configuration with a
+connection pool sized for the thread pools of the functions, the adaptive
+retry mode and explicit timeouts, and every call is timed by the metrics
+module.
+"""
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from stackset_orchestration import metrics
+
+CLIENT_MAX_POOL_CONNECTIONS = int(os.getenv("CLIENT_MAX_POOL_CONNECTIONS", "25"))
+CLIENT_RETRY_MODE = os.getenv("CLIENT_RETRY_MODE", "adaptive")
+CLIENT_MAX_ATTEMPTS = int(os.getenv("CLIENT_MAX_ATTEMPTS", "3"))
+CLIENT_CONNECT_TIMEOUT = float(os.getenv("CLIENT_CONNECT_TIMEOUT", "5"))
+CLIENT_READ_TIMEOUT = float(os.getenv("CLIENT_READ_TIMEOUT", "30"))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def config():
+    return Config(
+        max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+        retries={"mode": CLIENT_RETRY_MODE, "max_attempts": CLIENT_MAX_ATTEMPTS},
+        connect_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUT,
+    )
+
+
+def client(service_name):
+    # Get the cached client of a service, boto3 sessions are not thread safe so
+    # creation is serialized
+    if service_name not in _clients:
+        with _lock:
+            if service_name not in _clients:
+                new_client = boto3.client(service_name, config=config())
+                metrics.instrument_client(new_client)
+                _clients[service_name] = new_client
+    return _clients[service_name]
+
+
+class LazyClient:
+    """
+    Stand-in for the client of a service, created on the first attribute access
+
+    Callbacks receive the client once created, to register event handlers.
+    """
+
+    def __init__(self, service_name, *callbacks):
+        self._service_name = service_name
+        self._callbacks = callbacks
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    new_client = client(self._service_name)
+                    for callback in self._callbacks:
+                        callback(new_client)
+                    self._client = new_client
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get_client(), name)
+
+
+def lazy_client(service_name, *callbacks):
+    return LazyClient(service_name, *callbacks)
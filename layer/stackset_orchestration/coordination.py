@@ -0,0 +1,290 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Coordination of StackSet operations across executions
+
+Before starting an operation, a function takes the lease of its StackSet, so
+that executions touching the same StackSet queue instead of colliding with
+OperationInProgressException. A token bucket shared by every function paces
+the CloudFormation API calls.
+
+Leases and buckets live in a key-value store with compare-and-set semantics:
+DynamoDB when deployed, SQLite or memory for local runs. Coordination is
+disabled unless COORDINATION_BACKEND is set.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from stackset_orchestration import clients, metrics
+from stackset_orchestration.retry import error_code
+
+COORDINATION_BACKEND = os.getenv("COORDINATION_BACKEND", "none")
+COORDINATION_TABLE = os.getenv("COORDINATION_TABLE")
+COORDINATION_SQLITE_PATH = os.getenv("COORDINATION_SQLITE_PATH", ":memory:")
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "900"))
+API_CALLS_PER_SECOND = float(os.getenv("API_CALLS_PER_SECOND", "5"))
+API_CALLS_BURST = float(os.getenv("API_CALLS_BURST", "10"))
+
+
+class KeyValueStore:
+    """
+    Versioned key-value store
+
+    get returns the value of a key and its version, (None, 0) when the key does
+    not exist. compare_and_set writes the value only if the key is still at the
+    given version, and returns whether it did.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def compare_and_set(self, key, value, version):
+        raise NotImplementedError
+
+
+class MemoryStore(KeyValueStore):
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, version = self.items.get(key, (None, 0))
+            return json.loads(value) if value else None, version
+
+    def compare_and_set(self, key, value, version):
+        with self.lock:
+            if self.items.get(key, (None, 0))[1] != version:
+                return False
+            self.items[key] = (json.dumps(value), version + 1)
+            return True
+
+
+class SQLiteStore(KeyValueStore):
+    def __init__(self, path=":memory:"):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS coordination"
+                " (key TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL)"
+            )
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, version FROM coordination WHERE key = ?", (key,)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, 0)
+
+    def compare_and_set(self, key, value, version):
+        with self.lock, self.connection:
+            if version == 0:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO coordination VALUES (?, ?, 1)",
+                    (key, json.dumps(value)),
+                )
+            else:
+                cursor = self.connection.execute(
+                    "UPDATE coordination SET value = ?, version = ?"
+                    " WHERE key = ? AND version = ?",
+                    (json.dumps(value), version + 1, key, version),
+                )
+            return cursor.rowcount == 1
+
+
+class DynamoDBStore(KeyValueStore):
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client
+
+    def _client(self):
+        if self.client is None:
+            self.client = clients.client("dynamodb")
+        return self.client
+
+    def get(self, key):
+        item = (
+            self._client()
+            .get_item(
+                TableName=self.table_name, Key={"key": {"S": key}}, ConsistentRead=True
+            )
+            .get("Item")
+        )
+        if not item:
+            return None, 0
+        return json.loads(item["value"]["S"]), int(item["version"]["N"])
+
+    def compare_and_set(self, key, value, version):
+        try:
+            self._client().put_item(
+                TableName=self.table_name,
+                Item={
+                    "key": {"S": key},
+                    "value": {"S": json.dumps(value)},
+                    "version": {"N": str(version + 1)},
+                },
+                ConditionExpression="attribute_not_exists(#key) OR #version = :version",
+                ExpressionAttributeNames={"#key": "key", "#version": "version"},
+                ExpressionAttributeValues={":version": {"N": str(version)}},
+            )
+        except Exception as error:
+            if error_code(error) == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+
+class Leases:
+    def __init__(self, store, ttl_seconds=LEASE_TTL_SECONDS, clock=time.time):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+    def acquire(self, name, owner):
+        # Take the lease if it is free, expired or already held by the owner,
+        # which extends it
+        key = "lease#" + name
+        lease, version = self.store.get(key)
+        if (
+            lease
+            and lease["owner"] not in (None, owner)
+            and lease["expires_at"] > self.clock()
+        ):
+            return False
+        return self.store.compare_and_set(
+            key,
+            {"owner": owner, "expires_at": self.clock() + self.ttl_seconds},
+            version,
+        )
+
+    def release(self, name, owner):
+        key = "lease#" + name
+        lease, version = self.store.get(key)
+        if lease and lease["owner"] == owner:
+            self.store.compare_and_set(key, {"owner": None, "expires_at": 0}, version)
+
+
+class TokenBucket:
+    def __init__(self, store, name, rate, capacity, clock=time.time):
+        self.store = store
+        self.key = "bucket#" + name
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+
+    def take(self, tokens=1):
+        # Take tokens, returning 0 on success or the seconds to wait before they
+        # are available
+        while True:
+            bucket, version = self.store.get(self.key)
+            now = self.clock()
+            available = self.capacity
+            if bucket:
+                available = min(
+                    self.capacity,
+                    bucket["tokens"] + (now - bucket["updated_at"]) * self.rate,
+                )
+            if available < tokens:
+                return (tokens - available) / self.rate
+            if self.store.compare_and_set(
+                self.key, {"tokens": available - tokens, "updated_at": now}, version
+            ):
+                return 0
+
+
+class Coordinator:
+    enabled = True
+
+    def __init__(
+        self,
+        store,
+        lease_ttl_seconds=LEASE_TTL_SECONDS,
+        api_calls_per_second=API_CALLS_PER_SECOND,
+        api_calls_burst=API_CALLS_BURST,
+        clock=time.time,
+    ):
+        self.leases = Leases(store, lease_ttl_seconds, clock)
+        self.api_calls = TokenBucket(
+            store, "cloudformation", api_calls_per_second, api_calls_burst, clock
+        )
+
+    def acquire_stackset(self, stackset_name, owner):
+        return self.leases.acquire("stackset#" + stackset_name, owner)
+
+    def release_stackset(self, stackset_name, owner):
+        self.leases.release("stackset#" + stackset_name, owner)
+
+    def throttle(self):
+        # Wait for a token of the API call bucket, not sleeping when one is available
+        wait_seconds = self.api_calls.take()
+        if wait_seconds <= 0:
+            return
+        with metrics.timer("ThrottleSleepTime"):
+            while wait_seconds > 0:
+                time.sleep(wait_seconds)
+                wait_seconds = self.api_calls.take()
+
+
+class NullCoordinator:
+    enabled = False
+
+    def acquire_stackset(self, stackset_name, owner):
+        return True
+
+    def release_stackset(self, stackset_name, owner):
+        pass
+
+    def throttle(self):
+        pass
+
+
+def create_coordinator():
+    if COORDINATION_BACKEND == "dynamodb":
+        return Coordinator(DynamoDBStore(COORDINATION_TABLE))
+    if COORDINATION_BACKEND == "sqlite":
+        return Coordinator(SQLiteStore(COORDINATION_SQLITE_PATH))
+    if COORDINATION_BACKEND == "memory":
+        return Coordinator(MemoryStore())
+    return NullCoordinator()
+
+
+_coordinator = None
+
+
+def coordinator():
+    # Get the coordinator of the function, created on first use
+    global _coordinator
+    if _coordinator is None:
+        _coordinator = create_coordinator()
+    return _coordinator
+
+
+def use(new_coordinator):
+    # Replace the coordinator of the function, for tests and local runs
+    global _coordinator
+    _coordinator = new_coordinator
+
+
+def throttle_client(client):
+    # Pace every call of the client with the API call bucket
+    client.meta.events.register(
+        "before-call.*.*", lambda **kwargs: coordinator().throttle()
+    )
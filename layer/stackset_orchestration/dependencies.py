@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Ordering of dependent StackSets
+
+A stackset may list in depends_on the StackSets to deploy before it. The
+StackSets of an execution are sorted in waves, each holding the StackSets
+whose dependencies are all in earlier waves: the waves run one after another
+and the StackSets of a wave in parallel, so that a rollout takes as long as
+its longest chain of dependencies. StackSets being terminated are removed in
+the reverse order, after the StackSets depending on them.
+"""
+
+
+class DependencyCycle(ValueError):
+    pass
+
+
+def validate(stacksets):
+    # Raise a ValueError if the stacksets of a file depend on unknown or cyclic StackSets
+    names = set(stackset["name"] for stackset in stacksets)
+    errors = []
+    for stackset in stacksets:
+        for dependency in stackset.get("depends_on", []):
+            if dependency not in names:
+                errors.append(
+                    "stackset "
+                    + stackset["name"]
+                    + " depends on unknown stackset "
+                    + dependency
+                )
+    if errors:
+        raise ValueError("; ".join(errors))
+    waves(stacksets)
+
+
+def dependency_graph(stacksets):
+    # Map each StackSet name to the names of the StackSets to run before it.
+    # Dependencies outside the stacksets are already deployed, and ignored
+    graph = {stackset["name"]: {} for stackset in stacksets}
+    terminated = set(graph) - set(
+        stackset["name"] for stackset in stacksets if not stackset.get("terminate")
+    )
+    for stackset in stacksets:
+        for dependency in stackset.get("depends_on", []):
+            if dependency not in graph:
+                continue
+            if dependency in terminated:
+                # Remove a StackSet once the StackSets depending on it are removed
+                graph[dependency][stackset["name"]] = None
+            else:
+                graph[stackset["name"]][dependency] = None
+    return graph
+
+
+def waves(stacksets):
+    # Sort the StackSet names of the stacksets in waves, keeping their order
+    # within a wave, or raise DependencyCycle
+    graph = dependency_graph(stacksets)
+    order = {name: index for index, name in enumerate(graph)}
+    dependents = {name: [] for name in graph}
+    pending = {}
+    for name, dependencies in graph.items():
+        pending[name] = len(dependencies)
+        for dependency in dependencies:
+            dependents[dependency].append(name)
+    result = []
+    wave = [name for name in graph if not pending[name]]
+    while wave:
+        result.append(wave)
+        next_wave = []
+        for name in wave:
+            for dependent in dependents[name]:
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    next_wave.append(dependent)
+        wave = sorted(next_wave, key=order.get)
+    if any(pending.values()):
+        raise DependencyCycle(
+            "Cyclic dependencies between stacksets "
+            + ", ".join(name for name in graph if pending[name])
+        )
+    return result
+
+
+def components(stacksets):
+    # Map each StackSet name to a name shared by all the StackSets it is
+    # connected to by dependencies, which must be deployed by the same execution
+    roots = {}
+
+    def root(name):
+        while roots.setdefault(name, name) != name:
+            roots[name] = roots[roots[name]]
+            name = roots[name]
+        return name
+
+    for stackset in stacksets:
+        for dependency in stackset.get("depends_on", []):
+            first, second = root(stackset["name"]), root(dependency)
+            roots[max(first, second)] = min(first, second)
+    return {stackset["name"]: root(stackset["name"]) for stackset in stacksets}
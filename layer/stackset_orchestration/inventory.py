@@ -0,0 +1,94 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Inventory of the stack instances of StackSets
+
+The instances of a StackSet are listed with a single paginated call and
+indexed by account and region, so choosing between creating and updating an
+instance is a lookup. Listings are kept in the memory of warm containers for
+INVENTORY_TTL_SECONDS, and updated with the operations of the function.
+"""
+
+import os
+import threading
+import time
+
+INVENTORY_TTL_SECONDS = float(os.getenv("INVENTORY_TTL_SECONDS", "300"))
+
+
+class StackInstanceInventory:
+    def __init__(self, list_pages, ttl_seconds=INVENTORY_TTL_SECONDS, clock=None):
+        # list_pages returns the list_stack_instances pages of a StackSet, given
+        # its name and the extra arguments of the lookups
+        self.list_pages = list_pages
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock or time.monotonic
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def instances(self, stackset_name, **list_arguments):
+        # Get the stack instance summaries of the StackSet by (account, region)
+        with self.lock:
+            listing = self.listings.get(stackset_name)
+        if listing and self.clock() - listing["listed_at"] < self.ttl_seconds:
+            return listing["instances"]
+        instances = {}
+        for page in self.list_pages(stackset_name, **list_arguments):
+            for summary in page["Summaries"]:
+                instances[(summary["Account"], summary["Region"])] = summary
+        with self.lock:
+            self.listings[stackset_name] = {
+                "instances": instances,
+                "listed_at": self.clock(),
+            }
+        return instances
+
+    def exists(self, stackset_name, account_id, region, **list_arguments):
+        return (account_id, region) in self.instances(stackset_name, **list_arguments)
+
+    def accounts(self, stackset_name, region, **list_arguments):
+        # Get the accounts having an instance of the StackSet in the region
+        return set(
+            account_id
+            for account_id, instance_region in self.instances(
+                stackset_name, **list_arguments
+            )
+            if instance_region == region
+        )
+
+    def record(self, stackset_name, account_ids, regions, exists):
+        # Reflect an operation of the function in a cached listing
+        with self.lock:
+            listing = self.listings.get(stackset_name)
+            if not listing:
+                return
+            for account_id in account_ids:
+                for region in regions:
+                    if exists:
+                        listing["instances"].setdefault(
+                            (account_id, region),
+                            {"Account": account_id, "Region": region},
+                        )
+                    else:
+                        listing["instances"].pop((account_id, region), None)
+
+    def invalidate(self, stackset_name=None):
+        # Forget the listing of a StackSet, or of every StackSet
+        with self.lock:
+            if stackset_name is None:
+                self.listings.clear()
+            else:
+                self.listings.pop(stackset_name, None)
@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Leveled logging in compact JSON lines
+
+Each record is a single JSON line with its level, message and fields, tagged
+with the stackset and account of the invocation set for the metrics. Fields
+are truncated to LOG_MAX_FIELD_LENGTH characters so that events and responses
+never flood the logs, and the messages repeated by every iteration of the
+verify loop can be sampled at LOG_SAMPLE_RATE. Set LOG_LEVEL to DEBUG to see
+the full events, unsampled.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+
+from stackset_orchestration import metrics
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+LOG_LEVEL = LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), LEVELS["INFO"])
+# Share of the sampled records which are logged, unless the level is DEBUG
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+# Maximum length of a field once serialized, 0 to never truncate
+LOG_MAX_FIELD_LENGTH = int(os.getenv("LOG_MAX_FIELD_LENGTH", "1024"))
+
+_random = random.Random()
+_output_lock = threading.Lock()
+
+
+def truncate(value):
+    if (
+        not LOG_MAX_FIELD_LENGTH
+        or value is None
+        or isinstance(value, (bool, int, float))
+    ):
+        return value
+    text = (
+        value
+        if isinstance(value, str)
+        else json.dumps(value, default=str, separators=(",", ":"))
+    )
+    if len(text) <= LOG_MAX_FIELD_LENGTH:
+        return value
+    return (
+        text[:LOG_MAX_FIELD_LENGTH]
+        + "... ("
+        + str(len(text) - LOG_MAX_FIELD_LENGTH)
+        + " more characters)"
+    )
+
+
+def log(level, message, sampled=False, **fields):
+    if LEVELS[level] < LOG_LEVEL:
+        return
+    if sampled and LOG_LEVEL > LEVELS["DEBUG"]:
+        if _random.random() >= LOG_SAMPLE_RATE:
+            return
+        fields["sample_rate"] = LOG_SAMPLE_RATE
+    record = {"level": level, "message": message, "function": metrics.FUNCTION_NAME}
+    record.update(metrics.get_properties())
+    record.update((key, truncate(value)) for key, value in fields.items())
+    line = json.dumps(record, default=str, separators=(",", ":"))
+    with _output_lock:
+        sys.stdout.write(line + "\n")
+
+
+def debug(message, **fields):
+    log("DEBUG", message, **fields)
+
+
+def info(message, **fields):
+    log("INFO", message, **fields)
+
+
+def warning(message, **fields):
+    log("WARNING", message, **fields)
+
+
+def error(message, **fields):
+    log("ERROR", message, **fields)
@@ -0,0 +1,157 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Metrics in CloudWatch Embedded Metric Format
+
+Each metric is printed as a JSON line that CloudWatch Logs turns into a
+metric, without any API call. Every AWS client of the layer is timed through
+its botocore events, and the functions count the outcomes of their StackSet
+operations. The stackset and account being processed are set once per
+invocation and added to every line as properties, so that they can be
+queried in CloudWatch Logs Insights without multiplying the metrics.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "StackSetOrchestration")
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local")
+THROTTLING_ERROR_CODES = frozenset(
+    [
+        "RequestLimitExceeded",
+        "Throttling",
+        "ThrottlingException",
+        "TooManyRequestsException",
+    ]
+)
+
+_properties = threading.local()
+_output_lock = threading.Lock()
+
+
+def set_properties(**properties):
+    # Tag the metrics of the current invocation, in the current thread
+    _properties.values = {
+        key: value for key, value in properties.items() if value is not None
+    }
+
+
+def get_properties():
+    return getattr(_properties, "values", {})
+
+
+def emit(metrics, **dimensions):
+    # Print a line of the given metrics, each a (value, unit) tuple
+    if not METRICS_ENABLED:
+        return
+    dimensions = dict({"Function": FUNCTION_NAME}, **dimensions)
+    record = dict(get_properties(), **dimensions)
+    record["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [
+            {
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [
+                    {"Name": name, "Unit": unit}
+                    for name, (value, unit) in metrics.items()
+                ],
+            }
+        ],
+    }
+    for name, (value, unit) in metrics.items():
+        record[name] = value
+    # Lines of concurrent threads must not interleave
+    with _output_lock:
+        sys.stdout.write(json.dumps(record) + "\n")
+
+
+def count(name, value=1, **dimensions):
+    emit({name: (value, "Count")}, **dimensions)
+
+
+def duration(name, seconds, **dimensions):
+    emit({name: (seconds * 1000, "Milliseconds")}, **dimensions)
+
+
+@contextlib.contextmanager
+def timer(name, **dimensions):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration(name, time.perf_counter() - start, **dimensions)
+
+
+def _start_call(model, context, **kwargs):
+    context["metrics_operation"] = model.name
+    context["metrics_start"] = time.perf_counter()
+
+
+def _end_call(service_name, parsed, context, **kwargs):
+    emit_call(
+        service_name,
+        context,
+        retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+        error_code=parsed.get("Error", {}).get("Code"),
+    )
+
+
+def _end_call_error(service_name, context, exception, **kwargs):
+    emit_call(service_name, context, error_code=type(exception).__name__)
+
+
+def emit_call(service_name, context, retries=0, error_code=None):
+    metrics = {
+        "ApiCalls": (1, "Count"),
+        "ApiCallRetries": (retries, "Count"),
+        "ApiCallErrors": (1 if error_code else 0, "Count"),
+        "ApiCallThrottles": (
+            1 if error_code in THROTTLING_ERROR_CODES else 0,
+            "Count",
+        ),
+    }
+    if "metrics_start" in context:
+        metrics["ApiCallLatency"] = (
+            (time.perf_counter() - context.pop("metrics_start")) * 1000,
+            "Milliseconds",
+        )
+    emit(
+        metrics,
+        Service=service_name,
+        Operation=context.get("metrics_operation", "Unknown"),
+    )
+
+
+def instrument_client(client):
+    # Time every call of the client, including the client-side pacing and the
+    # retries of botocore, and count its errors and throttles
+    service_name = client.meta.service_model.service_name
+    events = client.meta.events
+    events.register_first("before-call.*.*", _start_call)
+    events.register(
+        "after-call.*.*",
+        lambda **kwargs: _end_call(service_name, **kwargs),
+    )
+    events.register(
+        "after-call-error.*.*",
+        lambda **kwargs: _end_call_error(service_name, **kwargs),
+    )
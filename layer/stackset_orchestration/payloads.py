@@ -0,0 +1,101 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Offloading of execution plans to S3
+
+Step Functions limits the input and output of every state to 256 KB. When the
+plan of an execution is too large, the trigger function writes its stacksets
+to a JSON Lines object and passes each Map iteration a reference to its own
+line. The functions of the iteration load that line with a ranged GET, and
+drop it again from the state they return.
+"""
+
+import functools
+import json
+
+from stackset_orchestration import clients
+
+s3 = clients.lazy_client("s3")
+
+# Keys of an offloaded stackset kept in the state of its iteration
+REFERENCE_KEYS = ["name", "plan"]
+
+
+def offload(stackset_groups, bucket, key):
+    # Write the stacksets of the groups to a single object, one per line, and
+    # replace them by the byte range of their line
+    lines = []
+    offset = 0
+    offloaded_groups = []
+    for group in stackset_groups:
+        references = []
+        for stackset in group["stacksets"]:
+            line = (json.dumps(stackset) + "\n").encode()
+            references.append(
+                {
+                    "name": stackset["name"],
+                    "plan": {
+                        "bucket": bucket,
+                        "key": key,
+                        "range": [offset, offset + len(line) - 1],
+                    },
+                }
+            )
+            lines.append(line)
+            offset += len(line)
+        offloaded_groups.append(dict(group, stacksets=references))
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=b"".join(lines),
+        ContentType="application/x-ndjson",
+    )
+    return offloaded_groups
+
+
+@functools.lru_cache(maxsize=256)
+def read_line(bucket, key, start, end):
+    # Plans are never rewritten, so their lines can be kept by warm functions
+    response = s3.get_object(
+        Bucket=bucket, Key=key, Range="bytes=" + str(start) + "-" + str(end)
+    )
+    return response["Body"].read()
+
+
+def offloaded_stackset(state):
+    reference = state["plan"]
+    return json.loads(
+        read_line(reference["bucket"], reference["key"], *reference["range"])
+    )
+
+
+def load(state):
+    # Merge the offloaded stackset of an iteration into its state
+    if "plan" not in state:
+        return state
+    return dict(offloaded_stackset(state), **state)
+
+
+def compact(state):
+    # Drop the offloaded stackset from the state returned to the state machine
+    if "plan" not in state:
+        return state
+    stackset = offloaded_stackset(state)
+    return {
+        key: value
+        for key, value in state.items()
+        if key not in stackset or key in REFERENCE_KEYS
+    }
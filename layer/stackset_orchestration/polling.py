@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Poll intervals of the verify loop of the state machine
+
+The functions never sleep while an operation runs. They return the number of
+seconds the state machine should wait before verifying again, in wait_seconds.
+"""
+
+import os
+
+MIN_WAIT_SECONDS = int(os.getenv("MIN_WAIT_SECONDS", "10"))
+MAX_WAIT_SECONDS = int(os.getenv("MAX_WAIT_SECONDS", "120"))
+# Share of the time already waited added to the next wait
+ELAPSED_WAIT_FACTOR = float(os.getenv("ELAPSED_WAIT_FACTOR", "0.25"))
+# Seconds added to the wait for each stack instance beyond the first one
+INSTANCE_WAIT_SECONDS = float(os.getenv("INSTANCE_WAIT_SECONDS", "1"))
+
+
+def wait_seconds(waited_seconds, instance_count):
+    # Poll short operations often, and back off as an operation keeps running
+    # or when it covers many stack instances
+    seconds = (
+        MIN_WAIT_SECONDS
+        + waited_seconds * ELAPSED_WAIT_FACTOR
+        + max(0, instance_count - 1) * INSTANCE_WAIT_SECONDS
+    )
+    return int(min(MAX_WAIT_SECONDS, max(MIN_WAIT_SECONDS, seconds)))
@@ -0,0 +1,157 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+OperationPreferences of StackSet operations
+
+Stacksets of the configuration files may set the preferences of their
+operations, which are validated, then completed with defaults depending on
+the operation: new and deleted instances are processed at full concurrency,
+while updates of existing instances go region by region, a quarter of the
+accounts at a time, and stop after the first failure. Rollbacks of failed
+updates go back to the previous parameters as fast as possible, in every
+account and region at once, without stopping at failures. The defaults use
+SOFT_FAILURE_TOLERANCE: STRICT_FAILURE_TOLERANCE caps the concurrency at one
+more than the failure tolerance, which would run updates one account at a time.
+"""
+
+# Settings of the configuration files, and their OperationPreferences names
+PREFERENCES = {
+    "max_concurrent_count": "MaxConcurrentCount",
+    "max_concurrent_percentage": "MaxConcurrentPercentage",
+    "failure_tolerance_count": "FailureToleranceCount",
+    "failure_tolerance_percentage": "FailureTolerancePercentage",
+    "region_concurrency_type": "RegionConcurrencyType",
+    "concurrency_mode": "ConcurrencyMode",
+}
+# Settings which cannot be set together
+EXCLUSIVE_PREFERENCES = [
+    ("max_concurrent_count", "max_concurrent_percentage"),
+    ("failure_tolerance_count", "failure_tolerance_percentage"),
+]
+# Minimum and maximum of the numeric settings
+PREFERENCE_RANGES = {
+    "max_concurrent_count": (1, None),
+    "max_concurrent_percentage": (1, 100),
+    "failure_tolerance_count": (0, None),
+    "failure_tolerance_percentage": (0, 100),
+}
+PREFERENCE_VALUES = {
+    "region_concurrency_type": ["SEQUENTIAL", "PARALLEL"],
+    "concurrency_mode": ["STRICT_FAILURE_TOLERANCE", "SOFT_FAILURE_TOLERANCE"],
+}
+DEFAULT_PREFERENCES = {
+    "create": {
+        "max_concurrent_percentage": 100,
+        "failure_tolerance_percentage": 0,
+        "region_concurrency_type": "PARALLEL",
+        "concurrency_mode": "SOFT_FAILURE_TOLERANCE",
+    },
+    "update": {
+        "max_concurrent_percentage": 25,
+        "failure_tolerance_percentage": 0,
+        "region_concurrency_type": "SEQUENTIAL",
+        "concurrency_mode": "SOFT_FAILURE_TOLERANCE",
+    },
+    "delete": {
+        "max_concurrent_percentage": 100,
+        "failure_tolerance_percentage": 0,
+        "region_concurrency_type": "PARALLEL",
+        "concurrency_mode": "SOFT_FAILURE_TOLERANCE",
+    },
+    "rollback": {
+        "max_concurrent_percentage": 100,
+        "failure_tolerance_percentage": 100,
+        "region_concurrency_type": "PARALLEL",
+        "concurrency_mode": "SOFT_FAILURE_TOLERANCE",
+    },
+}
+
+
+class InvalidOperationPreferences(ValueError):
+    pass
+
+
+def validate(settings):
+    # Raise InvalidOperationPreferences listing every invalid setting of a stackset
+    errors = []
+    for setting, (minimum, maximum) in PREFERENCE_RANGES.items():
+        if setting not in settings:
+            continue
+        value = settings[setting]
+        if (
+            not isinstance(value, int)
+            or isinstance(value, bool)
+            or value < minimum
+            or (maximum is not None and value > maximum)
+        ):
+            errors.append(
+                setting
+                + " must be an integer from "
+                + str(minimum)
+                + (" to " + str(maximum) if maximum is not None else " up")
+            )
+    for setting, values in PREFERENCE_VALUES.items():
+        if setting in settings and settings[setting] not in values:
+            errors.append(setting + " must be one of " + ", ".join(values))
+    for exclusive_settings in EXCLUSIVE_PREFERENCES:
+        if all(setting in settings for setting in exclusive_settings):
+            errors.append(" and ".join(exclusive_settings) + " cannot be set together")
+    if (
+        not errors
+        and settings.get("concurrency_mode", "SOFT_FAILURE_TOLERANCE")
+        == "STRICT_FAILURE_TOLERANCE"
+        and "max_concurrent_count" in settings
+        and "failure_tolerance_count" in settings
+        and settings["max_concurrent_count"] > settings["failure_tolerance_count"] + 1
+    ):
+        errors.append(
+            "max_concurrent_count must be at most one more than "
+            "failure_tolerance_count with STRICT_FAILURE_TOLERANCE"
+        )
+    if errors:
+        raise InvalidOperationPreferences(
+            "Invalid operation preferences of stackset "
+            + str(settings.get("name"))
+            + ": "
+            + "; ".join(errors)
+        )
+
+
+def merge(settings, overrides):
+    # Override settings, dropping the ones which cannot be set with an override
+    merged = dict(settings)
+    for exclusive_settings in EXCLUSIVE_PREFERENCES:
+        if any(setting in overrides for setting in exclusive_settings):
+            for setting in exclusive_settings:
+                merged.pop(setting, None)
+    merged.update(overrides)
+    return merged
+
+
+def operation_preferences(settings, action, regions):
+    # Get the OperationPreferences of an operation from the settings of its stackset
+    validate(settings)
+    preferences = merge(
+        DEFAULT_PREFERENCES[action],
+        {setting: settings[setting] for setting in PREFERENCES if setting in settings},
+    )
+    operation_preferences = {
+        PREFERENCES[setting]: value for setting, value in preferences.items()
+    }
+    # Regions are deployed one after the other in the order of the configuration
+    if preferences["region_concurrency_type"] == "SEQUENTIAL" and len(regions) > 1:
+        operation_preferences["RegionOrder"] = list(regions)
+    return operation_preferences
@@ -0,0 +1,115 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Retry of AWS API calls with decorrelated jitter exponential backoff
+
+Calls are only delayed when AWS reports throttling or a concurrent StackSet
+operation, so uncontended calls never sleep.
+"""
+
+import os
+import random
+import time
+
+from stackset_orchestration import logs, metrics
+
+RETRYABLE_ERROR_CODES = frozenset(
+    [
+        "OperationInProgressException",
+        "RequestLimitExceeded",
+        "Throttling",
+        "ThrottlingException",
+        "TooManyRequestsException",
+    ]
+)
+
+
+def error_code(error):
+    # Get the AWS error code of a botocore ClientError, None for any other error
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+
+def decorrelated_jitter(base_delay, max_delay):
+    # Yield an endless sequence of backoff delays, each drawn between the base
+    # delay and three times the previous delay, capped to the maximum delay
+    delay = base_delay
+    while True:
+        delay = min(max_delay, random.uniform(base_delay, delay * 3))
+        yield delay
+
+
+class Retrier:
+    def __init__(
+        self,
+        max_attempts=5,
+        base_delay=1.0,
+        max_delay=20.0,
+        retryable_error_codes=RETRYABLE_ERROR_CODES,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable_error_codes = retryable_error_codes
+
+    def call(self, function, *args, **kwargs):
+        # Call the function, backing off on retryable errors until the last attempt
+        delays = decorrelated_jitter(self.base_delay, self.max_delay)
+        attempt = 1
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                if (
+                    attempt >= self.max_attempts
+                    or error_code(error) not in self.retryable_error_codes
+                ):
+                    raise
+                delay = next(delays)
+                logs.warning(
+                    "Retrying",
+                    error_code=error_code(error),
+                    attempt=attempt,
+                    delay=round(delay, 2),
+                )
+                metrics.count("Retries", ErrorCode=error_code(error))
+                with metrics.timer("RetrySleepTime", ErrorCode=error_code(error)):
+                    time.sleep(delay)
+                attempt += 1
+
+    def paginate(self, function, **kwargs):
+        # Yield every page of a paginated API call, retrying each page on its own
+        while True:
+            page = self.call(function, **kwargs)
+            yield page
+            if not page.get("NextToken"):
+                return
+            kwargs["NextToken"] = page["NextToken"]
+
+
+retrier = Retrier(
+    max_attempts=int(os.getenv("RETRY_MAX_ATTEMPTS", "5")),
+    base_delay=float(os.getenv("RETRY_BASE_DELAY", "1")),
+    max_delay=float(os.getenv("RETRY_MAX_DELAY", "20")),
+)
+
+
+def call(function, *args, **kwargs):
+    return retrier.call(function, *args, **kwargs)
+
+
+def paginate(function, **kwargs):
+    return retrier.paginate(function, **kwargs)
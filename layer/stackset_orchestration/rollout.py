@@ -0,0 +1,94 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Progressive rollouts
+
+A stackset may roll out a change to its accounts progressively: its canary
+accounts first, then waves of accounts growing geometrically, 1, 5, 25...
+accounts by default, up to at most 100 accounts per wave. Each wave is planned
+as its own StackSet operations, verified before the next wave starts, so that
+a failure stops the rollout after the fewest accounts. A fleet of N accounts
+converges in about log(N) operations until the waves reach their maximum size,
+which bounds the stack instances a single invocation plans.
+
+The waves being sized by the rollout, their operations run at full concurrency
+by default, in SOFT_FAILURE_TOLERANCE mode since STRICT_FAILURE_TOLERANCE would
+cap the concurrency at one more than the failure tolerance, with the other
+preferences of the stackset. A rollout may also set
+its own preferences, named like the ones of the stackset.
+"""
+
+from stackset_orchestration import preferences
+
+FIRST_WAVE = 1
+GROWTH_FACTOR = 5
+MAX_WAVE = 100
+WAVE_PREFERENCES = {
+    "max_concurrent_percentage": 100,
+    "concurrency_mode": "SOFT_FAILURE_TOLERANCE",
+}
+
+
+class InvalidRollout(ValueError):
+    pass
+
+
+def wave_settings(settings):
+    # Settings of the operations of the waves of a stackset
+    rollout = settings["rollout"]
+    return preferences.merge(
+        preferences.merge(settings, WAVE_PREFERENCES),
+        {
+            setting: rollout[setting]
+            for setting in preferences.PREFERENCES
+            if setting in rollout
+        },
+    )
+
+
+def validate(settings):
+    # Raise a ValueError if the rollout of a stackset is invalid
+    if "rollout" not in settings:
+        return
+    if "deployment_targets" in settings:
+        raise InvalidRollout(
+            "Invalid rollout of stackset "
+            + str(settings.get("name"))
+            + ": rollout and deployment_targets cannot be set together"
+        )
+    # The preferences of the waves are reported like the ones of the stackset
+    preferences.validate(wave_settings(settings))
+
+
+def waves(accounts, rollout):
+    # Split accounts into the canary accounts, then waves growing geometrically,
+    # keeping their order. No wave has more than max_wave accounts
+    max_wave = rollout.get("max_wave", MAX_WAVE)
+    canary_accounts = set(rollout.get("canary_accounts", []))
+    canary = [account_id for account_id in accounts if account_id in canary_accounts]
+    others = [
+        account_id for account_id in accounts if account_id not in canary_accounts
+    ]
+    waves = [
+        canary[start : start + max_wave] for start in range(0, len(canary), max_wave)
+    ]
+    size = min(rollout.get("first_wave", FIRST_WAVE), max_wave)
+    start = 0
+    while start < len(others):
+        waves.append(others[start : start + size])
+        start += size
+        size = min(size * rollout.get("growth_factor", GROWTH_FACTOR), max_wave)
+    return waves
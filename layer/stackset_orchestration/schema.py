@@ -0,0 +1,245 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Schema of the configuration files
+
+Configuration files are validated in a single pass against the declared
+fields of the file and of its stacksets, and compiled into a normalized form:
+account IDs and parameter values become strings, regions become lists and
+terminate becomes a bool. Every error of the file is reported at once, with
+the path of the invalid field, before any execution is started.
+"""
+
+import re
+
+from stackset_orchestration import dependencies, preferences, rollout, targets
+
+ACCOUNT_ID = re.compile(r"^[0-9]{12}$")
+REGION = re.compile(r"^[a-z]{2}(-[a-z]+)+-[0-9]+$")
+
+
+class InvalidConfigFile(ValueError):
+    pass
+
+
+def string(value, path, errors):
+    if not isinstance(value, str) or not value:
+        errors.append(path + " must be a non-empty string")
+    return value
+
+
+def boolean(value, path, errors):
+    if isinstance(value, str) and value.lower() in ["true", "false"]:
+        return value.lower() == "true"
+    if not isinstance(value, bool):
+        errors.append(path + " must be a boolean")
+    return value
+
+
+def integer(minimum):
+    def normalize(value, path, errors):
+        if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+            errors.append(path + " must be an integer of at least " + str(minimum))
+        return value
+
+    return normalize
+
+
+def account_id(value, path, errors):
+    # YAML reads unquoted account IDs as integers, and the ones starting with 0
+    # as octal numbers: only integers which still have 12 digits are the IDs
+    if isinstance(value, int) and not isinstance(value, bool):
+        if len(str(value)) != 12:
+            errors.append(
+                path + " must be a 12-digit account ID, quoted if it starts with 0"
+            )
+            return value
+        value = str(value)
+    if not isinstance(value, str) or not ACCOUNT_ID.match(value):
+        errors.append(path + " must be a 12-digit account ID")
+    return value
+
+
+def region(value, path, errors):
+    if not isinstance(value, str) or not REGION.match(value):
+        errors.append(path + " must be a region name")
+    return value
+
+
+def list_of(item):
+    def normalize(value, path, errors):
+        # A single value stands for a list of one
+        if not isinstance(value, list):
+            value = [value]
+        if not value:
+            errors.append(path + " must not be empty")
+        return [
+            item(element, path + "[" + str(index) + "]", errors)
+            for index, element in enumerate(value)
+        ]
+
+    return normalize
+
+
+def parameter_value(value, path, errors):
+    # CloudFormation parameters are strings, lists are comma-delimited
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, list) and all(
+        isinstance(element, (str, int, float)) for element in value
+    ):
+        return ",".join(str(element) for element in value)
+    if not isinstance(value, str):
+        errors.append(path + " must be a string, a number, a boolean or a list")
+    return value
+
+
+def parameters(value, path, errors):
+    if not isinstance(value, dict):
+        errors.append(path + " must be a mapping")
+        return value
+    return {
+        str(key): parameter_value(element, path + "." + str(key), errors)
+        for key, element in value.items()
+    }
+
+
+def unchecked(value, path, errors):
+    return value
+
+
+ROLLOUT_SCHEMA = dict(
+    {
+        "canary_accounts": list_of(account_id),
+        "first_wave": integer(1),
+        "growth_factor": integer(1),
+        "max_wave": integer(1),
+    },
+    # Checked with the other preferences of the stackset
+    **{setting: unchecked for setting in preferences.PREFERENCES}
+)
+
+
+def rollout_settings(value, path, errors):
+    return normalize_fields(value, path, ROLLOUT_SCHEMA, [], errors)
+
+
+DEPLOYMENT_TARGETS_SCHEMA = {
+    "organizational_units": list_of(string),
+    "accounts": list_of(account_id),
+    "account_filter_type": string,
+}
+
+
+def deployment_target_settings(value, path, errors):
+    return normalize_fields(value, path, DEPLOYMENT_TARGETS_SCHEMA, [], errors)
+
+
+STACKSET_SCHEMA = dict(
+    {
+        "name": string,
+        "parameters": parameters,
+        "regions": list_of(region),
+        "terminate": boolean,
+        "deployment_targets": deployment_target_settings,
+        "call_as": string,
+        "depends_on": list_of(string),
+        "rollout": rollout_settings,
+    },
+    # Checked with the other preferences of the stackset
+    **{setting: unchecked for setting in preferences.PREFERENCES}
+)
+STACKSET_REQUIRED = ["name"]
+
+
+def stacksets(value, path, errors):
+    if not isinstance(value, list):
+        errors.append(path + " must be a list")
+        return value
+    return [
+        normalize_fields(
+            stackset,
+            path + "[" + str(index) + "]",
+            STACKSET_SCHEMA,
+            STACKSET_REQUIRED,
+            errors,
+        )
+        for index, stackset in enumerate(value)
+    ]
+
+
+CONFIG_FILE_SCHEMA = {
+    "account": account_id,
+    "regions": list_of(region),
+    "terminate": boolean,
+    "max_concurrency": integer(0),
+    "stackset_concurrency": integer(1),
+    "stacksets": stacksets,
+}
+CONFIG_FILE_REQUIRED = ["stacksets"]
+
+
+def normalize_fields(value, path, schema, required, errors):
+    if not isinstance(value, dict):
+        errors.append((path or "configuration file") + " must be a mapping")
+        return value
+    prefix = path + "." if path else ""
+    for field in required:
+        if field not in value:
+            errors.append(prefix + field + " is required")
+    normalized = {}
+    for field, element in value.items():
+        if field not in schema:
+            errors.append(prefix + str(field) + " is not a known setting")
+            continue
+        normalized[field] = schema[field](element, prefix + field, errors)
+    return normalized
+
+
+def raise_errors(errors):
+    if errors:
+        raise InvalidConfigFile("Invalid configuration file: " + "; ".join(errors))
+
+
+def normalize(config_file):
+    # Return the normalized configuration file, or raise InvalidConfigFile
+    # listing every error of the file
+    errors = []
+    normalized = normalize_fields(
+        config_file, "", CONFIG_FILE_SCHEMA, CONFIG_FILE_REQUIRED, errors
+    )
+    raise_errors(errors)
+    for index, stackset in enumerate(normalized["stacksets"]):
+        # Stacksets are deployed to the account of the file, unless they target organizational units
+        if "account" not in normalized and "deployment_targets" not in stackset:
+            errors.append(
+                "stacksets["
+                + str(index)
+                + "] needs the account of the file or deployment_targets"
+            )
+        for validate in [preferences.validate, targets.validate, rollout.validate]:
+            try:
+                validate(stackset)
+            except ValueError as e:
+                errors.append(str(e))
+    try:
+        dependencies.validate(normalized["stacksets"])
+    except ValueError as e:
+        errors.append(str(e))
+    raise_errors(errors)
+    return normalized
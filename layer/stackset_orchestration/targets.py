@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Deployment targets of service-managed StackSets
+
+Instead of accounts, a stackset may target organizational units, optionally
+filtered by accounts, so that a single operation covers every account of the
+units. CallAs lets a delegated administrator account operate the StackSets
+of the organization.
+"""
+
+ACCOUNT_FILTER_TYPES = ["NONE", "INTERSECTION", "DIFFERENCE", "UNION"]
+CALL_AS_VALUES = ["SELF", "DELEGATED_ADMIN"]
+
+
+class InvalidDeploymentTargets(ValueError):
+    pass
+
+
+def validate(settings):
+    # Raise InvalidDeploymentTargets listing every invalid target setting of a stackset
+    errors = []
+    if "deployment_targets" in settings:
+        deployment_targets = settings["deployment_targets"]
+        organizational_units = deployment_targets.get("organizational_units")
+        if not organizational_units or not isinstance(organizational_units, list):
+            errors.append("deployment_targets must list organizational_units")
+        account_filter_type = deployment_targets.get("account_filter_type", "NONE")
+        if account_filter_type not in ACCOUNT_FILTER_TYPES:
+            errors.append(
+                "account_filter_type must be one of " + ", ".join(ACCOUNT_FILTER_TYPES)
+            )
+        if account_filter_type != "NONE" and not deployment_targets.get("accounts"):
+            errors.append(
+                "account_filter_type " + account_filter_type + " needs accounts"
+            )
+        if "account" in settings or "accounts" in settings:
+            errors.append("deployment_targets and accounts cannot be set together")
+    if "call_as" in settings and settings["call_as"] not in CALL_AS_VALUES:
+        errors.append("call_as must be one of " + ", ".join(CALL_AS_VALUES))
+    if errors:
+        raise InvalidDeploymentTargets(
+            "Invalid deployment targets of stackset "
+            + str(settings.get("name"))
+            + ": "
+            + "; ".join(errors)
+        )
+
+
+def deployment_targets(settings):
+    # Get the DeploymentTargets of the operations of a stackset
+    targets = settings["deployment_targets"]
+    result = {"OrganizationalUnitIds": targets["organizational_units"]}
+    if targets.get("account_filter_type", "NONE") != "NONE":
+        result["AccountFilterType"] = targets["account_filter_type"]
+        result["Accounts"] = [str(account_id) for account_id in targets["accounts"]]
+    return result
+
+
+def call_as_arguments(settings):
+    # Get the CallAs argument of the CloudFormation calls on a stackset, if any
+    return {"CallAs": settings["call_as"]} if "call_as" in settings else {}
@@ -0,0 +1,50 @@
+from botocore.stub import Stubber
+import pytest
+
+from stackset_orchestration import clients
+
+
+@pytest.fixture(autouse=True)
+def cached_clients(monkeypatch):
+    monkeypatch.setattr(clients, "_clients", {})
+
+
+def test_client_is_cached():
+    """
+    Given a client created by the factory
+    When the same service is requested again
+    Then the cached client is returned, with the tuned configuration
+    """
+    # Given
+    cloudformation = clients.client("cloudformation")
+    # When
+    result = clients.client("cloudformation")
+    # Then
+    assert result is cloudformation
+    assert (
+        cloudformation.meta.config.max_pool_connections
+        == clients.CLIENT_MAX_POOL_CONNECTIONS
+    )
+    assert cloudformation.meta.config.retries["mode"] == "adaptive"
+    assert cloudformation.meta.config.read_timeout == clients.CLIENT_READ_TIMEOUT
+
+
+def test_lazy_client():
+    """
+    Given a lazy client with a callback
+    When it is first used
+    Then the client is created once, configured by the callback, and stubbable
+    """
+    # Given
+    configured = []
+    cloudformation = clients.lazy_client("cloudformation", configured.append)
+    assert clients._clients == {}
+    # When
+    stubber = Stubber(cloudformation)
+    stubber.add_response("list_stack_sets", {"Summaries": []})
+    stubber.activate()
+    result = cloudformation.list_stack_sets()
+    # Then
+    stubber.assert_no_pending_responses()
+    assert result["Summaries"] == []
+    assert configured == [clients.client("cloudformation")]
@@ -0,0 +1,155 @@
+from botocore.stub import Stubber
+import boto3
+import pytest
+
+from stackset_orchestration import coordination
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request):
+    if request.param == "memory":
+        return coordination.MemoryStore()
+    return coordination.SQLiteStore()
+
+
+def test_store_compare_and_set(store):
+    """
+    Given a key-value store
+    When a key is written at its current version, then at a stale version
+    Then only the write at the current version succeeds
+    """
+    # When
+    created = store.compare_and_set("key", {"value": 1}, 0)
+    stale = store.compare_and_set("key", {"value": 2}, 0)
+    updated = store.compare_and_set("key", {"value": 3}, 1)
+    # Then
+    assert (created, stale, updated) == (True, False, True)
+    assert store.get("key") == ({"value": 3}, 2)
+    assert store.get("missing") == (None, 0)
+
+
+def test_leases(store):
+    """
+    Given a StackSet lease held by an execution
+    When other executions try to take it, before and after it expires or is released
+    Then it is only granted to one owner at a time
+    """
+    # Given
+    clock = Clock()
+    leases = coordination.Leases(store, ttl_seconds=60, clock=clock)
+    assert leases.acquire("vpc", "first")
+    # When / Then
+    assert not leases.acquire("vpc", "second")
+    assert leases.acquire("vpc", "first")
+    assert leases.acquire("subnets", "second")
+    leases.release("vpc", "second")
+    assert not leases.acquire("vpc", "second")
+    clock.now += 61
+    assert leases.acquire("vpc", "second")
+    leases.release("vpc", "second")
+    assert leases.acquire("vpc", "third")
+
+
+def test_token_bucket(store):
+    """
+    Given a token bucket allowing 2 calls per second, with bursts of 4 calls
+    When tokens are taken faster than they refill
+    Then the burst is granted right away, and later calls are told how long to wait
+    """
+    # Given
+    clock = Clock()
+    bucket = coordination.TokenBucket(store, "api", rate=2, capacity=4, clock=clock)
+    # When
+    burst = [bucket.take() for _ in range(4)]
+    wait_seconds = bucket.take()
+    clock.now += wait_seconds
+    # Then
+    assert burst == [0, 0, 0, 0]
+    assert wait_seconds == pytest.approx(0.5)
+    assert bucket.take() == 0
+
+
+def test_coordinator_throttle(monkeypatch):
+    """
+    Given a coordinator whose API call bucket is empty
+    When a call is throttled
+    Then it sleeps until a token is available
+    """
+    # Given
+    clock = Clock()
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(coordination.time, "sleep", sleep)
+    coordinator = coordination.Coordinator(
+        coordination.MemoryStore(),
+        api_calls_per_second=1,
+        api_calls_burst=1,
+        clock=clock,
+    )
+    # When
+    coordinator.throttle()
+    coordinator.throttle()
+    # Then
+    assert sleeps == [pytest.approx(1)]
+
+
+def test_dynamodb_store():
+    """
+    Given a DynamoDB backed store
+    When a key is read, then written at a version another writer already changed
+    Then the item is read consistently, and the conditional write reports the conflict
+    """
+    # Given
+    client = boto3.client("dynamodb")
+    store = coordination.DynamoDBStore("coordination-table", client)
+    stubber = Stubber(client)
+    stubber.add_response(
+        "get_item",
+        {
+            "Item": {
+                "key": {"S": "key"},
+                "value": {"S": '{"a": 1}'},
+                "version": {"N": "3"},
+            }
+        },
+        {
+            "TableName": "coordination-table",
+            "Key": {"key": {"S": "key"}},
+            "ConsistentRead": True,
+        },
+    )
+    stubber.add_client_error(
+        "put_item",
+        "ConditionalCheckFailedException",
+        expected_params={
+            "TableName": "coordination-table",
+            "Item": {
+                "key": {"S": "key"},
+                "value": {"S": '{"a": 2}'},
+                "version": {"N": "4"},
+            },
+            "ConditionExpression": "attribute_not_exists(#key) OR #version = :version",
+            "ExpressionAttributeNames": {"#key": "key", "#version": "version"},
+            "ExpressionAttributeValues": {":version": {"N": "3"}},
+        },
+    )
+    stubber.activate()
+    # When
+    value = store.get("key")
+    written = store.compare_and_set("key", {"a": 2}, 3)
+    stubber.deactivate()
+    # Then
+    assert value == ({"a": 1}, 3)
+    assert written is False
@@ -0,0 +1,85 @@
+import pytest
+
+from stackset_orchestration import dependencies
+
+
+def test_waves():
+    """
+    Given stacksets depending on each other
+    When they are sorted in waves
+    Then each StackSet runs in the wave after its last dependency, and independent StackSets in the first wave
+    """
+    # Given
+    stacksets = [
+        {"name": "subnets", "depends_on": ["vpc"]},
+        {"name": "vpc"},
+        {"name": "endpoints", "depends_on": ["vpc", "subnets"]},
+        {"name": "dns"},
+        {"name": "subnets", "regions": ["us-east-1"], "depends_on": ["vpc"]},
+        {"name": "flow-logs", "depends_on": ["vpc", "bucket"]},
+    ]
+    # When
+    waves = dependencies.waves(stacksets)
+    # Then
+    assert waves == [["vpc", "dns"], ["subnets", "flow-logs"], ["endpoints"]]
+
+
+def test_waves_terminate():
+    """
+    Given stacksets depending on each other, all terminated
+    When they are sorted in waves
+    Then the StackSets are removed before the StackSets they depend on
+    """
+    # Given
+    stacksets = [
+        {"name": "vpc", "terminate": True},
+        {"name": "subnets", "depends_on": ["vpc"], "terminate": True},
+        {"name": "endpoints", "depends_on": ["subnets"], "terminate": True},
+    ]
+    # When
+    waves = dependencies.waves(stacksets)
+    # Then
+    assert waves == [["endpoints"], ["subnets"], ["vpc"]]
+
+
+def test_waves_cycle():
+    """
+    Given stacksets depending on each other in a cycle
+    When they are sorted in waves
+    Then DependencyCycle is raised with the StackSets of the cycle and the ones depending on it
+    """
+    # Given
+    stacksets = [
+        {"name": "dns"},
+        {"name": "vpc", "depends_on": ["endpoints"]},
+        {"name": "subnets", "depends_on": ["vpc"]},
+        {"name": "endpoints", "depends_on": ["subnets"]},
+    ]
+    # When
+    with pytest.raises(dependencies.DependencyCycle) as exception:
+        dependencies.waves(stacksets)
+    # Then
+    assert str(exception.value) == (
+        "Cyclic dependencies between stacksets vpc, subnets, endpoints"
+    )
+
+
+def test_components():
+    """
+    Given stacksets depending on each other and independent stacksets
+    When their components are computed
+    Then the StackSets connected by dependencies share their component
+    """
+    # Given
+    stacksets = [
+        {"name": "subnets", "depends_on": ["vpc"]},
+        {"name": "dns"},
+        {"name": "vpc"},
+        {"name": "endpoints", "depends_on": ["subnets"]},
+    ]
+    # When
+    components = dependencies.components(stacksets)
+    # Then
+    assert components["dns"] == "dns"
+    assert components["vpc"] == components["subnets"] == components["endpoints"]
+    assert components["vpc"] != components["dns"]
@@ -0,0 +1,86 @@
+from stackset_orchestration import inventory
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def summary(account_id, region):
+    return {"Account": account_id, "Region": region, "Status": "CURRENT"}
+
+
+class Listings:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def __call__(self, stackset_name):
+        self.calls.append(stackset_name)
+        return iter(self.pages)
+
+
+def test_instances_indexed_and_cached():
+    """
+    Given a StackSet whose instances span several pages
+    When its accounts are looked up twice within the TTL
+    Then the instances are listed once, and indexed by account and region
+    """
+    # Given
+    listings = Listings(
+        [
+            {"Summaries": [summary("111111111111", "eu-west-1")]},
+            {"Summaries": [summary("222222222222", "eu-central-1")]},
+        ]
+    )
+    stack_instances = inventory.StackInstanceInventory(listings, 60, Clock())
+    # When
+    accounts = stack_instances.accounts("vpc", "eu-west-1")
+    exists = stack_instances.exists("vpc", "222222222222", "eu-central-1")
+    # Then
+    assert accounts == {"111111111111"}
+    assert exists
+    assert listings.calls == ["vpc"]
+
+
+def test_instances_expire():
+    """
+    Given a cached listing
+    When it is looked up after the TTL
+    Then the instances are listed again
+    """
+    # Given
+    clock = Clock()
+    listings = Listings([{"Summaries": []}])
+    stack_instances = inventory.StackInstanceInventory(listings, 60, clock)
+    stack_instances.instances("vpc")
+    # When
+    clock.now = 61
+    stack_instances.instances("vpc")
+    # Then
+    assert listings.calls == ["vpc", "vpc"]
+
+
+def test_record_and_invalidate():
+    """
+    Given a cached listing
+    When operations are recorded, then the listing is invalidated
+    Then lookups reflect the operations without listing, then list again
+    """
+    # Given
+    listings = Listings([{"Summaries": [summary("111111111111", "eu-west-1")]}])
+    stack_instances = inventory.StackInstanceInventory(listings, 60, Clock())
+    stack_instances.instances("vpc")
+    # When
+    stack_instances.record("vpc", ["222222222222"], ["eu-west-1"], True)
+    stack_instances.record("vpc", ["111111111111"], ["eu-west-1"], False)
+    recorded = stack_instances.accounts("vpc", "eu-west-1")
+    stack_instances.invalidate("vpc")
+    listed = stack_instances.accounts("vpc", "eu-west-1")
+    # Then
+    assert recorded == {"222222222222"}
+    assert listed == {"111111111111"}
+    assert listings.calls == ["vpc", "vpc"]
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from stackset_orchestration import logs, metrics
+
+
+def log_lines(capsys):
+    return [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if '"level"' in line
+    ]
+
+
+@pytest.fixture(autouse=True)
+def log_settings(monkeypatch):
+    monkeypatch.setattr(logs, "LOG_LEVEL", logs.LEVELS["INFO"])
+    monkeypatch.setattr(logs, "LOG_SAMPLE_RATE", 0.1)
+    monkeypatch.setattr(logs, "LOG_MAX_FIELD_LENGTH", 1024)
+    monkeypatch.setattr(metrics, "FUNCTION_NAME", "function")
+    metrics.set_properties()
+
+
+def test_info(capsys):
+    """
+    Given the stackset and account of an invocation
+    When a message is logged
+    Then a single compact JSON line holds the level, message, properties and fields
+    """
+    # Given
+    metrics.set_properties(StackSet="vpc", Account="111111111111")
+    # When
+    logs.info("Started the StackSet operation", operation_id="id", action="create")
+    # Then
+    output = capsys.readouterr().out
+    assert output == (
+        '{"level":"INFO","message":"Started the StackSet operation",'
+        '"function":"function","StackSet":"vpc","Account":"111111111111",'
+        '"operation_id":"id","action":"create"}\n'
+    )
+
+
+def test_level(capsys):
+    """
+    Given the INFO level
+    When a debug and a warning messages are logged
+    Then only the warning is printed
+    """
+    # When
+    logs.debug("Received event", event={})
+    logs.warning("Lost the lease of the StackSet")
+    # Then
+    assert [line["level"] for line in log_lines(capsys)] == ["WARNING"]
+
+
+def test_sampling(capsys, monkeypatch):
+    """
+    Given a sample rate of 10%
+    When a sampled message is logged 1000 times
+    Then about a hundred are printed, each with the sample rate
+    """
+    # Given
+    monkeypatch.setattr(logs, "_random", logs.random.Random(1))
+    # When
+    for _ in range(1000):
+        logs.info("StackSet operation status", sampled=True, status="RUNNING")
+    # Then
+    lines = log_lines(capsys)
+    assert 50 < len(lines) < 150
+    assert all(line["sample_rate"] == 0.1 for line in lines)
+
+
+def test_sampling_debug(capsys, monkeypatch):
+    """
+    Given the DEBUG level
+    When a sampled message is logged 10 times
+    Then every message is printed
+    """
+    # Given
+    monkeypatch.setattr(logs, "LOG_LEVEL", logs.LEVELS["DEBUG"])
+    # When
+    for _ in range(10):
+        logs.info("StackSet operation status", sampled=True, status="RUNNING")
+    # Then
+    assert len(log_lines(capsys)) == 10
+
+
+@pytest.mark.parametrize(
+    "max_length,expected",
+    [
+        (10, '{"accounts... (94 more characters)'),
+        (0, {"accounts": [str(account).zfill(12) for account in range(6)]}),
+    ],
+)
+def test_truncate(capsys, monkeypatch, max_length, expected):
+    """
+    Given a maximum field length
+    When a large event is logged
+    Then the event is truncated to the maximum length, unless it is 0
+    """
+    # Given
+    monkeypatch.setattr(logs, "LOG_MAX_FIELD_LENGTH", max_length)
+    # When
+    logs.error(
+        "Received event",
+        event={"accounts": [str(account).zfill(12) for account in range(6)]},
+        attempt=3,
+    )
+    # Then
+    [line] = log_lines(capsys)
+    assert line["event"] == expected
+    assert line["attempt"] == 3
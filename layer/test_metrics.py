@@ -0,0 +1,128 @@
+import json
+
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+import pytest
+
+from stackset_orchestration import metrics, retry
+
+
+def metric_lines(capsys):
+    return [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if '"_aws"' in line
+    ]
+
+
+@pytest.fixture(autouse=True)
+def enabled_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", True)
+    monkeypatch.setattr(metrics, "FUNCTION_NAME", "function")
+    metrics.set_properties()
+
+
+def test_emit(capsys):
+    """
+    Given the stackset and account of an invocation
+    When a metric is emitted
+    Then an Embedded Metric Format line declares the metric and its dimensions, tagged with the stackset and account
+    """
+    # Given
+    metrics.set_properties(StackSet="vpc", Account="111111111111", Region=None)
+    # When
+    metrics.count("OperationsStarted", Action="create")
+    # Then
+    [line] = metric_lines(capsys)
+    assert line["_aws"]["CloudWatchMetrics"] == [
+        {
+            "Namespace": "StackSetOrchestration",
+            "Dimensions": [["Function", "Action"]],
+            "Metrics": [{"Name": "OperationsStarted", "Unit": "Count"}],
+        }
+    ]
+    assert {key: value for key, value in line.items() if key != "_aws"} == {
+        "Function": "function",
+        "StackSet": "vpc",
+        "Account": "111111111111",
+        "Action": "create",
+        "OperationsStarted": 1,
+    }
+
+
+def test_emit_disabled(capsys, monkeypatch):
+    """
+    Given metrics are disabled
+    When a metric is emitted
+    Then nothing is printed
+    """
+    # Given
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    # When
+    metrics.count("OperationsStarted")
+    # Then
+    assert metric_lines(capsys) == []
+
+
+def test_instrument_client(capsys):
+    """
+    Given an instrumented client
+    When a call succeeds and another one is throttled
+    Then each call emits its latency, errors and throttles, by service and operation
+    """
+    # Given
+    cloudformation = boto3.client("cloudformation")
+    metrics.instrument_client(cloudformation)
+    stubber = Stubber(cloudformation)
+    stubber.add_response("list_stack_instances", {"Summaries": []})
+    stubber.add_client_error("list_stack_instances", "Throttling")
+    stubber.activate()
+    # When
+    cloudformation.list_stack_instances(StackSetName="vpc")
+    with pytest.raises(ClientError):
+        cloudformation.list_stack_instances(StackSetName="vpc")
+    stubber.deactivate()
+    # Then
+    lines = metric_lines(capsys)
+    assert [
+        (
+            line["Service"],
+            line["Operation"],
+            line["ApiCalls"],
+            line["ApiCallErrors"],
+            line["ApiCallThrottles"],
+        )
+        for line in lines
+    ] == [
+        ("cloudformation", "ListStackInstances", 1, 0, 0),
+        ("cloudformation", "ListStackInstances", 1, 1, 1),
+    ]
+    assert all(line["ApiCallLatency"] >= 0 for line in lines)
+
+
+def test_retry_sleep(capsys, monkeypatch):
+    """
+    Given an API call throttled once
+    When it is called through the retrier
+    Then the retry and the time slept before it are emitted with the error code
+    """
+    # Given
+    monkeypatch.setattr(retry.time, "sleep", lambda seconds: None)
+    errors = [ClientError({"Error": {"Code": "Throttling"}}, "operation")]
+
+    def function():
+        if errors:
+            raise errors.pop()
+        return "result"
+
+    # When
+    result = retry.Retrier().call(function)
+    # Then
+    assert result == "result"
+    retries, sleep = metric_lines(capsys)
+    assert (retries["ErrorCode"], retries["Retries"]) == ("Throttling", 1)
+    assert sleep["ErrorCode"] == "Throttling"
+    assert sleep["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [
+        {"Name": "RetrySleepTime", "Unit": "Milliseconds"}
+    ]
@@ -0,0 +1,93 @@
+import io
+import json
+
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import pytest
+
+from stackset_orchestration import payloads
+
+
+@pytest.fixture(autouse=True)
+def cached_lines():
+    payloads.read_line.cache_clear()
+    yield
+    payloads.read_line.cache_clear()
+
+
+def streaming_body(body):
+    return StreamingBody(io.BytesIO(body), len(body))
+
+
+def test_offload_and_load():
+    """
+    Given the stackset groups of a large execution
+    When they are offloaded, and an iteration loads its stackset
+    Then each stackset is replaced by the byte range of its line, loaded with a ranged GET and dropped from the returned state
+    """
+    # Given
+    vpc = {"name": "vpc", "accounts": ["111111111111"], "parameters": {"A": "1"}}
+    dns = {"name": "dns", "account": "111111111111"}
+    stackset_groups = [
+        {"name": "vpc", "max_concurrency": 1, "stacksets": [vpc]},
+        {"name": "dns", "max_concurrency": 1, "stacksets": [dns]},
+    ]
+    lines = [(json.dumps(stackset) + "\n").encode() for stackset in [vpc, dns]]
+    s3 = Stubber(payloads.s3)
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "bucket",
+            "Key": "plan.jsonl",
+            "Body": b"".join(lines),
+            "ContentType": "application/x-ndjson",
+        },
+    )
+    s3.add_response(
+        "get_object",
+        {"Body": streaming_body(lines[1])},
+        {
+            "Bucket": "bucket",
+            "Key": "plan.jsonl",
+            "Range": "bytes="
+            + str(len(lines[0]))
+            + "-"
+            + str(sum(map(len, lines)) - 1),
+        },
+    )
+    s3.activate()
+    # When
+    offloaded_groups = payloads.offload(stackset_groups, "bucket", "plan.jsonl")
+    state = offloaded_groups[1]["stacksets"][0]
+    loaded_state = payloads.load(state)
+    loaded_state["wait_seconds"] = 5
+    returned_state = payloads.compact(loaded_state)
+    s3.deactivate()
+    # Then
+    s3.assert_no_pending_responses()
+    assert offloaded_groups[0]["max_concurrency"] == 1
+    assert state == {
+        "name": "dns",
+        "plan": {
+            "bucket": "bucket",
+            "key": "plan.jsonl",
+            "range": [len(lines[0]), sum(map(len, lines)) - 1],
+        },
+    }
+    assert loaded_state == dict(dns, plan=state["plan"], wait_seconds=5)
+    assert returned_state == dict(state, wait_seconds=5)
+
+
+def test_load_state_without_plan():
+    """
+    Given the state of an execution which was not offloaded
+    When it is loaded and compacted
+    Then it is returned unchanged, without calling S3
+    """
+    # Given
+    state = {"name": "vpc", "account": "111111111111"}
+    # When
+    result = payloads.compact(payloads.load(state))
+    # Then
+    assert result == state
@@ -0,0 +1,32 @@
+from stackset_orchestration import polling
+
+
+def test_wait_seconds_grows_with_elapsed_time():
+    """
+    Given an operation on a single stack instance
+    When the wait before the next poll is computed as the operation keeps running
+    Then the wait starts at the minimum, grows with the time already waited, and is capped
+    """
+    # Given
+    waits = []
+    waited_seconds = 0
+    # When
+    for _ in range(30):
+        waits.append(polling.wait_seconds(waited_seconds, 1))
+        waited_seconds += waits[-1]
+    # Then
+    assert waits[0] == polling.MIN_WAIT_SECONDS
+    assert waits == sorted(waits)
+    assert waits[-1] == polling.MAX_WAIT_SECONDS
+
+
+def test_wait_seconds_grows_with_operation_size():
+    """
+    Given operations on a growing number of stack instances
+    When the wait before their first poll is computed
+    Then larger operations are polled less often, within the maximum wait
+    """
+    # When
+    waits = [polling.wait_seconds(0, count) for count in [1, 10, 50, 1000]]
+    # Then
+    assert waits[0] < waits[1] < waits[2] <= waits[3] == polling.MAX_WAIT_SECONDS
@@ -0,0 +1,103 @@
+import pytest
+
+from stackset_orchestration import preferences
+
+
+def test_default_preferences():
+    """
+    Given a stackset without operation preferences
+    When the preferences of its operations are built
+    Then each action gets its defaults, updates going through the regions in order
+    """
+    # Given
+    settings = {"name": "vpc"}
+    regions = ["eu-west-1", "us-east-1"]
+    # When
+    create = preferences.operation_preferences(settings, "create", regions)
+    update = preferences.operation_preferences(settings, "update", regions)
+    # Then
+    assert create == {
+        "MaxConcurrentPercentage": 100,
+        "FailureTolerancePercentage": 0,
+        "RegionConcurrencyType": "PARALLEL",
+        "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+    }
+    assert update == {
+        "MaxConcurrentPercentage": 25,
+        "FailureTolerancePercentage": 0,
+        "RegionConcurrencyType": "SEQUENTIAL",
+        "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+        "RegionOrder": regions,
+    }
+
+
+def test_configured_preferences():
+    """
+    Given a stackset setting counts instead of the default percentages
+    When the preferences of an update are built
+    Then the counts replace the percentages, and the other defaults are kept
+    """
+    # Given
+    settings = {
+        "name": "vpc",
+        "max_concurrent_count": 3,
+        "failure_tolerance_count": 2,
+        "region_concurrency_type": "PARALLEL",
+    }
+    # When
+    result = preferences.operation_preferences(settings, "update", ["eu-west-1"])
+    # Then
+    assert result == {
+        "MaxConcurrentCount": 3,
+        "FailureToleranceCount": 2,
+        "RegionConcurrencyType": "PARALLEL",
+        "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+    }
+
+
+@pytest.mark.parametrize(
+    "settings,error",
+    [
+        ({"max_concurrent_percentage": 0}, "max_concurrent_percentage must be"),
+        ({"failure_tolerance_percentage": 101}, "failure_tolerance_percentage must"),
+        ({"max_concurrent_count": "10"}, "max_concurrent_count must be"),
+        ({"failure_tolerance_count": True}, "failure_tolerance_count must be"),
+        ({"region_concurrency_type": "parallel"}, "must be one of SEQUENTIAL"),
+        ({"concurrency_mode": "SOFT"}, "concurrency_mode must be one of"),
+        (
+            {"failure_tolerance_count": 1, "failure_tolerance_percentage": 10},
+            "cannot be set together",
+        ),
+        (
+            {
+                "max_concurrent_count": 5,
+                "failure_tolerance_count": 1,
+                "concurrency_mode": "STRICT_FAILURE_TOLERANCE",
+            },
+            "at most one more than failure_tolerance_count",
+        ),
+    ],
+)
+def test_invalid_preferences(settings, error):
+    """
+    Given a stackset with an invalid operation preference
+    When it is validated
+    Then InvalidOperationPreferences is raised, naming the stackset and the setting
+    """
+    # When
+    with pytest.raises(preferences.InvalidOperationPreferences) as exception:
+        preferences.validate(dict(settings, name="vpc"))
+    # Then
+    assert "stackset vpc" in str(exception.value)
+    assert error in str(exception.value)
+
+
+def test_soft_failure_tolerance_allows_higher_concurrency():
+    """
+    Given a stackset with a concurrency higher than its failure tolerance, in the default SOFT_FAILURE_TOLERANCE mode
+    When it is validated
+    Then no error is raised
+    """
+    preferences.validate(
+        {"name": "vpc", "max_concurrent_count": 5, "failure_tolerance_count": 1}
+    )
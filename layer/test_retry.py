@@ -0,0 +1,140 @@
+from botocore.exceptions import ClientError
+import pytest
+
+from stackset_orchestration import retry
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "operation")
+
+
+class FlakyFunction:
+    def __init__(self, errors, result="result"):
+        self.errors = list(errors)
+        self.result = result
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.result
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(retry.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_call_without_contention(sleeps):
+    """
+    Given an API call which succeeds right away
+    When it is called through the retrier
+    Then its result is returned without sleeping
+    """
+    # Given
+    function = FlakyFunction([])
+    # When
+    result = retry.Retrier().call(function, StackSetName="vpc")
+    # Then
+    assert result == "result"
+    assert function.calls == [{"StackSetName": "vpc"}]
+    assert sleeps == []
+
+
+def test_call_retries_on_contention(sleeps):
+    """
+    Given an API call which is throttled, then conflicts with another StackSet operation
+    When it is called through the retrier
+    Then it is retried after backing off, and its result is returned
+    """
+    # Given
+    function = FlakyFunction(
+        [client_error("Throttling"), client_error("OperationInProgressException")]
+    )
+    # When
+    result = retry.Retrier(base_delay=1, max_delay=5).call(function)
+    # Then
+    assert result == "result"
+    assert len(function.calls) == 3
+    assert len(sleeps) == 2
+    assert all(1 <= sleep <= 5 for sleep in sleeps)
+
+
+def test_call_does_not_retry_other_errors(sleeps):
+    """
+    Given an API call failing with a non retryable error
+    When it is called through the retrier
+    Then the error is raised right away
+    """
+    # Given
+    function = FlakyFunction([client_error("StackSetNotFoundException")])
+    # When
+    with pytest.raises(ClientError):
+        retry.Retrier().call(function)
+    # Then
+    assert len(function.calls) == 1
+    assert sleeps == []
+
+
+def test_call_gives_up_after_max_attempts(sleeps):
+    """
+    Given an API call which keeps conflicting with another StackSet operation
+    When it is called through the retrier
+    Then the error is raised once the maximum number of attempts is reached
+    """
+    # Given
+    function = FlakyFunction([client_error("OperationInProgressException")] * 5)
+    # When
+    with pytest.raises(ClientError) as error:
+        retry.Retrier(max_attempts=3).call(function)
+    # Then
+    assert retry.error_code(error.value) == "OperationInProgressException"
+    assert len(function.calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_decorrelated_jitter_is_bounded():
+    """
+    Given a base and a maximum delay
+    When backoff delays are drawn
+    Then every delay lies between the base and the maximum delay
+    """
+    # Given
+    delays = retry.decorrelated_jitter(0.5, 10)
+    # When
+    drawn = [next(delays) for _ in range(200)]
+    # Then
+    assert all(0.5 <= delay <= 10 for delay in drawn)
+    assert max(drawn) > 5
+
+
+def test_paginate(sleeps):
+    """
+    Given a paginated API call throttled on its second page
+    When it is paginated through the retrier
+    Then every page is returned, and only the throttled page is called again
+    """
+    # Given
+    pages = [{"Summaries": [1], "NextToken": "token"}, {"Summaries": [2]}]
+    calls = []
+    errors = [client_error("Throttling")]
+
+    def function(**kwargs):
+        calls.append(dict(kwargs))
+        if "NextToken" in kwargs and errors:
+            raise errors.pop()
+        return pages[1] if "NextToken" in kwargs else pages[0]
+
+    # When
+    result = list(retry.Retrier().paginate(function, StackSetName="vpc"))
+    # Then
+    assert result == pages
+    assert calls == [
+        {"StackSetName": "vpc"},
+        {"StackSetName": "vpc", "NextToken": "token"},
+        {"StackSetName": "vpc", "NextToken": "token"},
+    ]
+    assert len(sleeps) == 1
@@ -0,0 +1,107 @@
+from stackset_orchestration import preferences, rollout
+
+
+def test_waves():
+    """
+    Given the accounts of a stackset with a canary account in the middle
+    When they are split into the waves of its rollout
+    Then the canary account comes first, then waves of 1, 5 and 25 accounts, the last wave taking the rest
+    """
+    # Given
+    accounts = ["%012d" % account for account in range(40)]
+    settings = {"canary_accounts": ["000000000020"]}
+    # When
+    waves = rollout.waves(accounts, settings)
+    # Then
+    assert [len(wave) for wave in waves] == [1, 1, 5, 25, 8]
+    assert waves[0] == ["000000000020"]
+    assert waves[1] == ["000000000000"]
+    assert sum(waves, []).count("000000000020") == 1
+
+
+def test_waves_max_wave():
+    """
+    Given the accounts of a stackset with more canary accounts than the maximum wave size
+    When they are split into the waves of its rollout
+    Then no wave has more accounts than the maximum, the waves growing up to it
+    """
+    # Given
+    accounts = ["%012d" % account for account in range(2000)]
+    settings = {"canary_accounts": accounts[:150]}
+    # When
+    waves = rollout.waves(accounts, settings)
+    # Then
+    assert [len(wave) for wave in waves][:7] == [100, 50, 1, 5, 25, 100, 100]
+    assert max(len(wave) for wave in waves) == rollout.MAX_WAVE
+    assert sum(waves, []) == accounts
+
+
+def test_waves_settings():
+    """
+    Given a rollout without canary accounts, with its own first wave and growth factor
+    When accounts are split into its waves
+    Then the waves grow from the first wave by the growth factor
+    """
+    # Given
+    accounts = ["%012d" % account for account in range(10)]
+    settings = {"first_wave": 2, "growth_factor": 2}
+    # When
+    waves = rollout.waves(accounts, settings)
+    # Then
+    assert [len(wave) for wave in waves] == [2, 4, 4]
+
+
+def test_wave_settings():
+    """
+    Given a stackset with a maximum concurrent count, and a rollout with its own failure tolerance
+    When the settings of the operations of its waves are built
+    Then the waves run at full concurrency with the failure tolerance of the rollout
+    """
+    # Given
+    settings = {
+        "name": "vpc",
+        "max_concurrent_count": 2,
+        "failure_tolerance_percentage": 0,
+        "region_concurrency_type": "PARALLEL",
+        "rollout": {"failure_tolerance_count": 1},
+    }
+    # When
+    wave_settings = rollout.wave_settings(settings)
+    # Then
+    assert {
+        setting: value
+        for setting, value in wave_settings.items()
+        if setting not in ["name", "rollout"]
+    } == {
+        "max_concurrent_percentage": 100,
+        "failure_tolerance_count": 1,
+        "region_concurrency_type": "PARALLEL",
+        "concurrency_mode": "SOFT_FAILURE_TOLERANCE",
+    }
+
+
+def test_wave_operation_preferences():
+    """
+    Given a stackset in STRICT_FAILURE_TOLERANCE mode, with a rollout
+    When the OperationPreferences of an update of one of its waves are built
+    Then the wave is updated at full concurrency in SOFT_FAILURE_TOLERANCE mode, stopping after the first failure
+    """
+    # Given
+    settings = {
+        "name": "vpc",
+        "concurrency_mode": "STRICT_FAILURE_TOLERANCE",
+        "rollout": {"canary_accounts": ["123456789012"]},
+    }
+    regions = ["eu-west-1", "us-east-1"]
+    # When
+    operation_preferences = preferences.operation_preferences(
+        rollout.wave_settings(settings), "update", regions
+    )
+    # Then
+    assert operation_preferences == {
+        "MaxConcurrentPercentage": 100,
+        "FailureTolerancePercentage": 0,
+        "RegionConcurrencyType": "SEQUENTIAL",
+        "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+        "RegionOrder": regions,
+    }
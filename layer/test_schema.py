@@ -0,0 +1,226 @@
+import pytest
+import yaml
+
+from stackset_orchestration import schema
+
+
+def test_normalize():
+    """
+    Given a configuration file with unquoted account IDs, typed parameters and a single region
+    When it is normalized
+    Then account IDs and parameters are strings, regions are lists and terminate is a bool
+    """
+    # Given
+    config_file = {
+        "account": 123456789012,
+        "regions": "eu-west-1",
+        "terminate": "False",
+        "stackset_concurrency": 2,
+        "stacksets": [
+            {
+                "name": "vpc",
+                "parameters": {
+                    "CidrBlock": "10.0.0.0/24",
+                    "EnableDnsHostnames": True,
+                    "SubnetCount": 3,
+                    "AvailabilityZones": ["eu-west-1a", "eu-west-1b"],
+                },
+                "regions": ["eu-west-1", "us-east-1"],
+                "max_concurrent_percentage": 50,
+            },
+            {
+                "name": "baseline",
+                "deployment_targets": {"organizational_units": ["ou-abcd-11111111"]},
+            },
+        ],
+    }
+    # When
+    result = schema.normalize(config_file)
+    # Then
+    assert result == {
+        "account": "123456789012",
+        "regions": ["eu-west-1"],
+        "terminate": False,
+        "stackset_concurrency": 2,
+        "stacksets": [
+            {
+                "name": "vpc",
+                "parameters": {
+                    "CidrBlock": "10.0.0.0/24",
+                    "EnableDnsHostnames": "true",
+                    "SubnetCount": "3",
+                    "AvailabilityZones": "eu-west-1a,eu-west-1b",
+                },
+                "regions": ["eu-west-1", "us-east-1"],
+                "max_concurrent_percentage": 50,
+            },
+            {
+                "name": "baseline",
+                "deployment_targets": {"organizational_units": ["ou-abcd-11111111"]},
+            },
+        ],
+    }
+
+
+def test_normalize_errors():
+    """
+    Given a configuration file with several invalid fields
+    When it is normalized
+    Then InvalidConfigFile is raised, listing every error with its path
+    """
+    # Given
+    config_file = {
+        "account": "1234",
+        "stacksets": [
+            {"parameters": {"CidrBlock": {"Ref": "Cidr"}}},
+            {"name": "dns", "regions": ["Ireland"], "paramters": {}},
+        ],
+    }
+    # When
+    with pytest.raises(schema.InvalidConfigFile) as exception:
+        schema.normalize(config_file)
+    # Then
+    assert str(exception.value) == (
+        "Invalid configuration file: "
+        "account must be a 12-digit account ID; "
+        "stacksets[0].name is required; "
+        "stacksets[0].parameters.CidrBlock must be a string, a number, a boolean or a list; "
+        "stacksets[1].regions[0] must be a region name; "
+        "stacksets[1].paramters is not a known setting"
+    )
+
+
+def test_normalize_octal_account_id():
+    """
+    Given a configuration file with an unquoted account ID starting with 0, which YAML reads as an octal number
+    When it is normalized
+    Then InvalidConfigFile is raised, asking to quote the account ID
+    """
+    # Given
+    config_file = yaml.safe_load("account: 012345670123\nstacksets:\n- name: vpc\n")
+    # When
+    with pytest.raises(schema.InvalidConfigFile) as exception:
+        schema.normalize(config_file)
+    # Then
+    assert "account must be a 12-digit account ID, quoted if it starts with 0" in str(
+        exception.value
+    )
+
+
+def test_normalize_octal_deployment_target_account_id():
+    """
+    Given a stackset filtering the accounts of its organizational units, with an unquoted account ID starting with 0
+    When the configuration file is normalized
+    Then InvalidConfigFile is raised, asking to quote the account ID
+    """
+    # Given
+    config_file = yaml.safe_load(
+        "stacksets:\n"
+        "- name: baseline\n"
+        "  deployment_targets:\n"
+        "    organizational_units: [ou-abcd-11111111]\n"
+        "    account_filter_type: INTERSECTION\n"
+        "    accounts: [012345670123]\n"
+    )
+    # When
+    with pytest.raises(schema.InvalidConfigFile) as exception:
+        schema.normalize(config_file)
+    # Then
+    assert (
+        "stacksets[0].deployment_targets.accounts[0] must be a 12-digit account ID,"
+        " quoted if it starts with 0"
+    ) in str(exception.value)
+
+
+@pytest.mark.parametrize(
+    "config_file,error",
+    [
+        (None, "configuration file must be a mapping"),
+        ({"account": "123456789012"}, "stacksets is required"),
+        (
+            {"stacksets": [{"name": "vpc"}]},
+            "stacksets[0] needs the account of the file",
+        ),
+        (
+            {
+                "account": "123456789012",
+                "stacksets": [{"name": "vpc", "failure_tolerance_count": -1}],
+            },
+            "Invalid operation preferences of stackset vpc",
+        ),
+        (
+            {
+                "account": "123456789012",
+                "stacksets": [{"name": "vpc", "call_as": "ME"}],
+            },
+            "Invalid deployment targets of stackset vpc",
+        ),
+        (
+            {"account": "123456789012", "max_concurrency": True, "stacksets": []},
+            "max_concurrency must be an integer of at least 0",
+        ),
+        (
+            {
+                "account": "123456789012",
+                "stacksets": [{"name": "subnets", "depends_on": "vcp"}],
+            },
+            "stackset subnets depends on unknown stackset vcp",
+        ),
+        (
+            {
+                "account": "123456789012",
+                "stacksets": [
+                    {"name": "vpc", "depends_on": "subnets"},
+                    {"name": "subnets", "depends_on": "vpc"},
+                ],
+            },
+            "Cyclic dependencies between stacksets vpc, subnets",
+        ),
+        (
+            {
+                "account": "123456789012",
+                "stacksets": [{"name": "vpc", "rollout": {"first_wave": 0}}],
+            },
+            "stacksets[0].rollout.first_wave must be an integer of at least 1",
+        ),
+        (
+            {
+                "stacksets": [
+                    {
+                        "name": "vpc",
+                        "deployment_targets": {
+                            "organizational_units": ["ou-abcd-11111111"]
+                        },
+                        "rollout": {"canary_accounts": ["123456789012"]},
+                    }
+                ],
+            },
+            "Invalid rollout of stackset vpc",
+        ),
+        (
+            {
+                "stacksets": [
+                    {
+                        "name": "baseline",
+                        "deployment_targets": {
+                            "organizational_units": "ou-abcd-11111111",
+                            "acounts": ["123456789012"],
+                        },
+                    }
+                ],
+            },
+            "stacksets[0].deployment_targets.acounts is not a known setting",
+        ),
+    ],
+)
+def test_normalize_invalid(config_file, error):
+    """
+    Given an invalid configuration file
+    When it is normalized
+    Then InvalidConfigFile is raised with the error
+    """
+    # When
+    with pytest.raises(schema.InvalidConfigFile) as exception:
+        schema.normalize(config_file)
+    # Then
+    assert error in str(exception.value)
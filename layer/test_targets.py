@@ -0,0 +1,78 @@
+import pytest
+
+from stackset_orchestration import targets
+
+
+def test_deployment_targets():
+    """
+    Given a stackset targeting organizational units without an account
+    When its deployment targets are built
+    Then the account filter and accounts are passed along with the units
+    """
+    # Given
+    settings = {
+        "name": "baseline",
+        "call_as": "DELEGATED_ADMIN",
+        "deployment_targets": {
+            "organizational_units": ["ou-abcd-11111111"],
+            "account_filter_type": "DIFFERENCE",
+            "accounts": [111111111111],
+        },
+    }
+    # When
+    targets.validate(settings)
+    result = targets.deployment_targets(settings)
+    # Then
+    assert result == {
+        "OrganizationalUnitIds": ["ou-abcd-11111111"],
+        "AccountFilterType": "DIFFERENCE",
+        "Accounts": ["111111111111"],
+    }
+    assert targets.call_as_arguments(settings) == {"CallAs": "DELEGATED_ADMIN"}
+    assert targets.call_as_arguments({"name": "vpc"}) == {}
+
+
+@pytest.mark.parametrize(
+    "settings,error",
+    [
+        ({"deployment_targets": {}}, "must list organizational_units"),
+        (
+            {
+                "deployment_targets": {
+                    "organizational_units": ["ou-abcd-11111111"],
+                    "account_filter_type": "EXCEPT",
+                }
+            },
+            "account_filter_type must be one of",
+        ),
+        (
+            {
+                "deployment_targets": {
+                    "organizational_units": ["ou-abcd-11111111"],
+                    "account_filter_type": "INTERSECTION",
+                }
+            },
+            "account_filter_type INTERSECTION needs accounts",
+        ),
+        (
+            {
+                "account": "111111111111",
+                "deployment_targets": {"organizational_units": ["ou-abcd-11111111"]},
+            },
+            "cannot be set together",
+        ),
+        ({"call_as": "ADMIN"}, "call_as must be one of"),
+    ],
+)
+def test_invalid_deployment_targets(settings, error):
+    """
+    Given a stackset with invalid deployment targets
+    When it is validated
+    Then InvalidDeploymentTargets is raised, naming the stackset and the setting
+    """
+    # When
+    with pytest.raises(targets.InvalidDeploymentTargets) as exception:
+        targets.validate(dict(settings, name="baseline"))
+    # Then
+    assert "stackset baseline" in str(exception.value)
+    assert error in str(exception.value)